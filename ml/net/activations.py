@@ -0,0 +1,167 @@
+import numpy as np
+import scipy.special
+import sys
+
+
+def get_softmax(z, out=None, column=None, spread=None):
+	"""softmax of each column of z (each column is a sample).
+	   out, column and spread are optional preallocated (classes x samples), (1 x samples) and (classes x samples)
+	   arrays to work in"""
+	if out is None:
+		out = np.empty(z.shape, z.dtype)
+	if column is None:
+		column = np.empty( (1, z.shape[1]), z.dtype )
+	if spread is None:
+		spread = np.empty(z.shape, z.dtype)
+
+	#subtract each column's max so that exp() can't overflow. it cancels out in the normalization.
+	#column is copied into every row of spread first: a ufunc that broadcasts column itself buffers its operands
+	#in a 64 KB scratch array on every call, a copy doesn't
+	np.max(z, axis=0, keepdims=True, out=column)
+	np.copyto(spread, column)
+	np.subtract(z, spread, out=out)
+	np.exp(out, out=out)
+	np.sum(out, axis=0, keepdims=True, out=column)
+	np.copyto(spread, column)
+	out /= spread
+	return out
+
+
+#An activation is the y = f(z) of a layer's neurons. Layers look theirs up by neuron_type in the activations dict
+#below, so a new one only has to be added there.
+#
+#forward(z, y, buffers) writes f(z) into y. derivative(y, Dey, out) returns dE/dz = Dey * f'(z),
+#written into out (linear returns Dey as it is). The derivative is computed from y alone, since that is what layers
+#keep after the forward pass. Both work in place, without temporaries. flops and derivative_flops are roughly what
+#they cost per neuron and sample, for profiling.
+
+class Activation:
+	flops = 1
+	derivative_flops = 1
+
+	def derivative(self, y, Dey, out):
+		print('%s has no derivative here (only usable as an output layer)' % type(self).__name__)
+		sys.exit()
+
+
+class Logistic(Activation):
+	"""1 / (1 + e^-z), without overflowing for large negative z"""
+	flops = 4
+	derivative_flops = 3
+
+	def forward(self, z, y, buffers):
+		scipy.special.expit(z, out=y)
+
+	def derivative(self, y, Dey, out):
+		#Dey * y * (1-y)
+		np.subtract(1.0, y, out=out)
+		out *= y
+		out *= Dey
+		return out
+
+
+class Tanh(Activation):
+	flops = 4
+	derivative_flops = 3
+
+	def forward(self, z, y, buffers):
+		np.tanh(z, out=y)
+
+	def derivative(self, y, Dey, out):
+		#Dey * (1 - y^2)
+		np.multiply(y, y, out=out)
+		np.subtract(1.0, out, out=out)
+		out *= Dey
+		return out
+
+
+class ReLU(Activation):
+	flops = 1
+	derivative_flops = 2
+
+	def forward(self, z, y, buffers):
+		np.maximum(z, 0.0, out=y)
+
+	def derivative(self, y, Dey, out):
+		#y >= 0, so sign(y) is the 0/1 derivative
+		np.sign(y, out=out)
+		out *= Dey
+		return out
+
+
+class LeakyReLU(Activation):
+	"""z for z > 0, slope*z otherwise"""
+	flops = 2
+	derivative_flops = 4
+
+	def __init__(self, slope=0.01):
+		assert(0.0 < slope < 1.0)
+		self.slope = slope
+
+	def forward(self, z, y, buffers):
+		#max(z, slope*z), since 0 < slope < 1
+		np.multiply(z, self.slope, out=y)
+		np.maximum(z, y, out=y)
+
+	def derivative(self, y, Dey, out):
+		#sign(y) is -1 or 1, mapped to slope or 1
+		np.sign(y, out=out)
+		out *= 0.5 * (1.0 - self.slope)
+		out += 0.5 * (1.0 + self.slope)
+		out *= Dey
+		return out
+
+
+class Softplus(Activation):
+	"""log(1 + e^z), a smooth ReLU"""
+	flops = 5
+	derivative_flops = 4
+
+	def forward(self, z, y, buffers):
+		#max(z, 0) + log(1 + e^-|z|), which can't overflow (and is several times faster than np.logaddexp)
+		positive = buffers.get('softplus', z.shape, y.dtype)
+		np.maximum(z, 0.0, out=positive)
+		np.abs(z, out=y)
+		np.negative(y, out=y)
+		np.exp(y, out=y)
+		np.log1p(y, out=y)
+		y += positive
+
+	def derivative(self, y, Dey, out):
+		#f'(z) = logistic(z) = 1 - e^-y
+		np.negative(y, out=out)
+		np.expm1(out, out=out)
+		np.negative(out, out=out)
+		out *= Dey
+		return out
+
+
+class Linear(Activation):
+	flops = 0
+	derivative_flops = 0
+
+	def forward(self, z, y, buffers):
+		y[...] = z
+
+	def derivative(self, y, Dey, out):
+		return Dey
+
+
+class Softmax(Activation):
+	"""over each column (sample). Output layers only: their dE/dz comes from the cost (see Layer.get_output_Dez)"""
+	flops = 5
+	derivative_flops = 0
+
+	def forward(self, z, y, buffers):
+		get_softmax(z, out=y, column=buffers.get('column', (1, z.shape[1])), spread=buffers.get('spread', z.shape))
+
+
+activations = {'logistic': Logistic(), 'tanh': Tanh(), 'relu': ReLU(), 'leaky_relu': LeakyReLU(), 'softplus': Softplus(),
+               'linear': Linear(), 'softmax': Softmax()}
+
+
+def get_activation(neuron_type):
+	"""the activation of neuron_type. raises ValueError if there is none by that name"""
+	if neuron_type not in activations:
+		raise ValueError('Unexpected neuron type %s (one of %s)' % (neuron_type, ', '.join(sorted(activations))))
+	return activations[neuron_type]
@@ -2,7 +2,403 @@ import numpy as np
 import scipy.io as sio
 import math
 import sys
-
+from optimizers import *
+from activations import *
+
+
+
+class Buffers:
+	"""Named work arrays. With reuse on, an array is handed out again for as long as the requested shape stays the same,
+	   so that steady-state training doesn't allocate. With reuse off, every request gets a new array.
+	   Callers always overwrite (or zero) what they get back."""
+	def __init__(self, dtype=np.float64):
+		self.reuse = False
+		self.arrays = {}
+		self.dtype = dtype
+
+	def get(self, name, shape, dtype=None):
+		if dtype is None:
+			dtype = self.dtype
+
+		if not self.reuse:
+			return np.empty(shape, dtype)
+
+		array = self.arrays.get(name)
+		if array is None or array.shape != shape or array.dtype != dtype:
+			array = np.empty(shape, dtype)
+			self.arrays[name] = array
+		return array
+
+	def set_reuse(self, reuse):
+		self.reuse = reuse
+		if not reuse:
+			self.arrays = {}
+
+
+def get_initial_weights(shape, init_weight, dtype):
+	"""uniform random weights in [0, init_weight). With init_weight 0 the weights are zeros, which numpy can hand out
+	   without touching memory (e.g. for weights that are about to be replaced by ones loaded from a checkpoint)"""
+	if init_weight == 0:
+		return np.zeros(shape, dtype)
+	return (init_weight * np.random.rand(*shape)).astype(dtype)
+
+
+class Parameter:
+	"""A trainable weight array, together with its gradient and the state used by the update rule"""
+	def __init__(self, W, master_dtype=None):
+		self.W = W
+
+		#optional higher-precision copy of W that updates are applied to. W is then a rounded copy used for compute
+		self.master = None
+		if master_dtype is not None and np.dtype(master_dtype) != W.dtype:
+			self.master = W.astype(master_dtype)
+
+		#dE/dw, averaged across the samples of the last batch. If Dew_columns isn't None, the gradient is zero outside
+		#of those columns of W, and Dew only holds them (W.shape[0] x len(Dew_columns)), e.g. for the output weights
+		#of a sampled or hierarchical softmax
+		self.Dew = None
+		self.Dew_columns = None
+
+		#optimizer state (e.g. momentum), by name. updated in place, in the precision of the master weights
+		self.state = {}
+
+		#scratch array of the master weights' shape, for the optimizer
+		self.work = None
+
+		#sum of the (sample-weighted) gradients of micro-batches not applied yet, in the precision of the master weights
+		self.accumulator = None
+
+	def get_master(self):
+		"""the array that updates are applied to"""
+		if self.master is not None:
+			return self.master
+		return self.W
+
+	def get_work_array(self):
+		if self.work is None:
+			master = self.get_master()
+			self.work = np.empty(master.shape, master.dtype)
+		return self.work
+
+	def get_accumulator(self):
+		if self.accumulator is None:
+			master = self.get_master()
+			self.accumulator = np.zeros(master.shape, master.dtype)
+		return self.accumulator
+
+	def set_Dew(self, Dew, columns=None):
+		self.Dew = Dew
+		self.Dew_columns = columns
+
+	def add_Dew_to(self, total, weight):
+		"""total += weight * Dew, whether Dew holds all of the gradient or some of its columns"""
+		if self.Dew_columns is None:
+			work = self.get_work_array()
+			np.multiply(self.Dew, weight, out=work)
+			total += work
+		else:
+			total[:, self.Dew_columns] += weight * self.Dew
+
+	def sync(self, columns=None):
+		"""copies the master weights (if any) into W after an update (only columns, if given)"""
+		if self.master is not None:
+			if columns is None:
+				self.W[...] = self.master
+			else:
+				self.W[:, columns] = self.master[:, columns]
+
+
+class DenseBlock:
+	"""Full connectivity between neurons [from_range) of a layer and neurons [to_range) of the layer above.
+	   Only the (from x to) sub-matrix of real connections is stored, so neurons outside of the ranges cost nothing."""
+	def __init__(self, from_range, to_range, init_weight, dtype=np.float64, master_dtype=None):
+		self.from_range = from_range
+		self.to_range = to_range
+
+		from_len = from_range[1] - from_range[0]
+		to_len = to_range[1] - to_range[0]
+		self.param = Parameter(get_initial_weights((from_len, to_len), init_weight, dtype), master_dtype)
+		self.buffers = Buffers(dtype)
+
+	def forward(self, y, z):
+		"""adds this block's contribution to the net input z of the layer above"""
+		i0, i1 = self.from_range
+		j0, j1 = self.to_range
+		z_block = self.buffers.get('z', (j1-j0, y.shape[1]))
+		np.dot(self.param.W.T, y[i0:i1], out=z_block)
+		z[j0:j1] += z_block
+
+	def backward(self, Dez_above, Dey):
+		"""adds this block's contribution to dE/dy of the layer below"""
+		i0, i1 = self.from_range
+		j0, j1 = self.to_range
+		Dey_block = self.buffers.get('Dey', (i1-i0, Dez_above.shape[1]))
+		np.dot(self.param.W, Dez_above[j0:j1], out=Dey_block)
+		Dey[i0:i1] += Dey_block
+
+	def get_Dew(self, y, Dez_above, Dew=None):
+		"""dE/dw summed across all samples. If Dew is given (the gradient so far of a parameter this block shares
+		   with others), the gradient is added to it"""
+		i0, i1 = self.from_range
+		j0, j1 = self.to_range
+		result = self.buffers.get('Dew', self.param.W.shape)
+		np.dot(y[i0:i1], Dez_above[j0:j1].T, out=result)
+		if Dew is None:
+			return result
+		Dew += result
+		return Dew
+
+	def add_to_dense(self, W):
+		i0, i1 = self.from_range
+		j0, j1 = self.to_range
+		W[i0:i1, j0:j1] += self.param.W
+
+	def get_flops(self, num_samples):
+		"""[forward, backward, get_Dew] floating point operations for a batch (for profiling)"""
+		flops = 2 * self.param.W.size * num_samples
+		return [flops, flops, flops]
+
+
+class EmbeddingBlock(DenseBlock):
+	"""Full connectivity from neurons [from_range) of an embedding layer, whose inputs are one-hot.
+	   Instead of a one-hot matrix, the layer's y holds the indices of the active neurons (slots x samples), so the
+	   forward pass is a row gather from W and dE/dw is a scatter-add of the rows that were used."""
+	def __init__(self, *args, **kwargs):
+		DenseBlock.__init__(self, *args, **kwargs)
+		#get_slots of the last y, and that y
+		self.slots = None
+		self.slots_y = None
+
+	def get_slots(self, y, reuse=False):
+		"""list of (slot, local indices, samples whose active neuron in that slot is inside this block).
+		   With reuse, the list of the last call is returned if it was for the same y: get_Dew gets the y of the
+		   forward pass before it, so this is worked out once per batch (forward always works it out, since an
+		   input array can be refilled with the next batch)"""
+		if reuse and y is self.slots_y:
+			return self.slots
+
+		self.slots = []
+		self.slots_y = y
+		if y.shape[1] == 0:
+			return self.slots
+
+		from_len = self.from_range[1] - self.from_range[0]
+		num_slots = y.shape[0]
+		local = self.buffers.get('local', y.shape, y.dtype)
+		lowest = self.buffers.get('lowest', (num_slots,), y.dtype)
+		highest = self.buffers.get('highest', (num_slots,), y.dtype)
+		np.subtract(y, self.from_range[0], out=local)
+		local.min(axis=1, out=lowest)
+		local.max(axis=1, out=highest)
+
+		for slot in range(0, num_slots):
+			if lowest[slot] >= 0 and highest[slot] < from_len:
+				self.slots.append((slot, local[slot], slice(None)))
+			elif highest[slot] >= 0 and lowest[slot] < from_len:
+				inside = (local[slot] >= 0) & (local[slot] < from_len)
+				if inside.any():
+					self.slots.append((slot, local[slot][inside], inside))
+		return self.slots
+
+	def forward(self, y, z):
+		j0, j1 = self.to_range
+		for (slot, local, samples) in self.get_slots(y):
+			if isinstance(samples, slice):
+				rows = self.buffers.get('rows', (local.shape[0], j1-j0))
+				z_block = self.buffers.get('z', (j1-j0, local.shape[0]))
+				#indices are in range by construction. mode='clip' lets take() write straight into out instead of via a copy
+				np.take(self.param.W, local, axis=0, out=rows, mode='clip')
+				z_block[...] = rows.T
+				z[j0:j1] += z_block
+			else:
+				z[j0:j1, samples] += self.param.W[local].T
+
+	def get_flops(self, num_samples):
+		#a row per sample and context slot in range: about one per sample for simple_words
+		flops = self.param.W.shape[1] * num_samples
+		return [flops, 0, flops]
+
+	def backward(self, Dez_above, Dey):
+		#embedding layers take their input from data, so there is nothing below to propagate to
+		print('Embedding layers have no layer below to backpropagate to')
+		sys.exit()
+
+	def get_Dew(self, y, Dez_above, Dew=None):
+		#rows are scattered straight into a shared parameter's gradient, if there is one
+		j0, j1 = self.to_range
+		if Dew is None:
+			Dew = self.buffers.get('Dew', self.param.W.shape)
+			Dew.fill(0.0)
+		for (slot, local, samples) in self.get_slots(y, True):
+			np.add.at( Dew, local, Dez_above[j0:j1, samples].T )
+		return Dew
+
+
+class ConvolutionBlock:
+	"""Shared-kernel connections from a 1D/2D layer to a convolution layer above.
+	   Each feature map above has one kernel that covers a feature in every map of the layer below, so only
+	   (feature size * maps below) x (maps above) weights are stored. Forward/backward gather the features seen by all
+	   neurons into columns (im2col) and do a single matmul."""
+	def __init__(self, fields, from_size, num_maps, init_weight, dtype=np.float64, master_dtype=None):
+		#fields: (feature size * maps below) x (neurons per map above). column p holds the indices of the feature seen by position p
+		#contiguous, or every take() with it copies it first
+		self.fields = np.ascontiguousarray(fields)
+		self.num_maps = num_maps
+		self.from_range = [0, from_size]
+		self.to_range = [0, num_maps * fields.shape[1]]
+		self.param = Parameter(get_initial_weights((fields.shape[0], num_maps), init_weight, dtype), master_dtype)
+		self.buffers = Buffers(dtype)
+
+	def get_columns(self, y):
+		"""im2col: (feature size) x (positions*samples) matrix holding the feature seen by each position, for each sample"""
+		columns = self.buffers.get('columns', self.fields.shape + (y.shape[1],))
+		#fields are in range by construction. mode='clip' lets take() write straight into out instead of via a copy
+		np.take(y, self.fields, axis=0, out=columns, mode='clip')
+		return columns.reshape(self.fields.shape[0], -1)
+
+	def forward(self, y, z):
+		#the layer above is laid out map by map, so (maps x (positions*samples)) is a view of z
+		z_maps = self.buffers.get('z', (self.num_maps, self.fields.shape[1] * y.shape[1]))
+		np.dot(self.param.W.T, self.get_columns(y), out=z_maps)
+		z_view = z.reshape(self.num_maps, -1)
+		z_view += z_maps
+
+	def backward(self, Dez_above, Dey):
+		num_samples = Dez_above.shape[1]
+		Dcolumns = self.buffers.get('Dcolumns', (self.fields.shape[0], self.fields.shape[1] * num_samples))
+		np.dot(self.param.W, Dez_above.reshape(self.num_maps, -1), out=Dcolumns)
+		Dcolumns = Dcolumns.reshape(self.fields.shape[0], self.fields.shape[1], num_samples)
+
+		#col2im. for a given kernel entry every position sees a different neuron below, so no index repeats within a row
+		gathered = self.buffers.get('gathered', (self.fields.shape[1], num_samples))
+		for k in range(0, self.fields.shape[0]):
+			np.take(Dey, self.fields[k], axis=0, out=gathered, mode='clip')
+			gathered += Dcolumns[k]
+			Dey[self.fields[k]] = gathered
+
+	def get_Dew(self, y, Dez_above, Dew=None):
+		result = self.buffers.get('Dew', self.param.W.shape)
+		np.dot(self.get_columns(y), Dez_above.reshape(self.num_maps, -1).T, out=result)
+		if Dew is None:
+			return result
+		Dew += result
+		return Dew
+
+	def add_to_dense(self, W):
+		num_positions = self.fields.shape[1]
+		for m in range(0, self.num_maps):
+			to_indices = m*num_positions + np.arange(num_positions)
+			W[self.fields, to_indices[np.newaxis,:]] += self.param.W[:,m][:,np.newaxis]
+
+	def get_flops(self, num_samples):
+		matmul = 2 * self.param.W.size * self.fields.shape[1] * num_samples
+		return [matmul, matmul + self.fields.size * num_samples, matmul]
+
+
+class PoolBlock:
+	"""Fixed connections from a 1D/2D layer to an average_pool layer above. Each neuron above is the average of its
+	   feature in the same map below, so there are no weights to learn."""
+	def __init__(self, fields, from_size, dtype=np.float64):
+		#fields: (feature size) x (neurons above). column k holds the indices of the feature averaged by neuron k above
+		self.fields = np.ascontiguousarray(fields)
+		self.from_range = [0, from_size]
+		self.to_range = [0, fields.shape[1]]
+		self.param = None
+		self.buffers = Buffers(dtype)
+
+	def forward(self, y, z):
+		feature_size = self.fields.shape[0]
+		total = self.buffers.get('z', (self.fields.shape[1], y.shape[1]))
+		gathered = self.buffers.get('gathered', total.shape)
+		total.fill(0.0)
+		for k in range(0, feature_size):
+			np.take(y, self.fields[k], axis=0, out=gathered, mode='clip')
+			total += gathered
+		total *= 1.0 / feature_size
+		z += total
+
+	def backward(self, Dez_above, Dey):
+		feature_size = self.fields.shape[0]
+		Dez_share = self.buffers.get('Dez_share', Dez_above.shape)
+		np.multiply(Dez_above, 1.0 / feature_size, out=Dez_share)
+
+		#no index repeats within a row of fields (see ConvolutionBlock)
+		gathered = self.buffers.get('gathered', Dez_above.shape)
+		for k in range(0, feature_size):
+			np.take(Dey, self.fields[k], axis=0, out=gathered, mode='clip')
+			gathered += Dez_share
+			Dey[self.fields[k]] = gathered
+
+	def add_to_dense(self, W):
+		W[self.fields, np.arange(self.fields.shape[1])[np.newaxis,:]] += 1.0 / self.fields.shape[0]
+
+	def get_flops(self, num_samples):
+		flops = self.fields.size * num_samples
+		return [flops, flops, 0]
+
+
+class MapBiasBlock:
+	"""Bias weights shared by all neurons of each feature map of a convolution layer above"""
+	def __init__(self, bias_index, num_maps, map_size, init_weight, dtype=np.float64, master_dtype=None):
+		self.from_range = [bias_index, bias_index+1]
+		self.to_range = [0, num_maps * map_size]
+		self.num_maps = num_maps
+		self.param = Parameter(get_initial_weights((num_maps, 1), init_weight, dtype), master_dtype)
+		self.buffers = Buffers(dtype)
+
+	def forward(self, y, z):
+		#the bias unit is always 1. the bias is copied into every position first: adding the (maps x 1) W with
+		#broadcasting would go through a scratch buffer on every call
+		z_view = z.reshape(self.num_maps, -1)
+		spread = self.buffers.get('spread', z_view.shape)
+		np.copyto(spread, self.param.W)
+		z_view += spread
+
+	def get_Dew(self, y, Dez_above, Dew=None):
+		result = self.buffers.get('Dew', self.param.W.shape)
+		np.sum(Dez_above.reshape(self.num_maps, -1), axis=1, keepdims=True, out=result)
+		if Dew is None:
+			return result
+		Dew += result
+		return Dew
+
+	def add_to_dense(self, W):
+		map_size = (self.to_range[1] - self.to_range[0]) // self.num_maps
+		W[self.from_range[0]] += np.repeat(self.param.W[:,0], map_size)
+
+	def get_flops(self, num_samples):
+		flops = (self.to_range[1] - self.to_range[0]) * num_samples
+		return [flops, 0, flops]
+
+
+def get_twoD_field_indices(from_rows, from_columns, to_rows, to_columns, feature_rows, feature_columns, stride):
+	"""Returns a (to_rows*to_columns x feature_rows*feature_columns) array. Row k holds the 1D indices of the neurons in one map
+	   of the layer below that neuron k of a map above takes as its feature. 2D layers are laid out in 1D using a column-wise order."""
+	assert((to_rows-1)*stride + feature_rows <= from_rows)
+	assert((to_columns-1)*stride + feature_columns <= from_columns)
+
+	#(i,j) of the layer above sees the feature whose top-left corner is at (i*stride, j*stride) of the layer below
+	to_i, to_j = np.meshgrid(np.arange(to_rows), np.arange(to_columns), indexing='ij')
+	corners = (to_i*stride + to_j*stride*from_rows).ravel(order='F')
+
+	#offsets of the feature's neurons relative to its top-left corner
+	di, dj = np.meshgrid(np.arange(feature_rows), np.arange(feature_columns), indexing='ij')
+	offsets = (di + dj*from_rows).ravel(order='F')
+
+	return corners[:,np.newaxis] + offsets[np.newaxis,:]
+
+
+def get_log_softmax(z):
+	"""log of the softmax of each column of z, computed without taking the log of tiny probabilities"""
+	shifted = z - np.max(z, axis=0)
+	return shifted - np.log( np.sum(np.exp(shifted), axis=0) )
+
+
+def get_target_indices(targets):
+	"""class index of each sample, from one-hot targets (classes x samples) or from indices already"""
+	if targets.ndim == 1:
+		return targets
+	return np.argmax(targets, axis=0)
 
 
 class Layer:
@@ -11,15 +407,19 @@ class Layer:
 	             name,
 	             num_columns,			#number of columns in this layer
 		     num_rows = 1,			#1 for normal layer; can have 2-d layer if layer is convolution/pool/input
-		     layer_type = 'normal',		#implemented: normal, convolution, average_pool, input
-	             neuron_type = 'logistic',		#implemented: logistic, softmax, linear
+		     layer_type = 'normal',		#implemented: normal, convolution, average_pool, input, embedding
+	             neuron_type = 'logistic',		#logistic, tanh, relu, leaky_relu, softplus, linear, softmax (see activations.py)
 		     momentum = 0.9,			#for backprop
 		     learning_rate = 0.00003,		#for backprop
 		     init_weight = 0.01,		#what to initialize weights to
 		     bias = None,
 		     twoD_stride = None,		#2D stride. if layer is convolution/pool (relative to layer below)
-		     twoD_feature_side_length = None,	#if layer is convolution/pool (how many units to a side does each neuron in this layer take?)
-		     twoD_num_maps = 1			#if layer is convolution/pool (number of feature maps in parallel, with dimensions specified above)
+		     twoD_feature_side_length = None,	#if layer is convolution/pool (how many units to a side does each neuron in this layer take? features are 1 unit tall over 1D layers)
+		     twoD_num_maps = 1,			#if layer is convolution/pool (number of feature maps in parallel, with dimensions specified above)
+		     dtype = np.float64,		#precision of weights, activations and gradients (e.g. np.float32 to halve memory traffic)
+		     master_dtype = None,		#if set (e.g. np.float64 with a float32 dtype), weight updates are accumulated in a copy of this precision
+		     optimizer = None,			#update rule for the outgoing weights (see optimizers.py). default: SGD with the momentum above
+		     loss = None			#softmax output layer only: sampled/NCE/hierarchical training (see losses.py). default: full softmax
 		     ):	
 
 		self.name = name
@@ -37,15 +437,26 @@ class Layer:
 		self.learning_rate = learning_rate
 		self.init_weight = init_weight
 		self.bias = bias
+		self.dtype = np.dtype(dtype)
+		self.master_dtype = master_dtype
 
-		#weights W
-		self.W = None
-		
-		#deltaW from previous iteration of backpropagation
-		self.last_deltaW = None
+		#learning_rate is the base rate; the optimizer's schedule (if any) scales it as training goes
+		if optimizer is None:
+			optimizer = SGD(momentum)
+		self.optimizer = optimizer
+
+		#with a loss, the layer below's weights to this layer are trained on a few of this layer's neurons per batch
+		self.loss = loss
+		self.loss_cost = None
+
+		#outgoing connections to the layer above. Each block only stores weights for connections that exist
+		self.connections = []
+
+		#[from_subset, to_subset] of each connect_to_layer call, in order (enough to rebuild the connections)
+		self.connection_specs = []
 
-		#M. captures connectivity between this layer and the next (prevents non-existent weights from being updated)
-		self.weight_mask = None	
+		#weights from the bias unit to the layer above (the bias unit is the extra row of ones at the end of y)
+		self.bias_block = None
 
 		#y = f(z); z is the net input to each neuron
 		self.y = None
@@ -58,6 +469,15 @@ class Layer:
 
 		self.tied_weights = None
 
+		#work arrays (activations, dE/dy, dE/dz, net input to the layer above) reused across batches in buffer-reuse mode
+		self.buffers = Buffers(self.dtype)
+
+		#work arrays for inference. always reused: inference runs on chunks of a fixed size
+		self.inference_buffers = Buffers(self.dtype)
+		self.inference_buffers.set_reuse(True)
+
+		self.compile()
+
 
 	def set_dimensions(self, num_columns, num_rows, layer_type, twoD_num_maps):
 		if self.layer_type == 'normal':
@@ -76,22 +496,26 @@ class Layer:
 	                    from_subset=None,		#range of neurons in this layer (as [start, end) in the 1D-representation; NOT inclusive) 
 			    to_subset=None):		#range of neurons in target layer (as [start, end) in the 1D-representation; NOT inclusive)
 		"""Implements connections from this layer to the layer above.
-		Connectivity is defined using the weight mask matrix (connections with entries = 1; 0 otherwise)
+		Connectivity is defined by a list of connection blocks, each of which only stores the weights that exist.
 		
 		This function can implement connections from/to the following layers:
 		  * normal --> normal. In this case, can use 'from_subset' and 'to_subset' arguments to define full connectivity between
 		    the specified ranges of neurons on this and above layer. If source/target neuron ranges aren't specified, then we'll have
 		    full connectivity between all neurons in these two layers.
 		  * convolution --> average_pool. This will be specified using the dimensions of the two layers, as well as the "feature" dimensions
-		    and twoD stride of the target layer.
-		  * average_pool --> convolution. Same as above
+		    and twoD stride of the target layer. Each pool map averages the same map below, so both layers need the same number of maps.
+		  * average_pool --> convolution. Same as above, except that each convolution map has one shared kernel that sees a feature
+		    in every map below. input --> convolution and convolution --> convolution work the same way.
 		  * convolution --> normal. This will specify full connectivity between all neurons on this layer and the range of neurons
 		    specified on the next layer (i.e. 'to_subset' can be used).
 		  * average_pool --> normal. Same as above.
+		  * embedding --> normal. Same as normal --> normal, but the weights are looked up by index (see EmbeddingBlock), since
+		    the inputs of an embedding layer are the indices of its active (one-hot) neurons.
 		"""
 
 		self.layer_above = layer_above
 		layer_above.layer_below = self
+		self.connection_specs += [[from_subset, to_subset]]
 
 		#get from/to types, dimensions, other data
 		from_layer_type = self.layer_type
@@ -101,8 +525,12 @@ class Layer:
 		to_size = layer_above.num_neurons	#j
 
 		#some error checking
-		if from_layer_type != 'normal' and from_layer_type != 'input':
+		if from_layer_type not in ['normal', 'input', 'embedding']:
 			assert(from_subset is None)
+		if from_layer_type == 'embedding':
+			#the bias unit would need a row of ones in y, which holds indices for an embedding layer
+			assert(layer_above.bias is None)
+			assert(to_layer_type == 'normal')
 		if to_layer_type != 'normal':
 			assert(to_subset is None)
 		if from_subset is not None:
@@ -111,66 +539,150 @@ class Layer:
 		if to_subset is not None:
 			assert(to_subset[0] >= 0)
 			assert(to_subset[1] <= to_size)
-	
-		#define outgoing weight matrix dimensions (i x j)
-		if self.weight_mask is None:
-			self.weight_mask = np.zeros((from_size, to_size))
-
-			#add weights for the bias
-			if self.layer_above is not None and self.layer_above.bias is not None:
-				bias_weights = self.layer_above.bias * np.ones((1,to_size))
-				self.weight_mask = np.concatenate( (self.weight_mask, bias_weights), axis=0 )
 
-
-		#set outgoing weight mask
+		#an output layer with a loss gets one block, bias unit included, that knows how to train on part of the layer
+		if layer_above.loss is not None:
+			assert(layer_above.neuron_type == 'softmax')
+			assert(from_layer_type in ['normal', 'input'])
+			assert(from_subset is None and to_subset is None)
+			assert(len(self.connections) == 0)
+			from_range = [0, from_size + int(layer_above.bias is not None)]
+			self.connections += [layer_above.loss.get_block(from_range, [0, to_size], self.init_weight, layer_above.bias, self.dtype, self.master_dtype)]
+			self.compile()
+			return
+
+		#add weights for the bias (one per feature map for convolution layers, since their kernels are shared)
+		if self.bias_block is None and self.layer_above.bias is not None:
+			assert(to_layer_type != 'average_pool')
+			if to_layer_type == 'convolution':
+				map_size = to_size // layer_above.twoD_num_maps
+				self.bias_block = MapBiasBlock(from_size, layer_above.twoD_num_maps, map_size, self.init_weight * self.layer_above.bias, self.dtype, self.master_dtype)
+			else:
+				self.bias_block = DenseBlock([from_size, from_size+1], [0, to_size], self.init_weight * self.layer_above.bias, self.dtype, self.master_dtype)
+
+		#set outgoing connections
 		if to_layer_type == 'normal':
 			if from_subset is None:
 				from_subset = [0, from_size]
 			if to_subset is None:
 				to_subset = [0, to_size]
 
-			#need to "turn on" the matrix entries where from_subset and to_subset ranges intersect
-			for i in range(from_subset[0], from_subset[1]):
-				for j in range(to_subset[0], to_subset[1]):
-					#print('%d %d' % (i,j))
-					self.weight_mask[i,j] = 1.0
+			#connections are the block where from_subset and to_subset ranges intersect
+			for block in self.connections:
+				overlap_i = from_subset[0] < block.from_range[1] and block.from_range[0] < from_subset[1]
+				overlap_j = to_subset[0] < block.to_range[1] and block.to_range[0] < to_subset[1]
+				assert(not (overlap_i and overlap_j))
+
+			if from_layer_type == 'embedding':
+				self.connections += [EmbeddingBlock(list(from_subset), list(to_subset), self.init_weight, self.dtype, self.master_dtype)]
+			else:
+				self.connections += [DenseBlock(list(from_subset), list(to_subset), self.init_weight, self.dtype, self.master_dtype)]
 
 		elif from_layer_type != 'normal' and to_layer_type != 'normal':
-			#TODO: account for multiple 2d maps in parallel
-			#TODO: shared weights. Can implement another matrix that holds an index for each weight
-			#mapping between 2D layers
-			if from_layer_type == 'input':
-				assert(self.num_rows > 1)
+			#mapping between 1D/2D layers
 			assert(to_layer_type != 'input')
 
 			from_sizei = self.num_rows
 			from_sizej = self.num_columns
+			from_map_size = from_sizei * from_sizej
 
 			to_sizei = self.layer_above.num_rows
 			to_sizej = self.layer_above.num_columns
 			to_f_size = self.layer_above.twoD_feature_side_length
 			to_stride = self.layer_above.twoD_stride
 
-			#iterate column-wise
-			for j in range(0, to_sizej, to_stride):
-				for i in range(0, to_sizei, to_stride):
-					#i and j represent the offset of our feature
-					#map the feature at (i,j) of the layer above
-					for dj in range(0, to_f_size):
-						for di in range(0, to_f_size):
-							#2D layers are laid out in 1D using a column-wise order
-							to_index = i + j*to_sizei
-							from_index = (i+di) + (j+dj)*from_sizei
-							self.weight_mas[from_index, to_index] = 1.0
-
-			#now need to replicate weight mask across all feature maps
-			#ad;lkjasdl;js;aldkjsa;ldkjfsa;lkdfjsa;dlfkj
+			#features over a 1D layer are a single row
+			to_f_rows = to_f_size
+			if from_sizei == 1:
+				to_f_rows = 1
+
+			#row k holds the indices of the neurons (in map 0 below) that neuron k of a map above takes as its feature
+			fields = get_twoD_field_indices(from_sizei, from_sizej, to_sizei, to_sizej, to_f_rows, to_f_size, to_stride)
+
+			if to_layer_type == 'convolution':
+				#every kernel sees the same feature in all maps below
+				fields = np.concatenate( [fields + m*from_map_size for m in range(0, self.twoD_num_maps)], axis=1 )
+				self.connections += [ConvolutionBlock(fields.T, from_size, layer_above.twoD_num_maps, self.init_weight, self.dtype, self.master_dtype)]
+
+			elif to_layer_type == 'average_pool':
+				#map m above averages features of map m below
+				assert(self.twoD_num_maps == layer_above.twoD_num_maps)
+				fields = np.concatenate( [fields + m*from_map_size for m in range(0, self.twoD_num_maps)], axis=0 )
+				self.connections += [PoolBlock(fields.T, from_size, self.dtype)]
+
+			else:
+				print('Cant connect layer type %s to layer type %s' % (from_layer_type, to_layer_type))
+				sys.exit()
+
 		else:
 			print('Cant connect layer type %s to layer type %s' % (from_layer_type, to_layer_type))
 			sys.exit()
 
-		#self.W = self.init_weight * self.weight_mask
-		self.W = self.init_weight * np.random.rand(self.weight_mask.shape[0], self.weight_mask.shape[1]) * self.weight_mask
+		self.compile()
+
+
+	def compile(self):
+		"""Resolves everything that doesn't change from batch to batch: the connection blocks, whether a bias unit is
+		   added to y, and the kernels for this layer's neuron type. Called whenever the connections change."""
+		self.blocks = self.get_blocks()
+		self.trainable_blocks = self.get_trainable_blocks()
+		self.params = self.get_params()
+		self.has_bias = self.layer_above is not None and self.layer_above.bias is not None
+
+		self.activation = get_activation(self.neuron_type)
+
+
+	def get_config(self):
+		"""the constructor arguments of this layer (JSON-friendly), e.g. for checkpoints"""
+		master_dtype = None
+		if self.master_dtype is not None:
+			master_dtype = np.dtype(self.master_dtype).str
+		return {'name': self.name, 'num_columns': self.num_columns, 'num_rows': self.num_rows,
+		        'layer_type': self.layer_type, 'neuron_type': self.neuron_type, 'momentum': self.momentum,
+		        'learning_rate': self.learning_rate, 'init_weight': self.init_weight, 'bias': self.bias,
+		        'twoD_stride': self.twoD_stride, 'twoD_feature_side_length': self.twoD_feature_side_length,
+		        'twoD_num_maps': self.twoD_num_maps, 'dtype': self.dtype.str, 'master_dtype': master_dtype}
+
+
+	def get_blocks(self):
+		"""all outgoing connection blocks, including the bias weights"""
+		if self.bias_block is not None:
+			return self.connections + [self.bias_block]
+		return self.connections
+
+
+	def set_buffer_reuse(self, reuse=True):
+		"""In buffer-reuse mode, this layer and its connection blocks keep their activation, gradient and bias-augmented
+		   arrays between batches and write into them in place, so batches of an unchanged size allocate nothing.
+		   Arrays handed out (y, Dez, the returned z) are overwritten by the next batch. Call after connecting layers."""
+		self.buffers.set_reuse(reuse)
+		for block in self.get_blocks():
+			block.buffers.set_reuse(reuse)
+
+
+	def get_trainable_blocks(self):
+		"""outgoing connection blocks that have weights to learn"""
+		return [block for block in self.get_blocks() if block.param is not None]
+
+
+	def get_params(self):
+		"""the parameters of the outgoing connections, each once (tied blocks share one)"""
+		params = []
+		for block in self.get_trainable_blocks():
+			if not any(param is block.param for param in params):
+				params += [block.param]
+		return params
+
+
+	def get_dense_W(self):
+		"""returns the outgoing weights as a dense (i x j) matrix, with the bias weights as the last row (for inspection/export)"""
+		num_rows = self.num_neurons
+		if self.bias_block is not None:
+			num_rows += 1
+		W = np.zeros( (num_rows, self.layer_above.num_neurons), self.dtype )
+		for block in self.get_blocks():
+			block.add_to_dense(W)
+		return W
 
 
 	def tie_weights_in_range(self, ranges_to_connect):
@@ -180,38 +692,52 @@ class Layer:
 		   each ranges_k defines a sub-matrix in the weight matrix W, and each should be of the same dimension.
 		   Element (i,j) in sub-matrix k will be tied to elements (i,j) in all other sub-matrices forall k.
 
-		   This information is used during backpropagation.
+		   The blocks of all sub-matrices then share the parameter of sub-matrix 0: its weights are stored once, and the
+		   gradients of all of them are added into it.
 		"""
 
 		self.tied_weights = ranges_to_connect
 
+		blocks = self.get_trainable_blocks()
+		first = blocks[self.get_block_index(ranges_to_connect[0])]
+		for ranges in ranges_to_connect[1:]:
+			block = blocks[self.get_block_index(ranges)]
+			assert(block.param.W.shape == first.param.W.shape)
+			block.param = first.param
+
+		self.compile()
+
 	
 	###############################
 	######## COST FUNCTION ########
 	###############################
 
 	def get_cost(self, target_outputs):
-		"""Returns cross-entropy cost for softmax layer"""
+		"""Returns cross-entropy cost for softmax layer. target_outputs can be one-hot or class indices"""
 		assert(self.neuron_type == 'softmax')
-		assert(self.y.shape == target_outputs.shape)
+		if self.loss is not None:
+			#the training cost of the last batch (e.g. over the sampled words only). Network.evaluate gives the real one
+			return self.loss_cost
+		if target_outputs.ndim == 1:
+			assert(target_outputs.shape[0] == self.y.shape[1])
+		else:
+			assert(self.y.shape == target_outputs.shape)
 
 		result = None
 
 		if self.z_below is not None:
-			self.y = self.get_y(z_below=self.z_below)
-
-			#print(target_outputs.T.shape)
-			#print(self.y.shape)
-			#print(np.log(self.y))
-			small_num = math.e ** -20.0
-			cost_at_each_sample = -1.0 * (target_outputs.T).dot( np.log(self.y + small_num) )
-			cost_at_each_sample = cost_at_each_sample.diagonal()	#only want ith output paired with ith target, which is the diagonal of this matrix. not very efficient...
-			#print(cost_at_each_sample)
+			#log(y) straight from z, so that tiny probabilities don't turn into log(0)
+			log_y = get_log_softmax(self.z_below)
+			self.y = np.exp(log_y)
 
-			num_samples = cost_at_each_sample.shape[0]
+			#only the ith output paired with the ith target counts, so an elementwise product is enough
+			num_samples = target_outputs.shape[-1]
 
 			#return average cross-entropy across all samples
-			result = np.sum(cost_at_each_sample) / float(num_samples)
+			if target_outputs.ndim == 1:
+				result = -1.0 * np.sum(log_y[target_outputs, np.arange(num_samples)]) / float(num_samples)
+			else:
+				result = -1.0 * np.sum(target_outputs * log_y) / float(num_samples)
 		return result
 
 
@@ -227,64 +753,101 @@ class Layer:
 	#####################################
 	######## FORWARD PROPAGATION ########
 	#####################################
-	
+
+	def get_input_y(self, input_data, buffers=None):
+		"""y of an input/embedding layer: the input data, plus the bias unit if the layer above has a bias"""
+		if self.layer_type == 'embedding':
+			#input_data holds indices of the active neurons (slots x samples)
+			return input_data
+
+		if self.has_bias:
+			if buffers is None:
+				buffers = self.buffers
+			num_samples = input_data.shape[1]
+			y = buffers.get('y', (self.num_neurons+1, num_samples))
+			y[0:self.num_neurons] = input_data
+			y[self.num_neurons] = 1.0
+			return y
+		return np.asarray(input_data, dtype=self.dtype)
+
+
 	def get_z_to_next_layer(self, z_below=None, input_data=None):
 		"""returns column vector corresponding to net input to next layer above"""
-		result = None
-		if self.layer_type == 'input':
+		if self.layer_type == 'input' or self.layer_type == 'embedding':
 			assert(input_data is not None)
-			#add bias
-			if self.layer_above.bias is not None:
-				num_samples = input_data.shape[1]
-				bias = np.ones( (1,num_samples) )
-				input_data = np.concatenate( (input_data, bias), axis=0 )
-			self.y = input_data
-			result = (self.W.T).dot( input_data )
+			self.y = self.get_input_y(input_data)
 		else:
 			assert(z_below is not None)
 			self.y = self.get_y(z_below)
-			result = (self.W.T).dot( self.y )
+		return self.get_z_from_y(self.y)
+
+
+	def get_z_from_y(self, y, buffers=None):
+		"""net input to the layer above, given this layer's y"""
+		if buffers is None:
+			buffers = self.buffers
+		num_samples = y.shape[1]
+		result = buffers.get('z_above', (self.layer_above.num_neurons, num_samples))
+		result.fill(0.0)
+		for block in self.blocks:
+			block.forward(y, result)
 		return result
 
 
-	def get_y(self, z_below):	#net input from layer below (column vector)
+	def get_y(self, z_below, buffers=None):	#net input from layer below (column vector)
 		"""returns y = f(z) based on the neuron type of this layer"""
+		if buffers is None:
+			buffers = self.buffers
 
-		result = None
-		if self.neuron_type == 'logistic':
-			result = 1 / (1 + ( math.e ** (-z_below) ))
-
-			#add-in the bias that will go to the next layer
-			if self.layer_above.bias is not None:
-				num_samples = result.shape[1]
-				bias = np.ones( (1,num_samples) )
-				result = np.concatenate( (result, bias), axis=0 )
-
-		elif self.neuron_type == 'linear':
-			result = z_below
-			#add-in the bias that will go to the next layer
-			if self.layer_above.bias is not None:
-				num_samples = result.shape[1]
-				bias = np.ones( (1,num_samples) )
-				result = np.concatenate( (result, bias), axis=0 )
-
-
-		elif self.neuron_type == 'softmax':
-			#need to make sure we don't overflow	#XXX check that this is correct!
-			max_z = np.max(z_below)
-			z_below -= max_z
-			result = math.e ** (z_below)
-
-			#normalize. remember that z can be a matrix, with each column representing a different sample
-			for col in range(0, np.shape(result)[1] ):
-				result[:,col] = result[:,col] / np.sum( result[:,col] )
+		#make room for the bias that will go to the next layer
+		num_samples = z_below.shape[1]
+		result = buffers.get('y', (self.num_neurons + int(self.has_bias), num_samples))
+		self.activation.forward(z_below, result[0:self.num_neurons], buffers)
 
-		else:
-			print('Unexpected neuron type %s' % (self.neuron_type))
-			sys.exit()
+		#add-in the bias that will go to the next layer
+		if self.has_bias:
+			result[self.num_neurons] = 1.0
 
 		return result
 
+
+	def forward_input(self, input_data):
+		"""forward step of the bottom layer. returns the net input to the layer above"""
+		self.y = self.get_input_y(input_data)
+		return self.get_z_from_y(self.y)
+
+	def forward_hidden(self, z_below):
+		"""forward step of an intermediate layer. returns the net input to the layer above"""
+		self.z_below = z_below
+		self.y = self.get_y(z_below)
+		return self.get_z_from_y(self.y)
+
+	def infer(self, x):
+		"""Forward step for inference: x is the input data (input/embedding layers) or the net input from below.
+		   Returns the net input to the layer above. Works in inference_buffers and leaves y/z_below (and the
+		   buffers backprop uses) alone, so it can run between training steps"""
+		if self.layer_type == 'input' or self.layer_type == 'embedding':
+			y = self.get_input_y(x, self.inference_buffers)
+		else:
+			y = self.get_y(x, self.inference_buffers)
+		return self.get_z_from_y(y, self.inference_buffers)
+
+	def forward_output(self, z_below):
+		"""forward step of the top layer. returns its y"""
+		self.z_below = z_below
+		self.y = self.get_y(z_below)
+		return self.y
+
+	def forward_to_loss(self, x):
+		"""forward step of the layer below an output layer with a loss: only y, since which of the output neurons
+		   are needed depends on the targets. x is the input data or the net input from below. returns y"""
+		if self.layer_type == 'input':
+			self.y = self.get_input_y(x)
+		else:
+			self.z_below = x
+			self.y = self.get_y(x)
+		return self.y
+
 	def forwardprop_update(self, z_below=None, input_data=None):
 		self.z_below = z_below
 		if self.layer_above:
@@ -306,97 +869,131 @@ class Layer:
 
 		result = None
 		if targets is not None:
-			assert(self.neuron_type == 'softmax')
-			assert(self.y.shape == targets.shape)
-			result = self.y - targets
+			result = self.get_output_Dez(targets)
 
 		elif Dez_above is not None:
-			if self.neuron_type == 'logistic':
-				if self.layer_above.bias is not None:
-					result = self.W[0:-1,:].dot( Dez_above ) * self.y[0:-1,:] * (1- self.y[0:-1,:])
-				else:
-					result = self.W.dot( Dez_above ) * self.y * (1- self.y)
-
-			if self.neuron_type == 'linear':
-				if self.layer_above.bias is not None:
-					result = self.W[0:-1,:].dot( Dez_above )
-				else:
-					result = self.W.dot( Dez_above )
+			result = self.get_hidden_Dez(Dez_above)
 
 		else:
 			print('Not enough arguments provided.')
 			sys.exit()
 
 		return result
+
+	def get_output_Dez(self, targets):
+		"""dE/dz of a softmax output layer under cross-entropy. targets can be one-hot or class indices"""
+		assert(self.neuron_type == 'softmax')
+		result = self.buffers.get('Dez', self.y.shape)
+		if targets.ndim == 1:
+			#y - one_hot(targets), without making the one-hot matrix
+			assert(targets.shape[0] == self.y.shape[1])
+			result[...] = self.y
+			result[targets, np.arange(targets.shape[0])] -= 1.0
+			return result
+		assert(self.y.shape == targets.shape)
+		if not targets.flags['C_CONTIGUOUS']:
+			#e.g. columns picked from an identity matrix. subtracting them directly would go through a scratch buffer
+			np.copyto(result, targets)
+			np.subtract(self.y, result, out=result)
+			return result
+		np.subtract(self.y, targets, out=result)
+		return result
+
+	def get_loss_Dey(self, targets):
+		"""Backward step of an output layer with a loss: gradients of the layer below's outgoing weights from the
+		   neurons the loss picks for this batch, and dE/dy of the layer below (returned). targets can be one-hot or
+		   class indices"""
+		layer_below = self.layer_below
+		block = layer_below.connections[0]
+		y = layer_below.y
+		num_samples = y.shape[1]
+		Dey = layer_below.buffers.get('Dey', (layer_below.num_neurons, num_samples))
+		[cost, Dew, columns] = block.get_loss(y, get_target_indices(targets), Dey)
+		block.param.set_Dew(Dew, columns)
+		self.loss_cost = cost / float(num_samples)
+		return Dey
+
+	def backward_from_loss(self, Dey):
+		"""backward step of the layer below an output layer with a loss (which computed the gradients already).
+		   returns dE/dz"""
+		self.Dez = self.get_Dez_from_Dey(Dey)
+		return self.Dez
+
+	def get_hidden_Dez(self, Dez_above):
+		"""dE/dz of an intermediate layer, through its outgoing connections"""
+		#dE/dy through the outgoing connections (the bias unit has no dE/dz of its own)
+		num_samples = Dez_above.shape[1]
+		Dey = self.buffers.get('Dey', (self.num_neurons, num_samples))
+		Dey.fill(0.0)
+		for block in self.connections:
+			block.backward(Dez_above, Dey)
+		return self.get_Dez_from_Dey(Dey)
+
+	def get_Dez_from_Dey(self, Dey):
+		"""dE/dz = dE/dy * f'(z), from this layer's y"""
+		y = self.y[0:self.num_neurons,:]
+		return self.activation.derivative(y, Dey, self.buffers.get('Dez', Dey.shape))
+
+
+	def get_gradients(self, Dez_above):
+		"""dE/dw of outgoing weights (one sub-matrix per connection block), stored in each block's param.Dew"""
+		#Dew is the average across all samples
+		#blocks sharing a parameter add their gradients into the same Dew
+		num_samples = self.y.shape[1]
+		for param in self.params:
+			param.set_Dew(None)
+		for block in self.trainable_blocks:
+			block.param.Dew = block.get_Dew(self.y, Dez_above, block.param.Dew)
+		for param in self.params:
+			param.Dew /= float(num_samples)
+
+	def backward_hidden(self, Dez_above):
+		"""backward step of an intermediate layer: gradients of its outgoing weights, and its own dE/dz (returned)"""
+		self.get_gradients(Dez_above)
+		self.Dez = self.get_hidden_Dez(Dez_above)
+		return self.Dez
+
+	def update_weights(self):
+		"""applies the gradients in param.Dew to this layer's outgoing weights, using the layer's optimizer"""
+		#only weights of connections that exist are stored, so there is nothing to mask. tied weights are one parameter
+		self.optimizer.update(self.params, self.learning_rate)
+
+
+	def init_optimizer_state(self):
+		"""allocates the optimizer state of all outgoing weights now, instead of at the first update"""
+		for param in self.params:
+			self.optimizer.init_state(param)
+
 	
 	def backprop_update(self, Dez_above=None, targets=None):
 		"""update this layer's weights, and do backpropagation for layer below"""
 		if self.neuron_type == 'softmax':
 			assert(targets is not None)
+			#the sampled/hierarchical losses only train through Network
+			assert(self.loss is None)
 		else:
 			assert(Dez_above is not None)
 
-		#dE/dw of outgoing weights (i x j matrix)
+		#dE/dw of outgoing weights
 		if self.layer_above is not None:
-			#Dew is the average across all samples
-			num_samples = self.y.shape[1]
-			self.Dew = self.y.dot( Dez_above.T ) / float(num_samples)
-
-		#update this layer's weights (pool layer weights are not updated)
-		if 'pool' not in self.layer_type and self.neuron_type != 'softmax':
-			new_deltaW = self.Dew
-			if self.last_deltaW is not None:
-				new_deltaW += self.momentum * self.last_deltaW		#TODO: that's how momentum works, right?
+			self.get_gradients(Dez_above)
 
-			#account for any tied weights
-			if self.tied_weights:
-				new_deltaW = self.adjust_deltaW_for_tied_weights(new_deltaW)
+		#dE/dz for the layer below, through the weights as they were during the forward pass
+		if self.layer_below:
+			self.Dez = self.get_Dez(Dez_above=Dez_above, targets=targets)
 
-			#perform update
-			self.W = (self.W - self.learning_rate * new_deltaW) * self.weight_mask	#weight mask makes sure we don't update weights that shouldn't exist
-			self.last_deltaW = new_deltaW
+		#update this layer's weights (weights into a pool layer are fixed, so their blocks have no parameters)
+		if self.layer_above is not None:
+			self.update_weights()
 
 		#do backprop to next layer below
 		if self.layer_below:
-			self.Dez = self.get_Dez(Dez_above=Dez_above, targets=targets)
 			self.layer_below.backprop_update(Dez_above=self.Dez)
 
-	def adjust_deltaW_for_tied_weights(self, deltaW):
-		"""Looks at self.tied_weights to make sure that updates to tied weights are the same"""
-		assert(self.tied_weights is not None)
-
-		num_submatrices = len(self.tied_weights)
-
-		#add all other submatrices to 0th submatrix
-		for iadd in range(0, num_submatrices):
-			if iadd != 0:
-				from_range_i = self.tied_weights[iadd][0]
-				from_range_j = self.tied_weights[iadd][1]
-
-				to_range_i = self.tied_weights[0][0]
-				to_range_j = self.tied_weights[0][1]
-
-				deltaW[to_range_i[0]:to_range_i[1], to_range_j[0]:to_range_j[1]] += deltaW[from_range_i[0]:from_range_i[1], from_range_j[0]:from_range_j[1]]
-
-		#replicate 0th submatrix to other submatrices
-		for ireplicate in range(0, num_submatrices):
-			if ireplicate != 0:
-				from_range_i = self.tied_weights[0][0]
-				from_range_j = self.tied_weights[0][1]
-
-				to_range_i = self.tied_weights[ireplicate][0]
-				to_range_j = self.tied_weights[ireplicate][1]
-
-				deltaW[to_range_i[0]:to_range_i[1], to_range_j[0]:to_range_j[1]] = deltaW[from_range_i[0]:from_range_i[1], from_range_j[0]:from_range_j[1]]
-
-
-		#finish taking the average (excluding the bias weights row)
-		if self.bias is not None:
-			deltaW[:-1,:] /= num_submatrices
-		else:
-			deltaW /= num_submatrices
-
-		return deltaW
-			
-
-
+	def get_block_index(self, ranges):
+		"""index of the connection block covering ranges = [[from_i, to_i], [from_j, to_j]]"""
+		for iblock, block in enumerate(self.get_trainable_blocks()):
+			if list(block.from_range) == list(ranges[0]) and list(block.to_range) == list(ranges[1]):
+				return iblock
+		print('No connection block for tied range %s' % (str(ranges)))
+		sys.exit()
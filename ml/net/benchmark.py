@@ -0,0 +1,1333 @@
+import io
+import os
+import json
+import time
+import platform
+import tempfile
+import shutil
+import socket
+import hashlib
+import threading
+import http.server
+import tracemalloc
+import contextlib
+from base import *
+from network import Network
+from parallel import ParallelTrainer
+from loader import DataLoader
+from checkpoint import save_network, load_network, AsyncCheckpointer
+from optimizers import *
+from profiler import Profiler
+import simple_words
+
+
+#########################
+######## HELPERS ########
+#########################
+
+#what the benchmarks measured, {benchmark: {case: {metric: value}}}. main() can save it as JSON and compare it
+#against an earlier run
+results = {}
+
+#checks that failed, as messages. main() exits with an error if there are any, after running every benchmark
+failures = []
+
+#with --data-mat, benchmarks that train on simple_words data use data.mat (if it is here) instead of synthetic data
+use_data_mat = False
+
+
+def record(benchmark, case, **metrics):
+	"""keeps what a benchmark measured for case (e.g. seconds=..., cost=...)"""
+	if benchmark not in results:
+		results[benchmark] = {}
+	results[benchmark][case] = metrics
+
+def check(ok, message):
+	"""prints and keeps message as a failure unless ok"""
+	if not ok:
+		print('  FAILED: %s' % message)
+		failures.append(message)
+	return ok
+
+
+def time_it(fn, repeat=3):
+	"""returns the best wall time (in seconds) of fn() over a few runs"""
+	best = None
+	for i in range(0, repeat):
+		start = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def quiet(fn, *args, **kwargs):
+	"""calls fn, discarding anything it prints"""
+	with contextlib.redirect_stdout(io.StringIO()):
+		return fn(*args, **kwargs)
+
+
+def count_weights(net):
+	"""number of stored weights across all layers of a net"""
+	total = 0
+	for layer in net:
+		for param in layer.params:
+			total += param.W.size
+	return total
+
+
+def get_synthetic_word_data(num_words, num_samples, seed=0):
+	"""(num_samples x 4) matrix of 1-based word indices shaped like simple_words' data.mat. The 4th word is a fixed
+	   function of the 3rd most of the time, so there is something to learn"""
+	rand = np.random.RandomState(seed)
+	samples = rand.randint(1, num_words+1, size=(num_samples, 4))
+	next_word = rand.permutation(num_words) + 1
+	follows = rand.rand(num_samples) < 0.7
+	samples[follows, 3] = next_word[samples[follows, 2] - 1]
+	return samples
+
+
+def get_word_data(num_words=250, num_samples=100000):
+	"""[num_words, train_data, validate_data]: synthetic, or from data.mat with --data-mat (if it is here)"""
+	if use_data_mat and os.path.exists('data.mat'):
+		[vocab, train_data, validate_data, test_data] = simple_words.load_data('data.mat')
+		return [len(vocab), train_data, validate_data[0:10000,:]]
+	data = get_synthetic_word_data(num_words, num_samples + 10000)
+	return [num_words, data[0:num_samples], data[num_samples:]]
+
+
+def train_quietly(net, train_data, batch_size, num_words, num_epochs):
+	"""simple_words-style training loop without printing or validation"""
+	dtype = net[-1].dtype
+	num_batches = train_data.shape[0] // batch_size
+	for iepoch in range(0, num_epochs):
+		for ibatch in range(0, num_batches):
+			batch = train_data[ibatch*batch_size : (ibatch+1)*batch_size, :]
+			[inputs, targets] = simple_words.get_index_data(batch.T, num_words, dtype)
+			net.train_batch(inputs, targets)
+
+
+def get_word_cost(net, data, num_words):
+	"""average cross-entropy of the net over data"""
+	[inputs, targets] = simple_words.get_index_data(data.T, num_words, net[-1].dtype)
+	return net.evaluate(inputs, targets)
+
+
+######################################
+######## NETWORK CONSTRUCTION ########
+######################################
+
+def make_twoD_layers(num_rows, num_columns, feature_side_length, stride):
+	"""2D input (e.g. a spectrogram) --> convolution layer --> softmax output"""
+	conv_rows = (num_rows - feature_side_length) // stride + 1
+	conv_columns = (num_columns - feature_side_length) // stride + 1
+
+	input_layer = Layer(name='input', num_columns=num_columns, num_rows=num_rows, layer_type='input', neuron_type='linear')
+	conv_layer = Layer(name='conv', num_columns=conv_columns, num_rows=conv_rows, layer_type='convolution',
+	                   twoD_stride=stride, twoD_feature_side_length=feature_side_length)
+	output_layer = Layer(name='output', num_columns=10, neuron_type='softmax', bias=1.0)
+
+	input_layer.connect_to_layer(conv_layer)
+	conv_layer.connect_to_layer(output_layer)
+	return Network([input_layer, conv_layer, output_layer])
+
+
+def bench_construction():
+	"""time to build and connect nets of realistic sizes"""
+	print('%-40s %12s %12s' % ('net', 'weights', 'seconds'))
+
+	for num_words in [250, 1000, 5000]:
+		for tie_embeddings in [False, True]:
+			net = quiet(simple_words.make_layers, num_words, tie_embeddings=tie_embeddings)
+			seconds = time_it(lambda: quiet(simple_words.make_layers, num_words, tie_embeddings=tie_embeddings))
+			name = 'simple_words vocab=%d%s' % (num_words, ' tied' if tie_embeddings else '')
+			print('%-40s %12d %12.4f' % (name, count_weights(net), seconds))
+			record('construction', name, weights=count_weights(net), seconds=seconds)
+
+	for (num_rows, num_columns, feature_side_length, stride) in [(32, 64, 5, 1), (64, 128, 5, 1), (128, 256, 8, 2)]:
+		net = make_twoD_layers(num_rows, num_columns, feature_side_length, stride)
+		seconds = time_it(lambda: make_twoD_layers(num_rows, num_columns, feature_side_length, stride))
+		name = '2D %dx%d feature=%d stride=%d' % (num_rows, num_columns, feature_side_length, stride)
+		print('%-40s %12d %12.4f' % (name, count_weights(net), seconds))
+		record('construction', name, weights=count_weights(net), seconds=seconds)
+
+
+
+##########################
+######## ENCODING ########
+##########################
+
+def bench_one_hot():
+	"""encoding 3-word contexts as dense one-hot inputs (get_one_hot) and as embedding indices (get_index_data)"""
+	print('%-40s %12s %12s' % ('encoding', 'one-hot (s)', 'indices (s)'))
+	for num_words in [250, 5000]:
+		for batch_size in [100, 10000]:
+			samples = get_synthetic_word_data(num_words, batch_size).T
+			one_hot_seconds = time_it(lambda: simple_words.get_one_hot(samples[0:-1], num_words))
+			index_seconds = time_it(lambda: simple_words.get_index_data(samples, num_words))
+			name = 'vocab=%d batch=%d' % (num_words, batch_size)
+			print('%-40s %12.5f %12.5f' % (name, one_hot_seconds, index_seconds))
+			record('one_hot', name, one_hot_seconds=one_hot_seconds, index_seconds=index_seconds)
+
+
+
+####################################
+######## CONVOLUTION / POOL ########
+####################################
+
+def make_beat_layers(window_size, num_classes):
+	"""1D CNN shaped for MIT-BIH beat windows: conv --> average_pool --> conv --> softmax"""
+	conv1_size = window_size - 7 + 1
+	pool_size = (conv1_size - 2) // 2 + 1
+	conv2_size = pool_size - 5 + 1
+
+	input_layer = Layer(name='input', num_columns=window_size, layer_type='input', neuron_type='linear')
+	conv1 = Layer(name='conv1', num_columns=conv1_size, layer_type='convolution', twoD_stride=1, twoD_feature_side_length=7, twoD_num_maps=8, bias=1.0)
+	pool = Layer(name='pool', num_columns=pool_size, layer_type='average_pool', neuron_type='linear', twoD_stride=2, twoD_feature_side_length=2, twoD_num_maps=8)
+	conv2 = Layer(name='conv2', num_columns=conv2_size, layer_type='convolution', twoD_stride=1, twoD_feature_side_length=5, twoD_num_maps=16, bias=1.0)
+	output_layer = Layer(name='output', num_columns=num_classes, neuron_type='softmax', bias=1.0)
+
+	layers = [input_layer, conv1, pool, conv2, output_layer]
+	for (layer, layer_above) in zip(layers[0:-1], layers[1:]):
+		layer.connect_to_layer(layer_above)
+	return Network(layers)
+
+
+def bench_convolution():
+	"""forward + backward step of a 1D CNN on beat-sized windows"""
+	print('%-40s %12s %12s %12s' % ('net', 'weights', 'dense equiv', 'seconds'))
+	for (window_size, batch_size) in [(256, 100), (256, 1000), (1024, 100)]:
+		net = make_beat_layers(window_size, 5)
+		dense_equivalent = sum([layer.num_neurons * layer.layer_above.num_neurons for layer in net[0:-1]])
+
+		inputs = np.random.rand(window_size, batch_size)
+		targets = np.eye(5)[:, np.random.randint(0, 5, batch_size)]
+		seconds = time_it(lambda: net.train_batch(inputs, targets))
+
+		name = 'beat cnn window=%d batch=%d' % (window_size, batch_size)
+		print('%-40s %12d %12d %12.4f' % (name, count_weights(net), dense_equivalent, seconds))
+		record('convolution', name, seconds=seconds)
+
+
+
+##############################
+######## SOFTMAX/COST ########
+##############################
+
+def reference_softmax_cost(z, targets):
+	"""the previous implementation: per-column normalization loop, and the diagonal of a (batch x batch) matrix"""
+	y = math.e ** (z - np.max(z))
+	for col in range(0, np.shape(y)[1] ):
+		y[:,col] = y[:,col] / np.sum( y[:,col] )
+	cost_at_each_sample = -1.0 * (targets.T).dot( np.log(y + math.e ** -20.0) )
+	return np.sum(cost_at_each_sample.diagonal()) / float(z.shape[1])
+
+
+def bench_softmax():
+	"""softmax + cross-entropy of an output layer, at batch sizes 100 to 10k"""
+	num_classes = 250
+	output_layer = Layer(name='output', num_columns=num_classes, neuron_type='softmax')
+
+	print('%-30s %12s %12s %12s' % ('batch', 'new (s)', 'old (s)', 'cost diff'))
+	for batch_size in [100, 1000, 10000]:
+		z = np.random.randn(num_classes, batch_size)
+		targets = np.eye(num_classes)[:, np.random.randint(0, num_classes, batch_size)]
+
+		def new():
+			output_layer.z_below = z
+			output_layer.y = targets
+			return output_layer.get_cost(targets)
+		new_seconds = time_it(new)
+
+		#the old (batch x batch) matrix needs 800MB at a batch of 10k
+		if batch_size <= 2000:
+			old_seconds = '%12.5f' % time_it(lambda: reference_softmax_cost(z.copy(), targets))
+			diff = '%12.2e' % abs(new() - reference_softmax_cost(z.copy(), targets))
+		else:
+			old_seconds = '%12s' % 'skipped'
+			diff = '%12s' % '-'
+		print('%-30d %12.5f %s %s' % (batch_size, new_seconds, old_seconds, diff))
+		record('softmax', 'batch=%d' % batch_size, seconds=new_seconds)
+
+
+
+#############################
+######## ACTIVATIONS ########
+#############################
+
+def reference_logistic(z, Dey):
+	"""the original logistic layer: y and dE/dz with a temporary per operation (and overflow warnings for large -z)"""
+	y = 1 / (1 + ( math.e ** (-z) ))
+	return [y, Dey * y * (1 - y)]
+
+
+def bench_activations():
+	"""y = f(z) and dE/dz of every activation in place, on (neurons x batch) arrays, and the original logistic"""
+	shape = (1024, 1000)
+	z = np.random.randn(*shape) * 4.0
+	Dey = np.random.randn(*shape)
+	y = np.empty(shape)
+	Dez = np.empty(shape)
+	buffers = Buffers()
+	buffers.reuse = True
+
+	print('%-30s %14s %14s' % ('activation 1024x1000', 'forward (ms)', 'dE/dz (ms)'))
+	with np.errstate(over='ignore'):
+		[old_y, old_Dez] = reference_logistic(z, Dey)
+		seconds = time_it(lambda: reference_logistic(z, Dey))
+	print('%-30s %29.3f' % ('logistic (original)', seconds * 1e3))
+	record('activations', 'logistic (original)', seconds=seconds)
+
+	for (name, activation) in activations.items():
+		forward_seconds = time_it(lambda: activation.forward(z, y, buffers))
+		derivative_seconds = None
+		if name != 'softmax':
+			derivative_seconds = time_it(lambda: activation.derivative(y, Dey, Dez))
+		print('%-30s %14.3f %14s' % (name, forward_seconds * 1e3, '%.3f' % (derivative_seconds * 1e3) if derivative_seconds is not None else '-'))
+		record('activations', name, forward_seconds=forward_seconds, derivative_seconds=derivative_seconds)
+
+	activations['logistic'].forward(z, y, buffers)
+	activations['logistic'].derivative(y, Dey, Dez)
+	print('logistic vs original, max difference: y %.2e, dE/dz %.2e' % (np.max(np.abs(y - old_y)), np.max(np.abs(Dez - old_Dez))))
+
+
+
+##########################################
+######## FORWARD / BACKWARD PASSES #######
+##########################################
+
+def make_dense_layers(num_inputs, width, num_classes=10):
+	"""input --> two fully connected logistic layers of width neurons --> softmax output"""
+	input_layer = Layer(name='input', num_columns=num_inputs, layer_type='input', neuron_type='linear')
+	hidden1 = Layer(name='hidden1', num_columns=width, bias=1.0)
+	hidden2 = Layer(name='hidden2', num_columns=width, bias=1.0)
+	output_layer = Layer(name='output', num_columns=num_classes, neuron_type='softmax', bias=1.0)
+
+	layers = [input_layer, hidden1, hidden2, output_layer]
+	for (layer, layer_above) in zip(layers[0:-1], layers[1:]):
+		layer.connect_to_layer(layer_above)
+	return Network(layers)
+
+
+def bench_passes():
+	"""forward, backward and update of a dense net separately, at several layer widths and batch sizes"""
+	num_inputs = 256
+	print('%-40s %12s %12s %12s' % ('net', 'forward (s)', 'backward', 'update'))
+	for width in [64, 256, 1024]:
+		net = quiet(make_dense_layers, num_inputs, width)
+		net.set_buffer_reuse(True)
+		for batch_size in [1, 100, 1000]:
+			inputs = np.random.rand(num_inputs, batch_size)
+			targets = np.eye(10)[:, np.random.randint(0, 10, batch_size)]
+
+			#backward needs the forward pass of the same batch, and update the gradients
+			forward_seconds = time_it(lambda: net.forward(inputs))
+			backward_seconds = time_it(lambda: net.backward(targets))
+			update_seconds = time_it(net.update)
+
+			name = 'dense width=%d batch=%d' % (width, batch_size)
+			print('%-40s %12.5f %12.5f %12.5f' % (name, forward_seconds, backward_seconds, update_seconds))
+			record('passes', name, forward_seconds=forward_seconds, backward_seconds=backward_seconds, update_seconds=update_seconds)
+
+
+
+#################################
+######## BUFFER REUSE ###########
+#################################
+
+def get_step_allocations(net, inputs, targets, num_batches=20):
+	"""largest amount of memory (bytes) a training step allocates on top of what is already allocated, once warmed up"""
+	for i in range(0, 3):
+		net.train_batch(inputs, targets)
+
+	tracemalloc.start()
+	worst = 0
+	for i in range(0, num_batches):
+		before = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		net.train_batch(inputs, targets)
+		worst = max(worst, tracemalloc.get_traced_memory()[1] - before)
+	tracemalloc.stop()
+	return worst
+
+
+def bench_allocations():
+	"""per-batch allocations of a training step with and without buffer reuse, at three batch sizes.
+	   With reuse, what a step allocates must not grow with the batch size (a little slack for Python objects whose
+	   size depends on the values involved), and stay under max_allocated bytes. What is left is fixed-size:
+	   np.add.at's and fancy indexing's own bookkeeping, and Python objects"""
+	num_words = 1000
+	max_allocated = 16384
+	slack = 1024
+
+	print('%-30s %16s %16s' % ('net', 'no reuse (B)', 'reuse (B)'))
+	for name in ['simple_words', 'beat cnn']:
+		reuse_allocated = []
+		for batch_size in [10, 100, 1000]:
+			if name == 'simple_words':
+				samples = np.random.randint(1, num_words+1, size=(4, batch_size))
+				[inputs, targets] = simple_words.get_index_data(samples, num_words)
+			else:
+				inputs = np.random.rand(256, batch_size)
+				targets = np.eye(5)[:, np.random.randint(0, 5, batch_size)]
+
+			allocated = []
+			for reuse in [False, True]:
+				if name == 'simple_words':
+					net = quiet(simple_words.make_layers, num_words)
+				else:
+					net = make_beat_layers(256, 5)
+				net.set_buffer_reuse(reuse)
+				allocated += [get_step_allocations(net, inputs, targets)]
+
+			case = '%s batch=%d' % (name, batch_size)
+			print('%-30s %16d %16d' % (case, allocated[0], allocated[1]))
+			record('allocations', case, bytes=allocated[0], reuse_bytes=allocated[1])
+			check(allocated[1] <= max_allocated, '%s allocates %d bytes per step with buffer reuse on (at most %d allowed)' % (case, allocated[1], max_allocated))
+			reuse_allocated += [allocated[1]]
+
+		check(max(reuse_allocated) <= reuse_allocated[0] + slack, '%s: per-step allocations grow with the batch size with buffer reuse on: %s' % (name, reuse_allocated))
+
+
+###########################
+######## PRECISION ########
+###########################
+
+def bench_precision():
+	"""simple_words convergence and training time in float64, float32, and float32 with float64 master weights.
+	   The float32 runs must end within tolerance (relative) of the float64 train and validation costs. They train
+	   with Adam, since SGD at simple_words' learning rate barely moves the cost of the synthetic data in 3 epochs
+	   (see bench_convergence), which would make the comparison meaningless"""
+	[num_words, train_data, validate_data] = get_word_data()
+	num_epochs = 3
+	tolerance = 0.002
+
+	print('%-36s %14s %14s %12s %12s' % ('precision', 'train cost', 'valid cost', 'vs float64', 'seconds'))
+	reference = None
+	for (name, dtype, master_dtype) in [('float64', np.float64, None), ('float32', np.float32, None), ('float32 + float64 master', np.float32, np.float64)]:
+		np.random.seed(0)
+		net = quiet(simple_words.make_layers, num_words, dtype=dtype, master_dtype=master_dtype, optimizer=Adam(), learning_rate=0.001)
+		net.set_buffer_reuse(True)
+
+		start = time.perf_counter()
+		train_quietly(net, train_data, 100, num_words, num_epochs)
+		seconds = time.perf_counter() - start
+
+		train_cost = get_word_cost(net, train_data[0:10000], num_words)
+		valid_cost = get_word_cost(net, validate_data, num_words)
+		if reference is None:
+			reference = [train_cost, valid_cost]
+		#largest relative difference from the float64 costs
+		difference = max(abs(train_cost - reference[0]) / reference[0], abs(valid_cost - reference[1]) / reference[1])
+		print('%-36s %14.6f %14.6f %12.2e %12.3f' % (name, train_cost, valid_cost, difference, seconds))
+		record('precision', name, train_cost=train_cost, valid_cost=valid_cost, seconds=seconds)
+		check(difference <= tolerance, '%s costs differ from float64 by %.2e (at most %.2e allowed)' % (name, difference, tolerance))
+
+
+
+#########################
+######## TRAINING #######
+#########################
+
+def bench_training(num_batches=500):
+	"""a short simple_words run: num_batches batches of 100 (encoding included), and the validation cost after it"""
+	[num_words, train_data, validate_data] = get_word_data()
+	batch_size = 100
+	net = quiet(simple_words.make_layers, num_words)
+	net.set_buffer_reuse(True)
+
+	start = time.perf_counter()
+	train_quietly(net, train_data[0:num_batches*batch_size], batch_size, num_words, 1)
+	seconds = time.perf_counter() - start
+	valid_cost = get_word_cost(net, validate_data, num_words)
+
+	name = 'simple_words vocab=%d %d batches' % (num_words, num_batches)
+	print('%-36s %12s %14s %12s' % ('run', 'seconds', 'samples/s', 'valid cost'))
+	print('%-36s %12.3f %14.0f %12.6f' % (name, seconds, num_batches * batch_size / seconds, valid_cost))
+	record('training', name, seconds=seconds, samples_per_second=num_batches * batch_size / seconds, valid_cost=valid_cost)
+
+
+###########################
+######## ACCUMULATION #####
+###########################
+
+def bench_accumulation():
+	"""one gradient step on a 10k-sample simple_words batch, all at once and in micro-batches with accumulated
+	   gradients. 'peak MB' is the most memory the first step allocates at once (the reused activation and gradient
+	   buffers are allocated then)"""
+	num_words = 1000
+	batch_size = 10000
+	samples = np.random.randint(1, num_words+1, size=(4, batch_size))
+	[inputs, targets] = simple_words.get_index_data(samples, num_words)
+
+	print('%-36s %12s %12s' % ('step', 'seconds', 'peak MB'))
+	for micro_batch_size in [None, 2000, 500, 100]:
+		net = quiet(simple_words.make_layers, num_words)
+		net.set_buffer_reuse(True)
+		step = lambda: net.train_batch(inputs, targets, micro_batch_size)
+		tracemalloc.start()
+		step()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		seconds = time_it(step)
+
+		name = 'batch=%d' % batch_size
+		if micro_batch_size is not None:
+			name += ' micro-batch=%d' % micro_batch_size
+		print('%-36s %12.4f %12.1f' % (name, seconds, peak / 1e6))
+		record('accumulation', name, seconds=seconds, peak_bytes=peak)
+
+
+#############################
+######## LARGE VOCAB ########
+#############################
+
+def bench_large_vocab(num_batches=100):
+	"""simple_words training at growing vocabulary sizes with the full softmax and with sampled softmax, NCE and
+	   hierarchical softmax outputs: time per batch of 100, and the exact validation cost after num_batches batches.
+	   The next word is random 30% of the time, and most words are seen once or never in num_batches batches, so
+	   no output gets far below log vocab here; the sampled/hierarchical ones must end within margin of it. Their
+	   time per batch grows with the vocabulary through the input embeddings only (3 x vocab x 50, dense)"""
+	from losses import SampledSoftmax, NCE, HierarchicalSoftmax
+	batch_size = 100
+	margin = 0.5
+
+	print('%-40s %12s %12s' % ('output', 'ms/batch', 'valid cost'))
+	for num_words in [1000, 10000, 50000]:
+		data = get_synthetic_word_data(num_words, num_batches * batch_size + 2000)
+		train_data = data[0:num_batches * batch_size]
+		#word counts of a corpus covering the vocabulary, as a real one would (see HierarchicalSoftmax)
+		counts = simple_words.get_word_counts(get_synthetic_word_data(num_words, 10 * num_words, seed=1), num_words)
+		[valid_inputs, valid_targets] = simple_words.get_index_data(data[num_batches * batch_size:].T, num_words, target_indices=True)
+
+		for (name, loss) in [('softmax', None), ('sampled softmax k=64', SampledSoftmax(64, counts)),
+		                     ('NCE k=64', NCE(64, counts)), ('hierarchical softmax', HierarchicalSoftmax(counts))]:
+			np.random.seed(0)
+			net = quiet(simple_words.make_layers, num_words, loss=loss)
+			net.set_buffer_reuse(True)
+
+			#encoding counts: the full softmax needs one-hot targets, the others the target indices only
+			start = time.perf_counter()
+			for ibatch in range(0, num_batches):
+				batch = train_data[ibatch*batch_size : (ibatch+1)*batch_size]
+				[inputs, targets] = simple_words.get_index_data(batch.T, num_words, target_indices=loss is not None)
+				net.train_batch(inputs, targets)
+			seconds = (time.perf_counter() - start) / num_batches
+			#small chunks: a chunk's (vocab x chunk) net input, and its temporaries, get big at vocab=50000
+			valid_cost = net.evaluate(valid_inputs, valid_targets, chunk_size=256)
+
+			case = '%s vocab=%d' % (name, num_words)
+			print('%-40s %12.2f %12.4f' % (case, seconds * 1e3, valid_cost))
+			record('large_vocab', case, seconds=seconds, valid_cost=valid_cost)
+			if loss is not None:
+				check(valid_cost <= np.log(num_words) + margin, '%s: validation cost %.4f, more than log vocab (%.4f) + %g' % (case, valid_cost, np.log(num_words), margin))
+
+
+
+##########################
+######## DISPATCH ########
+##########################
+
+def bench_dispatch():
+	"""training steps per second on small nets and batches, through the compiled plan (Network.train_batch)
+	   and through the recursive forwardprop_update/backprop_update calls. Expect them to be about even: both run
+	   the same kernels, and walking the layers is a handful of Python calls per step. What a small step spends
+	   outside of the math is in the kernels (e.g. the embedding blocks' index range checks), not in dispatch"""
+	num_words = 250
+	num_steps = 200
+
+	print('%-36s %14s %14s' % ('net', 'plan (step/s)', 'recursive'))
+	for batch_size in [1, 10, 100]:
+		samples = np.random.randint(1, num_words+1, size=(4, batch_size))
+		[inputs, targets] = simple_words.get_index_data(samples, num_words)
+		net = quiet(simple_words.make_layers, num_words)
+		net.set_buffer_reuse(True)
+
+		def plan():
+			for i in range(0, num_steps):
+				net.train_batch(inputs, targets)
+		def recursive():
+			for i in range(0, num_steps):
+				net[0].forwardprop_update(input_data = inputs)
+				net[-1].backprop_update(targets = targets)
+
+		plan_rate = num_steps / time_it(plan)
+		recursive_rate = num_steps / time_it(recursive)
+		print('%-36s %14.0f %14.0f' % ('simple_words batch=%d' % batch_size, plan_rate, recursive_rate))
+		record('dispatch', 'simple_words batch=%d' % batch_size, steps_per_second=plan_rate, recursive_steps_per_second=recursive_rate)
+
+
+
+########################
+######## LOADER ########
+########################
+
+def bench_loader(io_seconds=0.002):
+	"""one epoch of simple_words training with batches encoded in the loop, through a DataLoader without
+	   prefetching, and through a prefetching DataLoader. 'waiting' is the time the loop spent getting batches.
+
+	   simple_words' encoding is cheap, and prefetching gains nothing on it. The 'slow' runs add io_seconds
+	   per batch to the encoding, like reading batches from disk would (a sleep, which releases the GIL the
+	   same way): that is what prefetching hides"""
+	[num_words, train_data, validate_data] = get_word_data()
+	dtype = np.float64
+
+	def encode(samples, out):
+		return simple_words.get_index_data(samples, num_words, dtype, out)
+
+	def slow_encode(samples, out):
+		time.sleep(io_seconds)
+		return encode(samples, out)
+
+	print('%-36s %12s %12s' % ('batches', 'seconds', 'waiting'))
+	for (kind, batch_encode) in [('', encode), ('slow ', slow_encode)]:
+		for batch_size in [100, 1000]:
+			def get_inline_batches():
+				for start in range(0, train_data.shape[0], batch_size):
+					yield batch_encode(train_data[start:start+batch_size].T, None)
+
+			loader = DataLoader(train_data, batch_size, batch_encode, num_prefetch=0, seed=0)
+			prefetch_loader = DataLoader(train_data, batch_size, batch_encode, seed=0)
+			for (name, get_batches) in [('inline', get_inline_batches), ('loader', lambda: iter(loader)), ('prefetch', lambda: iter(prefetch_loader))]:
+				net = quiet(simple_words.make_layers, num_words)
+				net.set_buffer_reuse(True)
+
+				waiting = 0.0
+				start = time.perf_counter()
+				batches = get_batches()
+				while True:
+					before = time.perf_counter()
+					batch = next(batches, None)
+					waiting += time.perf_counter() - before
+					if batch is None:
+						break
+					net.train_batch(batch[0], batch[1])
+				seconds = time.perf_counter() - start
+				case = '%s%s batch=%d' % (kind, name, batch_size)
+				print('%-36s %12.3f %12.3f' % (case, seconds, waiting))
+				record('loader', case, seconds=seconds, waiting=waiting)
+
+
+
+###########################
+######## INFERENCE ########
+###########################
+
+def bench_inference():
+	"""scoring 3-word contexts: forward pass of everything + per-sample argmax loop (the old way), against chunked
+	   predict/top_k. 'peak MB' is the most memory allocated at once while scoring"""
+	num_words = 1000
+	net = quiet(simple_words.make_layers, num_words)
+
+	def old_way(contexts):
+		net[0].forwardprop_update(input_data = simple_words.get_one_hot_indices(contexts, num_words))
+		return simple_words.get_output_words(net[-1])
+
+	print('%-36s %12s %12s' % ('method', 'seconds', 'peak MB'))
+	for num_samples in [10000, 100000]:
+		contexts = np.random.randint(1, num_words+1, size=(3, num_samples))
+		methods = [('predict', lambda: simple_words.predict_words(net, contexts, num_words)),
+		           ('top_k k=10', lambda: simple_words.predict_words(net, contexts, num_words, k=10))]
+		if num_samples <= 10000:
+			methods = [('forwardprop + argmax loop', lambda: old_way(contexts))] + methods
+
+		for (name, method) in methods:
+			seconds = time_it(method, repeat=2)
+			tracemalloc.start()
+			method()
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			print('%-36s %12.3f %12.1f' % ('%s n=%d' % (name, num_samples), seconds, peak / 1e6))
+			record('inference', '%s n=%d' % (name, num_samples), seconds=seconds, peak_bytes=peak)
+
+
+
+############################
+######## VALIDATION ########
+############################
+
+def bench_validation():
+	"""validation cost of a simple_words net on 10k samples: a full training forward pass + get_cost (the old way)
+	   against chunked evaluation on the inference path"""
+	num_words = 1000
+	num_samples = 10000
+	net = quiet(simple_words.make_layers, num_words)
+	net.set_buffer_reuse(True)
+	samples = np.random.randint(1, num_words+1, size=(4, num_samples))
+	[inputs, targets] = simple_words.get_index_data(samples, num_words)
+
+	def old_way():
+		net.forward(inputs)
+		return net.get_cost(targets)
+
+	print('%-36s %12s %12s %12s' % ('method', 'seconds', 'peak MB', 'cost'))
+	for (name, method) in [('forward + get_cost', old_way), ('evaluate chunk=1024', lambda: net.evaluate(inputs, targets)),
+	                       ('evaluate chunk=256', lambda: net.evaluate(inputs, targets, 256))]:
+		seconds = time_it(method)
+		tracemalloc.start()
+		cost = method()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print('%-36s %12.4f %12.1f %12.6f' % (name, seconds, peak / 1e6, cost))
+		record('validation', name, seconds=seconds, peak_bytes=peak, cost=cost)
+
+
+
+############################
+######## CHECKPOINTS #######
+############################
+
+def bench_checkpoint():
+	"""saving a simple_words net as tab-separated text vs a binary checkpoint, loading it (read vs memory-mapped),
+	   and how long a background checkpoint holds up the training loop"""
+	num_words = 5000
+	net = quiet(simple_words.make_layers, num_words)
+	samples = np.random.randint(1, num_words+1, size=(4, 100))
+	[inputs, targets] = simple_words.get_index_data(samples, num_words)
+	net.train_batch(inputs, targets)
+
+	directory = tempfile.mkdtemp()
+	text_path = os.path.join(directory, 'embed.csv')
+	path = os.path.join(directory, 'net.ckpt')
+
+	print('%-36s %12s %12s' % ('operation', 'seconds', 'MB'))
+	seconds = time_it(lambda: [np.savetxt(text_path, layer.get_dense_W(), delimiter='\t') for layer in net[0:-1]], repeat=1)
+	print('%-36s %12.3f %12s' % ('savetxt (W only)', seconds, '-'))
+	record('checkpoint', 'savetxt (W only)', seconds=seconds)
+	seconds = time_it(lambda: save_network(net, path))
+	print('%-36s %12.3f %12.1f' % ('save_network', seconds, os.path.getsize(path) / 1e6))
+	record('checkpoint', 'save_network', seconds=seconds, bytes=os.path.getsize(path))
+	seconds = time_it(lambda: load_network(path))
+	print('%-36s %12.3f %12s' % ('load_network', seconds, '-'))
+	record('checkpoint', 'load_network', seconds=seconds)
+	seconds = time_it(lambda: load_network(path, mmap_mode='r'))
+	print('%-36s %12.3f %12s' % ('load_network mmap', seconds, '-'))
+	record('checkpoint', 'load_network mmap', seconds=seconds)
+
+	#time save() alone, with the previous write already finished
+	checkpointer = AsyncCheckpointer(path)
+	seconds = None
+	for i in range(0, 3):
+		checkpointer.wait()
+		start = time.perf_counter()
+		checkpointer.save(net)
+		elapsed = time.perf_counter() - start
+		if seconds is None or elapsed < seconds:
+			seconds = elapsed
+	checkpointer.wait()
+	print('%-36s %12.3f %12s' % ('AsyncCheckpointer.save (stall)', seconds, '-'))
+	record('checkpoint', 'AsyncCheckpointer.save (stall)', seconds=seconds)
+
+	for name in os.listdir(directory):
+		os.remove(os.path.join(directory, name))
+	os.rmdir(directory)
+
+
+
+############################
+######## CONVERGENCE #######
+############################
+
+def bench_convergence(target_cost=5.3, max_epochs=3):
+	"""wall time for simple_words to reach target_cost on the validation set, per optimizer.
+	   The validation cost is checked every 250 batches (checking isn't counted)"""
+	[num_words, train_data, validate_data] = get_word_data()
+	[valid_inputs, valid_targets] = simple_words.get_index_data(validate_data.T, num_words)
+	batch_size = 100
+
+	candidates = [('SGD momentum=0.9 lr=0.09', None, 0.09),
+	              ('Nesterov momentum=0.9 lr=0.09', Nesterov(0.9), 0.09),
+	              ('RMSProp lr=0.0005', RMSProp(), 0.0005),
+	              ('Adam lr=0.001', Adam(), 0.001),
+	              ('Adam lr=0.003 cosine', Adam(schedule=CosineDecay(max_epochs * train_data.shape[0] // batch_size, 0.1)), 0.003)]
+
+	print('target validation cost %.3f' % target_cost)
+	print('%-36s %12s %10s %12s' % ('optimizer', 'seconds', 'epochs', 'final cost'))
+	for (name, optimizer, learning_rate) in candidates:
+		np.random.seed(0)
+		net = quiet(simple_words.make_layers, num_words, optimizer=optimizer, learning_rate=learning_rate)
+		net.set_buffer_reuse(True)
+
+		seconds = 0.0
+		reached = None
+		cost = None
+		for iepoch in range(0, max_epochs):
+			for ibatch in range(0, train_data.shape[0] // batch_size):
+				batch = train_data[ibatch*batch_size : (ibatch+1)*batch_size, :]
+				[inputs, targets] = simple_words.get_index_data(batch.T, num_words)
+				start = time.perf_counter()
+				net.train_batch(inputs, targets)
+				seconds += time.perf_counter() - start
+
+				if ibatch % 250 == 0:
+					cost = net.evaluate(valid_inputs, valid_targets)
+					if cost <= target_cost:
+						reached = [seconds, iepoch + float(ibatch) / (train_data.shape[0] // batch_size)]
+						break
+			if reached is not None:
+				break
+
+		if reached is None:
+			print('%-36s %12s %10s %12.4f' % (name, 'not reached', '-', cost))
+			record('convergence', name, seconds=None, epochs=None, cost=cost)
+		else:
+			print('%-36s %12.2f %10.2f %12.4f' % (name, reached[0], reached[1], cost))
+			record('convergence', name, seconds=reached[0], epochs=reached[1], cost=cost)
+
+
+
+#########################
+######## SCALING ########
+#########################
+
+def bench_scaling():
+	"""simple_words training throughput with data-parallel workers (sync: shards of each batch, hogwild: whole
+	   batches with lock-free updates), and the validation cost reached after one epoch"""
+	[num_words, train_data, validate_data] = get_word_data()
+	dtype = np.float64
+	max_workers = os.cpu_count() or 1
+	worker_counts = [n for n in [1, 2, 4, 8, 16] if n <= max(max_workers, 2)]
+	print('%d cores' % max_workers)
+
+	print('%-36s %14s %10s %12s' % ('mode', 'samples/s', 'speedup', 'valid cost'))
+	for (mode, batch_size) in [('sync', 1000), ('hogwild', 100)]:
+		def get_batches():
+			for ibatch in range(0, train_data.shape[0] // batch_size):
+				batch = train_data[ibatch*batch_size : (ibatch+1)*batch_size, :]
+				yield simple_words.get_index_data(batch.T, num_words, dtype)
+
+		base_rate = None
+		for num_workers in worker_counts:
+			np.random.seed(0)
+			net = quiet(simple_words.make_layers, num_words)
+			net.set_buffer_reuse(True)
+
+			start = time.perf_counter()
+			if num_workers == 1:
+				net.fit(get_batches)
+			else:
+				trainer = ParallelTrainer(net, num_workers, mode)
+				trainer.fit(get_batches)
+				trainer.close()
+			rate = train_data.shape[0] / (time.perf_counter() - start)
+			if base_rate is None:
+				base_rate = rate
+
+			name = '%s batch=%d workers=%d' % (mode, batch_size, num_workers)
+			valid_cost = get_word_cost(net, validate_data, num_words)
+			print('%-36s %14.0f %10.2f %12.6f' % (name, rate, rate / base_rate, valid_cost))
+			record('scaling', name, samples_per_second=rate, valid_cost=valid_cost)
+
+
+
+###########################
+######## PROFILING ########
+###########################
+
+def bench_profile():
+	"""per-layer profile of a few training batches of simple_words and the beat CNN, and what having a profiler
+	   attached costs (train_batch steps per second with and without one)"""
+	num_words = 250
+	num_steps = 100
+	net = quiet(simple_words.make_layers, num_words)
+	net.set_buffer_reuse(True)
+	[inputs, targets] = simple_words.get_index_data(np.random.randint(1, num_words+1, size=(4, 100)), num_words)
+
+	cnn = make_beat_layers(256, 5)
+	cnn.set_buffer_reuse(True)
+	cnn_inputs = np.random.rand(256, 100)
+	cnn_targets = np.eye(5)[:, np.random.randint(0, 5, size=100)]
+
+	for (name, model, x, y) in [['simple_words', net, inputs, targets], ['beat CNN', cnn, cnn_inputs, cnn_targets]]:
+		profiler = Profiler(track_memory=True)
+		model.set_profiler(profiler)
+		for i in range(0, 10):
+			model.train_batch(x, y)
+		model.set_profiler(None)
+		print('%s, batch=100:' % name)
+		profiler.print_table()
+		print('')
+
+	trace_path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+	profiler.save_chrome_trace(trace_path)
+	print('chrome trace of the beat CNN: %s (%d events)\n' % (trace_path, len(profiler.events)))
+
+	def train():
+		for i in range(0, num_steps):
+			net.train_batch(inputs, targets)
+
+	print('%-36s %14s' % ('simple_words batch=100', 'step/s'))
+	for (name, profiler) in [('no profiler', None), ('profiler (timing only)', Profiler()),
+	                         ('profiler (with tracemalloc)', Profiler(track_memory=True)), ('detached again', None)]:
+		net.set_profiler(profiler)
+		rate = num_steps / time_it(train)
+		print('%-36s %14.0f' % (name, rate))
+		record('profile', name, steps_per_second=rate)
+
+
+
+##########################
+######## MIT-BIH #########
+##########################
+
+def bench_mitbih():
+	"""the whole MIT-BIH database: decoding it record by record as before, building the cache in parallel, and
+	   memory-mapping the cache. Needs wfdb and the records in mitbih_data (see mitbih_data/download_data.py)"""
+	import mitbih
+	if mitbih.wfdb is None:
+		print('skipped: wfdb is not installed')
+		return
+	if not os.path.isdir(mitbih.data_dir) or len(mitbih.get_record_names(mitbih.data_dir)) == 0:
+		print('skipped: no records in %s' % mitbih.data_dir)
+		return
+
+	record_names = mitbih.get_record_names(mitbih.data_dir)
+	cache_path = tempfile.mkdtemp()
+
+	def read_each():
+		for name in record_names:
+			mitbih.read_data_file(mitbih.data_dir, name)
+			mitbih.read_annotation_file(mitbih.data_dir, name)
+
+	print('%-36s %12s' % ('%d records' % len(record_names), 'seconds'))
+	for (name, fn) in [('record by record (channel 0)', read_each),
+	                   ('build cache', lambda: mitbih.load_database(mitbih.data_dir, cache_path, rebuild=True)),
+	                   ('load cache', lambda: mitbih.load_database(mitbih.data_dir, cache_path))]:
+		seconds = time_it(fn, repeat=1)
+		print('%-36s %12.3f' % (name, seconds))
+		record('mitbih', name, seconds=seconds)
+
+
+def reference_beat_windows(signal, centers, window_size):
+	"""one beat at a time: a slice per beat, normalized, then stacked"""
+	offset = window_size // 2
+	windows = []
+	for center in centers:
+		window = np.array(signal[center-offset:center-offset+window_size], np.float64)
+		window -= np.mean(window)
+		window /= max(np.std(window), 1e-6)
+		windows += [window]
+	return np.array(windows)
+
+
+def bench_segmentation():
+	"""normalized windows around ~110k beats of a signal as long as the whole MIT-BIH database (48 records of
+	   650000 samples, memory-mapped), one beat at a time and with mitbih.get_windows"""
+	import mitbih
+	num_samples = 48 * 650000
+	num_beats = 110000
+	window_size = 256
+	signal_path = os.path.join(tempfile.mkdtemp(), 'channel_0.npy')
+	np.save(signal_path, np.random.randn(num_samples).astype(np.float32))
+	signal = np.load(signal_path, mmap_mode='r')
+	centers = np.sort(np.random.randint(window_size, num_samples - window_size, size=num_beats))
+
+	print('%-36s %12s %12s' % ('%d beats, window=%d' % (num_beats, window_size), 'seconds', 'beats/s'))
+	old = lambda: reference_beat_windows(signal, centers, window_size)
+	new = lambda: mitbih.get_windows(signal, centers, window_size, normalize=True, dtype=np.float64)
+	for (name, fn) in [('one beat at a time', old), ('get_windows', new)]:
+		seconds = time_it(fn, repeat=2)
+		print('%-36s %12.3f %12.0f' % (name, seconds, num_beats / seconds))
+		record('segmentation', name, seconds=seconds)
+	print('max difference %.2e' % np.max(np.abs(new() - old())))
+
+
+def make_synthetic_ecg(seconds, fs=360, seed=0):
+	"""[signal, beats]: noisy baseline wander with a QRS-like spike at each of beats (RR intervals of 0.6-1.1 s)"""
+	random = np.random.RandomState(seed)
+	num_samples = int(seconds * fs)
+	beats = (np.cumsum(random.uniform(0.6, 1.1, size=int(seconds) * 2)) * fs).astype(np.int64)
+	beats = beats[beats < num_samples - 20]
+	signal = 0.05 * random.randn(num_samples) + 0.2 * np.sin(np.arange(num_samples) * 2.0 * np.pi * 0.3 / fs)
+	spike = np.arange(-20, 21)
+	#beats are further apart than a spike is wide, so no sample gets two
+	signal[beats[:,np.newaxis] + spike] += np.exp(-(spike / 4.0) ** 2)
+	return [signal, beats]
+
+
+def bench_streaming():
+	"""mitbih.BeatStream classifying synthetic ECG with the beat CNN, fed one second (360 samples) at a time:
+	   throughput as a multiple of real time, and peak memory for records of increasing length"""
+	import mitbih
+	window_size = 256
+	net = make_beat_layers(window_size, 5)
+	net.set_buffer_reuse(True)
+
+	print('%-36s %10s %14s %14s' % ('record', 'beats', 'x real time', 'peak KB'))
+	for minutes in [5, 30, 120]:
+		[signal, beats] = make_synthetic_ecg(minutes * 60)
+		chunks = (signal[start:start+360] for start in range(0, len(signal), 360))
+
+		tracemalloc.start()
+		start = time.perf_counter()
+		num_beats = 0
+		for (samples, labels, probabilities) in mitbih.classify_stream(net, chunks, window_size):
+			num_beats += len(samples)
+		seconds = time.perf_counter() - start
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+		real_time = len(signal) / 360.0 / seconds
+		print('%-36s %10d %14.0f %14.0f' % ('%d minutes' % minutes, num_beats, real_time, peak / 1e3))
+		record('streaming', '%d minutes' % minutes, real_time=real_time, peak_bytes=peak, beats=num_beats)
+
+	#the stream ends a few samples after the window of its last beat is all in: flush() must still classify it
+	[signal, beats] = make_synthetic_ecg(20)
+	last_beat = beats[-3]
+	signal = signal[0:last_beat + window_size - window_size // 2 + 5]
+	chunks = (signal[start:start+360] for start in range(0, len(signal), 360))
+	samples = np.concatenate([samples for (samples, labels, probabilities) in mitbih.classify_stream(net, chunks, window_size)])
+	check(len(samples) > 0 and np.min(np.abs(samples - last_beat)) <= 0.05 * 360, 'the beat %d samples before the end of the stream was not classified' % (len(signal) - last_beat))
+
+
+def print_detection_accuracy(name, counts):
+	"""sensitivity and positive predictivity from summed [true positives, false positives, false negatives]"""
+	[true_positives, false_positives, false_negatives] = counts
+	sensitivity = true_positives / float(max(true_positives + false_negatives, 1))
+	predictivity = true_positives / float(max(true_positives + false_positives, 1))
+	print('%-44s %8d %8d %8d %10.4f %10.4f' % (name, true_positives, false_positives, false_negatives, sensitivity, predictivity))
+	return [sensitivity, predictivity]
+
+
+def bench_r_peaks():
+	"""R-peak detection (mitbih.pan_tompkins) on a record-long (650000 samples) synthetic ECG, whole and a second
+	   at a time, then its accuracy against the .atr beat annotations of every MIT-BIH record, if wfdb and the
+	   records are here. A beat counts as found within 150 ms. The R peaks of a noisy record with a dropout must
+	   not depend on the chunk size"""
+	import mitbih
+	fs = 360
+	tolerance = int(0.15 * fs)
+	[signal, beats] = make_synthetic_ecg(650000 / float(fs))
+	#amplitude drifting over the record, and the opposite polarity
+	signal *= -np.linspace(0.3, 2.0, len(signal))
+
+	def chunked():
+		detector = mitbih.PanTompkins(fs)
+		peaks = [detector.process(signal[start:start+fs]) for start in range(0, len(signal), fs)]
+		return np.concatenate(peaks + [detector.flush()])
+
+	print('%-44s %12s' % ('650000 samples', 'seconds'))
+	detected = {}
+	for (name, fn) in [('pan_tompkins', lambda: mitbih.pan_tompkins(signal, fs)), ('PanTompkins, 1 s chunks', chunked)]:
+		seconds = time_it(fn)
+		detected[name] = fn()
+		print('%-44s %12.3f' % (name, seconds))
+		record('r_peaks', name, seconds=seconds)
+
+	#noise that puts a few candidates within the refractory period of each other, and 10 s of lost signal
+	[noisy, noisy_beats] = make_synthetic_ecg(600, seed=3)
+	noisy *= -np.linspace(0.3, 2.0, len(noisy))
+	noisy += 0.3 * np.random.RandomState(1).randn(len(noisy))
+	noisy[300*fs:310*fs] = 0.0
+	whole = mitbih.pan_tompkins(noisy, fs)
+	for chunk_size in [1, 37, 360]:
+		detector = mitbih.PanTompkins(fs)
+		peaks = [detector.process(noisy[start:start+chunk_size]) for start in range(0, len(noisy), chunk_size)]
+		peaks = np.concatenate(peaks + [detector.flush()])
+		check(np.array_equal(peaks, whole), 'noisy record: %d R peaks in chunks of %d, %d whole' % (len(peaks), chunk_size, len(whole)))
+
+	print('\n%-44s %8s %8s %8s %10s %10s' % ('accuracy', 'TP', 'FP', 'FN', 'Se', '+P'))
+	for (name, peaks) in detected.items():
+		print_detection_accuracy('synthetic: %s' % name, mitbih.get_detection_accuracy(peaks, beats, tolerance))
+	print_detection_accuracy('synthetic, noisy with a dropout', mitbih.get_detection_accuracy(whole, noisy_beats, tolerance))
+
+	if mitbih.wfdb is None or not os.path.isdir(mitbih.data_dir) or len(mitbih.get_record_names(mitbih.data_dir)) == 0:
+		print('MIT-BIH accuracy skipped: needs wfdb and the records in %s' % mitbih.data_dir)
+		return
+	database = mitbih.load_database(mitbih.data_dir)
+	counts = np.zeros(3, np.int64)
+	for record_info in database.records:
+		name = record_info['name']
+		signal = np.asarray(database.get_signals(name))
+		[annsamp, anntype, chan] = database.get_annotations(name)
+		reference = np.sort(np.asarray(annsamp)[np.isin(anntype, mitbih.beat_annotations)])
+		counts += mitbih.get_detection_accuracy(mitbih.pan_tompkins(signal, record_info['fs']), reference, int(0.15 * record_info['fs']))
+	[sensitivity, predictivity] = print_detection_accuracy('MIT-BIH (%d records): pan_tompkins' % len(database.records), counts)
+	record('r_peaks', 'MIT-BIH pan_tompkins', sensitivity=sensitivity, predictivity=predictivity)
+
+
+#########################
+######## DOWNLOAD #######
+#########################
+
+class MirrorHandler(http.server.SimpleHTTPRequestHandler):
+	"""serves the files of server.mirror with keep-alive and range requests, like physionet. The first response
+	   for each file in server.drop stops halfway through, as if the connection dropped"""
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def setup(self):
+		http.server.SimpleHTTPRequestHandler.setup(self)
+		with self.server.lock:
+			self.server.open_connections += 1
+
+	def finish(self):
+		http.server.SimpleHTTPRequestHandler.finish(self)
+		with self.server.lock:
+			self.server.open_connections -= 1
+
+	def do_HEAD(self):
+		file_path = os.path.join(self.server.mirror, self.path.lstrip('/'))
+		if not os.path.isfile(file_path):
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Length', str(os.path.getsize(file_path)))
+		self.end_headers()
+
+	def do_GET(self):
+		name = self.path.lstrip('/')
+		file_path = os.path.join(self.server.mirror, name)
+		if not os.path.isfile(file_path):
+			self.send_error(404)
+			return
+		with open(file_path, 'rb') as f:
+			data = f.read()
+
+		start = 0
+		if self.headers.get('Range') is not None:
+			self.server.num_ranges += 1
+			start = int(self.headers.get('Range').split('=')[1].rstrip('-'))
+			if start >= len(data):
+				self.send_response(416)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			self.send_response(206)
+		else:
+			self.send_response(200)
+		self.send_header('Content-Length', str(len(data) - start))
+		self.end_headers()
+
+		with self.server.lock:
+			drop = name in self.server.drop
+			self.server.drop.discard(name)
+		if drop:
+			self.wfile.write(data[start:start + (len(data) - start) // 2])
+			self.wfile.flush()
+			self.close_connection = True
+			self.connection.shutdown(socket.SHUT_RDWR)
+			return
+		self.wfile.write(data[start:])
+
+
+def bench_download():
+	"""mitbih_data/download_data.py against a local mirror of made-up records, over HTTP (with dropped connections)
+	   and from the directory itself. Checks that every file arrives intact, that dropped transfers are resumed,
+	   that a second run downloads nothing, that truncated and corrupt files are repaired (also without checksums,
+	   by size), and that no connection is left open"""
+	from mitbih_data import download_data
+	root = tempfile.mkdtemp()
+	mirror = os.path.join(root, 'mirror')
+	os.makedirs(mirror)
+	random = np.random.RandomState(0)
+	checksums = []
+	for name in ['100', '101', '103', '234']:
+		for extension in download_data.extensions:
+			data = random.bytes(random.randint(1000, 300000))
+			with open(os.path.join(mirror, name + extension), 'wb') as f:
+				f.write(data)
+			checksums += ['%s %s' % (hashlib.sha256(data).hexdigest(), name + extension)]
+	with open(os.path.join(mirror, download_data.checksum_file), 'w') as f:
+		f.write('\n'.join(checksums) + '\n')
+	with open(os.path.join(mirror, download_data.records_file), 'w') as f:
+		f.write('100\n101\n103\n234\n')
+	names = sorted([line.split()[1] for line in checksums])
+
+	def read(file_path):
+		with open(file_path, 'rb') as f:
+			return f.read()
+
+	def check_files(dest, what):
+		for name in names:
+			file_path = os.path.join(dest, name)
+			check(os.path.exists(file_path) and read(file_path) == read(os.path.join(mirror, name)), '%s: %s is not a copy of the mirror\'s' % (what, name))
+		check(not any([name.endswith('.part') for name in os.listdir(dest)]), '%s: .part files left behind' % what)
+
+	def damage(dest):
+		"""truncates one file back to a .part file, corrupts another, and puts the wrong bytes in a third's .part file"""
+		os.replace(os.path.join(dest, '101.dat'), os.path.join(dest, '101.dat.part'))
+		with open(os.path.join(dest, '101.dat.part'), 'r+b') as f:
+			f.truncate(5000)
+		with open(os.path.join(dest, '103.atr'), 'ab') as f:
+			f.write(b'junk')
+		os.remove(os.path.join(dest, '234.hea'))
+		with open(os.path.join(dest, '234.hea.part'), 'wb') as f:
+			f.write(b'wrong bytes')
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MirrorHandler)
+	server.mirror = mirror
+	server.lock = threading.Lock()
+	server.open_connections = 0
+	server.num_ranges = 0
+	#the large files lose their connection halfway through the first time
+	server.drop = set([name for name in names if os.path.getsize(os.path.join(mirror, name)) > 200000])
+	num_dropped = len(server.drop)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+	print('%-36s %12s   %s' % ('run', 'seconds', 'outcomes'))
+	def run(name, source, dest):
+		start = time.perf_counter()
+		outcomes = quiet(download_data.download, source, dest, 4)
+		seconds = time.perf_counter() - start
+		counts = {}
+		for outcome in outcomes.values():
+			counts[outcome] = counts.get(outcome, 0) + 1
+		print('%-36s %12.3f   %s' % (name, seconds, ', '.join(['%d %s' % (count, outcome) for (outcome, count) in sorted(counts.items())])))
+		record('download', name, seconds=seconds)
+		return outcomes
+
+	def run_unverified(name, source):
+		"""without checksums, a file cut short in place (not a .part file) must be downloaded again"""
+		checksum_path = os.path.join(mirror, download_data.checksum_file)
+		os.replace(checksum_path, os.path.join(root, download_data.checksum_file))
+		try:
+			dest = os.path.join(root, name.split()[0] + '-unverified')
+			run('%s, no checksums' % name, source, dest)
+			with open(os.path.join(dest, '100.dat'), 'r+b') as f:
+				f.truncate(1000)
+			outcomes = run('%s, no checksums, truncated' % name, source, dest)
+			check_files(dest, '%s, no checksums' % name)
+			check(outcomes['100.dat'] == 'downloaded' and list(outcomes.values()).count('present') == len(names) - 1, '%s, no checksums, truncated: %s' % (name, outcomes))
+		finally:
+			os.replace(os.path.join(root, download_data.checksum_file), checksum_path)
+
+	try:
+		dest = os.path.join(root, 'http')
+		outcomes = run('http', url, dest)
+		check_files(dest, 'http')
+		check(list(outcomes.values()).count('resumed') == num_dropped and server.num_ranges >= num_dropped, 'http: the %d dropped transfers were not resumed' % num_dropped)
+
+		outcomes = run('http again', url, dest)
+		check(set(outcomes.values()) == set(['present']), 'http again: files were downloaded again')
+
+		damage(dest)
+		outcomes = run('http, damaged files', url, dest)
+		check_files(dest, 'http, damaged files')
+		check(outcomes['101.dat'] == 'resumed' and outcomes['103.atr'] == 'downloaded' and outcomes['234.hea'] == 'downloaded', 'http, damaged files: %s' % outcomes)
+		run_unverified('http', url)
+
+		#the server's side of a connection ends once the client closes it
+		for i in range(0, 100):
+			if server.open_connections == 0:
+				break
+			time.sleep(0.01)
+		check(server.open_connections == 0, 'http: %d connections left open' % server.open_connections)
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	for (name, source) in [('directory', mirror), ('file:// URL', 'file://' + mirror)]:
+		dest = os.path.join(root, name.split()[0])
+		run(name, source, dest)
+		damage(dest)
+		outcomes = run('%s, damaged files' % name, source, dest)
+		check_files(dest, name)
+		check(outcomes['101.dat'] == 'resumed', '%s: the truncated file was not resumed' % name)
+	run_unverified('directory', mirror)
+	shutil.rmtree(root)
+
+
+benchmarks = {
+	'accumulation': bench_accumulation,
+	'activations': bench_activations,
+	'allocations': bench_allocations,
+	'checkpoint': bench_checkpoint,
+	'construction': bench_construction,
+	'convergence': bench_convergence,
+	'convolution': bench_convolution,
+	'dispatch': bench_dispatch,
+	'download': bench_download,
+	'inference': bench_inference,
+	'large_vocab': bench_large_vocab,
+	'loader': bench_loader,
+	'mitbih': bench_mitbih,
+	'one_hot': bench_one_hot,
+	'passes': bench_passes,
+	'precision': bench_precision,
+	'profile': bench_profile,
+	'r_peaks': bench_r_peaks,
+	'scaling': bench_scaling,
+	'segmentation': bench_segmentation,
+	'softmax': bench_softmax,
+	'streaming': bench_streaming,
+	'training': bench_training,
+	'validation': bench_validation,
+	}
+
+
+def save_results(file_path):
+	"""writes what was recorded, and what it ran on, to file_path as JSON"""
+	run = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+	       'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'data_mat': use_data_mat, 'results': results}
+	with open(file_path, 'w') as f:
+		json.dump(run, f, indent=1, default=lambda value: value.item())
+
+
+def compare_results(file_path):
+	"""prints every metric recorded in this run next to its value in an earlier run saved in file_path"""
+	with open(file_path, 'r') as f:
+		old_run = json.load(f)
+	old_results = old_run['results']
+	print('==== compared to %s (%s) ====' % (file_path, old_run['time']))
+	print('%-60s %14s %14s %8s' % ('metric', 'before', 'now', 'ratio'))
+	for benchmark in sorted(results.keys()):
+		for (case, metrics) in results[benchmark].items():
+			old_metrics = old_results.get(benchmark, {}).get(case, {})
+			for (metric, value) in metrics.items():
+				old_value = old_metrics.get(metric)
+				if value is None or old_value is None:
+					continue
+				ratio = '%8.2f' % (value / old_value) if old_value != 0 else '%8s' % '-'
+				print('%-60s %14.6g %14.6g %s' % ('%s: %s: %s' % (benchmark, case, metric), old_value, value, ratio))
+
+
+def main():
+	"""runs the benchmarks named on the command line (all of them if none are given).
+	   --save=results.json writes what they measured to a file, --compare=old.json compares it with an earlier
+	   save, and --data-mat trains on data.mat instead of synthetic data where a benchmark trains on words"""
+	global use_data_mat
+	names = []
+	save_path = None
+	compare_path = None
+	for arg in sys.argv[1:]:
+		if arg.startswith('--save='):
+			save_path = arg[len('--save='):]
+		elif arg.startswith('--compare='):
+			compare_path = arg[len('--compare='):]
+		elif arg == '--data-mat':
+			use_data_mat = True
+		else:
+			names += [arg]
+	if len(names) == 0:
+		names = sorted(benchmarks.keys())
+
+	for name in names:
+		if name not in benchmarks:
+			print('Unknown benchmark %s. Choose from: %s' % (name, ', '.join(sorted(benchmarks.keys()))))
+			sys.exit()
+
+	for name in names:
+		print('==== %s ====' % name)
+		#the same random data every run, so runs can be compared
+		np.random.seed(0)
+		benchmarks[name]()
+
+	if save_path is not None:
+		save_results(save_path)
+	if compare_path is not None:
+		compare_results(compare_path)
+	if len(failures) > 0:
+		print('%d checks FAILED:' % len(failures))
+		for message in failures:
+			print('  %s' % message)
+		sys.exit(1)
+
+
+
+if __name__ == '__main__':
+	main()
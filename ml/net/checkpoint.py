@@ -0,0 +1,168 @@
+import os
+import json
+import threading
+from base import *
+from network import Network
+from losses import get_loss
+
+
+#File layout: magic, header length (8 bytes, little-endian), JSON header, then the raw arrays, each starting at a
+#multiple of 64 bytes. The header holds the layer configs, the connect_to_layer calls, tied weights, optimizers, output losses and
+#where each array is, so arrays can be memory-mapped straight from the file.
+magic = b'\x93MLNET\x01\n'
+alignment = 64
+
+
+def get_aligned(offset):
+	return (offset + alignment - 1) // alignment * alignment
+
+
+def to_json(value):
+	"""numpy scalars (e.g. a learning rate computed with numpy) as plain Python values"""
+	if isinstance(value, np.generic):
+		return value.item()
+	if isinstance(value, np.ndarray):
+		return value.tolist()
+	raise TypeError('Cant store %s in a checkpoint header' % type(value))
+
+
+def get_checkpoint_contents(net, extra=None):
+	"""[header, arrays]: the description of net and the arrays to store (W, master weights, optimizer state) in order"""
+	layers = []
+	arrays = []
+	array_specs = []
+	for (ilayer, layer) in enumerate(net):
+		layers += [{'config': layer.get_config(), 'connections': layer.connection_specs, 'tied_weights': layer.tied_weights,
+		            'optimizer': layer.optimizer.get_config(), 'loss': layer.loss.get_config() if layer.loss is not None else None}]
+		for (iparam, param) in enumerate(layer.params):
+			kinds = [('W', param.W), ('master', param.master)]
+			kinds += [('state:' + name, param.state[name]) for name in sorted(param.state.keys())]
+			for (kind, array) in kinds:
+				if array is not None:
+					array_specs += [{'layer': ilayer, 'param': iparam, 'kind': kind, 'dtype': array.dtype.str, 'shape': list(array.shape)}]
+					arrays += [array]
+
+	header = {'layers': layers, 'arrays': array_specs, 'extra': extra}
+	return [header, arrays]
+
+
+def write_checkpoint(file_path, header, arrays):
+	"""writes header and arrays to file_path. The file is written next to it first, so a crash never leaves
+	   a half-written checkpoint behind"""
+	#offsets depend on the header length, which depends on the offsets: reserve room for them first
+	for spec in header['arrays']:
+		spec['offset'] = 0
+	header_bytes = json.dumps(header, default=to_json).encode('utf-8')
+	header_size = len(header_bytes) + 16 * len(header['arrays']) + 64
+
+	offset = get_aligned(len(magic) + 8 + header_size)
+	for (spec, array) in zip(header['arrays'], arrays):
+		spec['offset'] = offset
+		offset = get_aligned(offset + array.nbytes)
+	header_bytes = json.dumps(header, default=to_json).encode('utf-8')
+	assert(len(header_bytes) <= header_size)
+	header_bytes += b' ' * (header_size - len(header_bytes))
+
+	temp_path = file_path + '.tmp'
+	with open(temp_path, 'wb') as f:
+		f.write(magic)
+		f.write(np.array(header_size, '<u8').tobytes())
+		f.write(header_bytes)
+		for (spec, array) in zip(header['arrays'], arrays):
+			f.write(b'\0' * (spec['offset'] - f.tell()))
+			f.write(memoryview(np.ascontiguousarray(array)).cast('B'))
+	os.replace(temp_path, file_path)
+
+
+def save_network(net, file_path, extra=None):
+	"""saves net (layers, connectivity, weights, optimizer and its state) to file_path. extra is any JSON-friendly value
+	   to keep with it, e.g. how far training got"""
+	[header, arrays] = get_checkpoint_contents(net, extra)
+	write_checkpoint(file_path, header, arrays)
+
+
+def read_header(file_path):
+	with open(file_path, 'rb') as f:
+		if f.read(len(magic)) != magic:
+			print('%s is not a network checkpoint' % file_path)
+			sys.exit()
+		header_size = int(np.frombuffer(f.read(8), '<u8')[0])
+		return json.loads(f.read(header_size).decode('utf-8'))
+
+
+def load_network(file_path, mmap_mode=None):
+	"""Returns [net, extra] from a checkpoint written by save_network.
+	   With mmap_mode ('r', 'r+' or 'c', as for np.load) the weights are memory-mapped from the file instead of
+	   read, so only the parts that get used are paged in. 'r' is enough for inference; training needs 'r+'
+	   (updates go to the file) or 'c' (updates stay in memory)."""
+	header = read_header(file_path)
+
+	#build and connect the layers. weights start at zero (without touching memory), and are replaced below
+	layers = []
+	for spec in header['layers']:
+		config = dict(spec['config'])
+		init_weight = config['init_weight']
+		config['init_weight'] = 0
+		layer = Layer(optimizer=get_optimizer(spec['optimizer']), loss=get_loss(spec.get('loss')), **config)
+		layer.init_weight = init_weight
+		layers += [layer]
+
+	for (layer, layer_above, spec) in zip(layers[0:-1], layers[1:], header['layers'][0:-1]):
+		for [from_subset, to_subset] in spec['connections']:
+			layer.connect_to_layer(layer_above, from_subset=from_subset, to_subset=to_subset)
+		if spec['tied_weights'] is not None:
+			layer.tie_weights_in_range(spec['tied_weights'])
+
+	for spec in header['arrays']:
+		param = layers[spec['layer']].params[spec['param']]
+		if mmap_mode is not None:
+			array = np.memmap(file_path, dtype=spec['dtype'], mode=mmap_mode, offset=spec['offset'], shape=tuple(spec['shape']))
+		else:
+			array = np.fromfile(file_path, dtype=spec['dtype'], count=int(np.prod(spec['shape'])), offset=spec['offset'])
+			array = array.reshape(spec['shape'])
+		if spec['kind'].startswith('state:'):
+			param.state[spec['kind'][len('state:'):]] = array
+		else:
+			assert(getattr(param, spec['kind']) is None or getattr(param, spec['kind']).shape == array.shape)
+			setattr(param, spec['kind'], array)
+
+	return [Network(layers), header['extra']]
+
+
+class AsyncCheckpointer:
+	"""Writes checkpoints of a net on a background thread. save() only copies the weights into snapshot arrays
+	   (reused from one save to the next) before returning, so training can carry on while the file is written."""
+	def __init__(self, file_path):
+		self.file_path = file_path
+		self.snapshots = []
+		self.writer = None
+		self.error = None
+
+	def save(self, net, extra=None):
+		#the snapshots are still being written from the last save
+		self.wait()
+
+		[header, arrays] = get_checkpoint_contents(net, extra)
+		if [a.shape for a in self.snapshots] != [a.shape for a in arrays] or [a.dtype for a in self.snapshots] != [a.dtype for a in arrays]:
+			self.snapshots = [np.empty(array.shape, array.dtype) for array in arrays]
+		for (snapshot, array) in zip(self.snapshots, arrays):
+			snapshot[...] = array
+
+		self.writer = threading.Thread(target=self.write, args=(header,), daemon=True)
+		self.writer.start()
+
+	def write(self, header):
+		try:
+			write_checkpoint(self.file_path, header, self.snapshots)
+		except Exception as e:
+			self.error = e
+
+	def wait(self):
+		"""waits for the checkpoint being written (if any) to be on disk"""
+		if self.writer is not None:
+			self.writer.join()
+			self.writer = None
+		if self.error is not None:
+			error = self.error
+			self.error = None
+			raise error
@@ -0,0 +1,116 @@
+import threading
+import queue
+from base import *
+
+
+class DataLoader:
+	"""Iterates over mini-batches of a data set, one epoch per iteration, shuffled every epoch. Batches are prepared
+	   on a background thread and handed over through a bounded queue, so encoding overlaps with training.
+	   With num_prefetch=0 they are prepared in the loop instead.
+
+	   The thread only pays for itself when encoding takes a real share of a step, e.g. when it reads from disk or
+	   does a lot of array work. Handing a batch over costs tens of microseconds, and Python code on the thread
+	   competes with the training loop for the GIL. simple_words' index encoding takes ~2% of a step, and is about
+	   as fast either way (see bench_loader).
+
+	   samples holds one sample per row. encode(batch, out) turns a batch (samples in columns) into whatever the
+	   training loop takes, e.g. [inputs, targets]. out is what encode returned the last time for the same output
+	   slot (None at first), so it can be refilled instead of reallocated.
+
+	   There are num_prefetch+2 output slots, used in turn: a batch stays untouched until the loop asks for the next
+	   one, but don't hold on to batches after that."""
+
+	def __init__(self, samples, batch_size, encode, shuffle=True, num_prefetch=2, seed=None):
+		assert(batch_size >= 1)
+		assert(num_prefetch >= 0)
+		self.samples = samples
+		self.batch_size = batch_size
+		self.encode = encode
+		self.shuffle = shuffle
+		self.num_prefetch = num_prefetch
+		self.random = np.random.RandomState(seed)
+
+		#per slot: the gathered rows of the batch, and the encoded batch
+		self.num_slots = num_prefetch + 2
+		self.rows = [None] * self.num_slots
+		self.encoded = [None] * self.num_slots
+
+		self.all_encoded = None
+
+	def __len__(self):
+		return (self.samples.shape[0] + self.batch_size - 1) // self.batch_size
+
+	def __iter__(self):
+		"""one epoch of batches (the last one may be smaller)"""
+		num_samples = self.samples.shape[0]
+		order = None
+		if self.shuffle:
+			order = self.random.permutation(num_samples)
+
+		if self.num_prefetch == 0:
+			for (ibatch, start) in enumerate(range(0, num_samples, self.batch_size)):
+				end = min(start + self.batch_size, num_samples)
+				yield self.get_batch(ibatch % self.num_slots, order, start, end)
+			return
+
+		batches = queue.Queue(maxsize=self.num_prefetch)
+		stop = threading.Event()
+		producer = threading.Thread(target=self.produce, args=(order, batches, stop), daemon=True)
+		producer.start()
+
+		try:
+			while True:
+				batch = batches.get()
+				if isinstance(batch, BaseException):
+					raise batch
+				if batch is None:
+					break
+				yield batch
+		finally:
+			#the loop may stop early: let the producer finish instead of blocking on a full queue
+			stop.set()
+			producer.join()
+
+	def produce(self, order, batches, stop):
+		"""background thread: encodes the batches of one epoch into the queue, then None"""
+		try:
+			num_samples = self.samples.shape[0]
+			for (ibatch, start) in enumerate(range(0, num_samples, self.batch_size)):
+				end = min(start + self.batch_size, num_samples)
+				batch = self.get_batch(ibatch % self.num_slots, order, start, end)
+				if not self.put(batches, batch, stop):
+					return
+			self.put(batches, None, stop)
+		except BaseException as e:
+			self.put(batches, e, stop)
+
+	def put(self, batches, item, stop):
+		"""puts item on the queue unless the consumer is gone. returns whether it was put"""
+		while not stop.is_set():
+			try:
+				batches.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def get_batch(self, islot, order, start, end):
+		"""gathers and encodes samples [start, end) of the epoch into output slot islot"""
+		if order is None:
+			rows = self.samples[start:end]
+		else:
+			shape = (end - start,) + self.samples.shape[1:]
+			rows = self.rows[islot]
+			if rows is None or rows.shape != shape:
+				rows = np.empty(shape, self.samples.dtype)
+				self.rows[islot] = rows
+			np.take(self.samples, order[start:end], axis=0, out=rows, mode='clip')
+
+		self.encoded[islot] = self.encode(rows.T, self.encoded[islot])
+		return self.encoded[islot]
+
+	def get_all(self):
+		"""the whole data set (in order) encoded as one batch. encoded once, then cached"""
+		if self.all_encoded is None:
+			self.all_encoded = self.encode(self.samples.T, None)
+		return self.all_encoded
@@ -0,0 +1,325 @@
+import heapq
+import scipy.sparse
+import scipy.special
+from base import *
+
+
+#A loss replaces the full softmax of an output layer during training (pass it as the layer's loss=). Its weights are
+#the outgoing weights of the layer below, as one block that includes the bias unit, so that the block can pick out
+#only the columns a batch needs. forward() still computes every output, so inference and evaluation (predict,
+#top_k, evaluate) give the exact softmax of the trained weights.
+
+
+def get_noise_distribution(counts, vocab_size, power):
+	"""counts^power, normalized (uniform without counts). Word frequencies to the 3/4 are the usual choice"""
+	if counts is None:
+		return np.full(vocab_size, 1.0 / vocab_size)
+	assert(len(counts) == vocab_size)
+	q = np.asarray(counts, np.float64) ** power
+	#words never seen still get sampled now and then
+	q += 1e-6 * np.sum(q) / vocab_size
+	return q / np.sum(q)
+
+
+def get_sparse_Dew(y, columns, samples, values):
+	"""[the columns used, dE/dw of those columns]: Dew[:, k] = sum of values[i] * y[:, samples[i]] over the entries i
+	   whose column is the k-th one used. A column can come up more than once; the entries are summed as a sparse
+	   (columns used x samples) matrix, so the work is len(columns) * from_len, whatever the vocabulary size"""
+	[unique, inverse] = np.unique(columns, return_inverse=True)
+	weights = scipy.sparse.csr_matrix((values, (inverse, samples)), shape=(len(unique), y.shape[1]))
+	return [unique, np.ascontiguousarray((weights @ y.T).T)]
+
+
+#######################################
+######## SAMPLED SOFTMAX / NCE ########
+#######################################
+
+class SampledBlock(DenseBlock):
+	"""Output weights (from_len x vocab, bias unit in the last row if there is one) trained on the words of the
+	   batch plus num_sampled words drawn from the noise distribution q per batch. The logits get log(num_sampled * q)
+	   subtracted, which corrects for how often each word is drawn. Subclasses turn the logits into a cost
+	   (get_logit_gradients)"""
+	def __init__(self, from_range, to_range, init_weight, bias, q, num_sampled, dtype=np.float64, master_dtype=None):
+		DenseBlock.__init__(self, from_range, to_range, init_weight, dtype, master_dtype)
+		if bias is not None:
+			self.param.get_master()[-1] *= bias
+			self.param.sync()
+
+		self.num_sampled = num_sampled
+		self.log_expected = np.log(num_sampled * q).astype(dtype)
+		self.cumulative = np.cumsum(q)
+		self.cumulative /= self.cumulative[-1]
+
+	def get_sample(self):
+		"""num_sampled word indices drawn from q, with replacement. O(num_sampled log vocab)"""
+		sample = np.searchsorted(self.cumulative, np.random.rand(self.num_sampled), side='right')
+		return np.minimum(sample, len(self.cumulative) - 1)
+
+	def get_loss(self, y, targets, Dey):
+		"""Returns [cost summed over the samples, dE/dw averaged over the samples and divided by get_step_divisor(),
+		   the columns of W it is for] (see get_sparse_Dew). y is the layer below's y (with the bias unit), targets the
+		   index of each sample's word. dE/dy of the layer below goes into Dey"""
+		W = self.param.W
+		num_samples = y.shape[1]
+		sample = self.get_sample()
+
+		#logits of each sample's own word, and of the sampled words
+		W_true = np.take(W, targets, axis=1)
+		true_logits = np.einsum('in,in->n', W_true, y)
+		true_logits -= self.log_expected[targets]
+		W_sampled = np.take(W, sample, axis=1)
+		sampled_logits = np.dot(W_sampled.T, y)
+		sampled_logits -= self.log_expected[sample][:,np.newaxis]
+
+		#a sampled word that is the sample's own word isn't noise (an 'accidental hit'): it doesn't count
+		hits = sample[:,np.newaxis] == targets[np.newaxis,:]
+		[cost, D_true, D_sampled] = self.get_logit_gradients(true_logits, sampled_logits, hits)
+
+		#dE/dy through the columns that were used (the bias unit has none)
+		Dey_all = W_true * D_true
+		Dey_all += np.dot(W_sampled, D_sampled)
+		Dey[...] = Dey_all[0:Dey.shape[0]]
+
+		#dE/dw: only the columns that were used are non-zero
+		sample_index = np.arange(num_samples)
+		columns = np.concatenate([targets, np.repeat(sample, num_samples)])
+		samples = np.concatenate([sample_index, np.tile(sample_index, len(sample))])
+		values = np.concatenate([D_true, D_sampled.ravel()])
+		values /= float(num_samples) * self.get_step_divisor()
+		[columns, Dew] = get_sparse_Dew(y, columns, samples, values)
+		return [cost, Dew, columns]
+
+	def get_step_divisor(self):
+		return 1.0
+
+	def get_loss_flops(self, num_samples):
+		"""floating point operations of get_loss for a batch (for profiling)"""
+		from_len = self.param.W.shape[0]
+		return 6 * from_len * (self.num_sampled + 1) * num_samples
+
+
+class SampledSoftmaxBlock(SampledBlock):
+	"""softmax over each sample's own word and the sampled words (Jean et al.)"""
+	def get_logit_gradients(self, true_logits, sampled_logits, hits):
+		sampled_logits[hits] = -np.inf
+		shift = np.maximum(true_logits, np.max(sampled_logits, axis=0))
+		true_exp = np.exp(true_logits - shift)
+		sampled_exp = np.exp(sampled_logits - shift)
+		total = true_exp + np.sum(sampled_exp, axis=0)
+
+		#-log of the own word's probability
+		cost = np.sum(np.log(total) - (true_logits - shift))
+		return [cost, true_exp / total - 1.0, sampled_exp / total]
+
+
+class NCEBlock(SampledBlock):
+	"""noise-contrastive estimation: each logit is a logistic classifier of 'own word' (label 1) against 'noise'
+	   (label 0) (Mnih & Teh)"""
+	def get_logit_gradients(self, true_logits, sampled_logits, hits):
+		#-log sigmoid(x) = log(1 + e^-x), and -log(1 - sigmoid(x)) = log(1 + e^x)
+		noise = ~hits
+		cost = np.sum(np.logaddexp(0.0, -true_logits)) + np.sum(np.logaddexp(0.0, sampled_logits) * noise)
+		D_sampled = scipy.special.expit(sampled_logits)
+		D_sampled *= noise
+		return [cost, scipy.special.expit(true_logits) - 1.0, D_sampled]
+
+	def get_step_divisor(self):
+		#every noise word is a classifier of its own, pushed down by up to 1 per sample, where the pushes of a softmax
+		#on the other words add up to at most 1. At the layer's learning rate that is num_sampled times the step, and
+		#the output weights overshoot (validation cost far above log vocab)
+		return float(self.num_sampled)
+
+
+######################################
+######## HIERARCHICAL SOFTMAX ########
+######################################
+
+def get_huffman_paths(counts):
+	"""Huffman tree over the words (frequent words get short paths). Returns [nodes, signs, mask], each (words x depth):
+	   the internal nodes (0 is the root) on each word's path from the root, +1/-1 for the branch taken at each, and
+	   1 where the path is real (shorter paths are padded with node 0 and mask 0)"""
+	vocab_size = len(counts)
+	assert(vocab_size >= 2)
+
+	#leaves are 0..vocab_size-1, internal nodes vocab_size.. in the order they are made. ties go by id, so the tree
+	#only depends on the counts
+	heap = [(count, i) for (i, count) in enumerate(counts)]
+	heapq.heapify(heap)
+	parent = np.zeros(2*vocab_size - 1, np.int64)
+	branch = np.zeros(2*vocab_size - 1, np.float64)
+	next_id = vocab_size
+	while len(heap) > 1:
+		(count0, child0) = heapq.heappop(heap)
+		(count1, child1) = heapq.heappop(heap)
+		parent[child0] = next_id
+		parent[child1] = next_id
+		branch[child0] = -1.0
+		branch[child1] = 1.0
+		heapq.heappush(heap, (count0 + count1, next_id))
+		next_id += 1
+	root = next_id - 1
+
+	paths = []
+	for word in range(0, vocab_size):
+		path = []
+		node = word
+		while node != root:
+			#internal node ids, counted from the root down
+			path += [(root - parent[node], branch[node])]
+			node = parent[node]
+		paths += [path[::-1]]
+
+	depth = max([len(path) for path in paths])
+	nodes = np.zeros((vocab_size, depth), np.int64)
+	signs = np.ones((vocab_size, depth))
+	mask = np.zeros((vocab_size, depth))
+	for (word, path) in enumerate(paths):
+		for (d, (node, sign)) in enumerate(path):
+			nodes[word, d] = node
+			signs[word, d] = sign
+			mask[word, d] = 1.0
+	return [nodes, signs, mask]
+
+
+class HierarchicalSoftmaxBlock(DenseBlock):
+	"""Output weights as one vector per internal node of a Huffman tree over the words (from_len x vocab-1, bias unit
+	   in the last row if there is one). p(word) is the product of sigmoid(sign * score) of the nodes on its path, so
+	   training a sample takes depth = O(log vocab) dot products. The p's sum to 1 by construction: forward() gives
+	   the exact log p of every word as z, which get_softmax/get_log_softmax leave as they are.
+	   The node vectors start at zero (as in word2vec), so every branch starts at 1/2 and the cost at about log vocab"""
+	def __init__(self, from_range, to_range, init_weight, bias, counts, dtype=np.float64, master_dtype=None):
+		self.from_range = from_range
+		self.to_range = to_range
+		vocab_size = to_range[1] - to_range[0]
+		from_len = from_range[1] - from_range[0]
+		#random node vectors put every node off 1/2, which costs at each level of the tree
+		self.param = Parameter(np.zeros((from_len, vocab_size - 1), dtype), master_dtype)
+		self.buffers = Buffers(dtype)
+
+		#add-one, so that words missing from the counts don't end up at the bottom of a very deep tree
+		if counts is None:
+			counts = np.zeros(vocab_size)
+		[self.nodes, signs, mask] = get_huffman_paths(np.asarray(counts) + 1)
+		self.signs = signs.astype(dtype)
+		self.mask = mask.astype(dtype)
+
+	def forward(self, y, z):
+		"""log p of every word, added to z"""
+		i0, i1 = self.from_range
+		j0, j1 = self.to_range
+		num_samples = y.shape[1]
+		scores = self.buffers.get('scores', (self.param.W.shape[1], num_samples))
+		np.dot(self.param.W.T, y[i0:i1], out=scores)
+
+		#log sigmoid(sign * score) = -log(1 + e^(-sign * score)), one level of the tree at a time
+		term = self.buffers.get('term', (j1-j0, num_samples))
+		for d in range(0, self.nodes.shape[1]):
+			np.take(scores, self.nodes[:, d], axis=0, out=term, mode='clip')
+			term *= -self.signs[:, d:d+1]
+			np.logaddexp(0.0, term, out=term)
+			term *= self.mask[:, d:d+1]
+			z[j0:j1] -= term
+
+	def get_loss(self, y, targets, Dey):
+		"""Returns [cost summed over the samples, dE/dw averaged over the samples with each sample's divided by its
+		   path length, the columns (nodes) of W it is for]. Only the nodes on the path of each sample's word are used.
+		   dE/dy of the layer below goes into Dey"""
+		W = self.param.W
+		nodes = self.nodes[targets].T
+		signs = self.signs[targets].T
+		mask = self.mask[targets].T
+
+		W_path = np.take(W, nodes, axis=1)
+		scores = np.einsum('idn,in->dn', W_path, y)
+		scores *= signs
+		cost = np.sum(np.logaddexp(0.0, -scores) * mask)
+
+		#d/dscore of -log sigmoid(sign * score)
+		D_scores = scipy.special.expit(-scores)
+		D_scores *= signs
+		D_scores *= mask
+		np.negative(D_scores, out=D_scores)
+
+		Dey_all = np.einsum('idn,dn->in', W_path, D_scores)
+		Dey[...] = Dey_all[0:Dey.shape[0]]
+
+		#a sample trains every node on its path as an output of its own: at the layer's learning rate, a step of
+		#path length times a softmax's, and the top of the tree overshoots (validation cost far above log vocab)
+		values = D_scores / (np.sum(mask, axis=0) * float(y.shape[1]))
+		samples = np.tile(np.arange(y.shape[1]), nodes.shape[0])
+		[columns, Dew] = get_sparse_Dew(y, nodes.ravel(), samples, values.ravel())
+		return [cost, Dew, columns]
+
+	def add_to_dense(self, W):
+		#node vectors, not weights of particular words
+		i0, i1 = self.from_range
+		W[i0:i1, 0:self.param.W.shape[1]] += self.param.W
+
+	def get_flops(self, num_samples):
+		flops = 2 * self.param.W.size * num_samples + 4 * self.nodes.size * num_samples
+		return [flops, 0, 0]
+
+	def get_loss_flops(self, num_samples):
+		return 6 * self.param.W.shape[0] * self.nodes.shape[1] * num_samples
+
+
+###############################
+######## LOSS SETTINGS ########
+###############################
+
+class SampledSoftmax:
+	"""sampled softmax with num_sampled noise words per batch, drawn from counts^power (uniform without counts)"""
+	block_type = SampledSoftmaxBlock
+
+	def __init__(self, num_sampled=64, counts=None, power=0.75):
+		self.num_sampled = num_sampled
+		self.counts = counts
+		self.power = power
+
+	def get_block(self, from_range, to_range, init_weight, bias, dtype, master_dtype):
+		q = get_noise_distribution(self.counts, to_range[1] - to_range[0], self.power)
+		return self.block_type(from_range, to_range, init_weight, bias, q, self.num_sampled, dtype, master_dtype)
+
+	def get_config(self):
+		counts = None
+		if self.counts is not None:
+			counts = [int(count) for count in self.counts]
+		return {'type': type(self).__name__, 'num_sampled': self.num_sampled, 'counts': counts, 'power': self.power}
+
+
+class NCE(SampledSoftmax):
+	"""noise-contrastive estimation with num_sampled noise words per batch, drawn from counts^power"""
+	block_type = NCEBlock
+
+
+class HierarchicalSoftmax:
+	"""hierarchical softmax over a Huffman tree built from the word counts (a balanced tree without counts).
+	   The counts should cover the vocabulary (e.g. the whole corpus): counts of a training set much smaller than
+	   the vocabulary put the words it has in subtrees of their own, and the top of the tree learns that the target
+	   is one of them"""
+	def __init__(self, counts=None):
+		self.counts = counts
+
+	def get_block(self, from_range, to_range, init_weight, bias, dtype, master_dtype):
+		return HierarchicalSoftmaxBlock(from_range, to_range, init_weight, bias, self.counts, dtype, master_dtype)
+
+	def get_config(self):
+		counts = None
+		if self.counts is not None:
+			counts = [int(count) for count in self.counts]
+		return {'type': type(self).__name__, 'counts': counts}
+
+
+losses = {'SampledSoftmax': SampledSoftmax, 'NCE': NCE, 'HierarchicalSoftmax': HierarchicalSoftmax}
+
+
+def get_loss(config):
+	"""loss from what get_config() returned (None for a full softmax)"""
+	if config is None:
+		return None
+	config = dict(config)
+	name = config.pop('type')
+	if name not in losses:
+		print('Unknown loss %s' % name)
+		sys.exit()
+	return losses[name](**config)
@@ -1,15 +1,22 @@
 import os
 import sys
+import json
+import collections
+import concurrent.futures
 import numpy as np
 import scipy.io as sio
-import wfdb	#physionet package to read their data/annotation formats
-import matplotlib.pyplot as plt
+import scipy.signal
+try:
+	import wfdb	#physionet package to read their data/annotation formats. only needed to decode the records
+except ImportError:
+	wfdb = None
 
 
 data_dir = './mitbih_data'
 
 data_extension = '.dat'
 annotation_extension = '.atr'
+header_extension = '.hea'
 
 #Note: integer 1 corresponds to normal beat
 #got these by looking at the _rdann.py file in the wfdb python repository (github.com/MIT-LCP/wfdb-python)
@@ -22,15 +29,28 @@ non_key_annotations = [
 	40		#waveform end
 	]
 
+#annotations of actual beats (normal, bundle branch block, premature, escape, paced, fusion, unclassifiable...), what
+#R-peak detection is scored against
+beat_annotations = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 25, 34, 35, 38, 41]
+
+#the cache: the samples of every record one after the other, one file per channel (in mV, as float32: the
+#11-bit samples lose nothing), the annotations of every record one after the other, and an index saying where
+#each record starts in them
+cache_dtype = np.float32
+cache_index_file = 'index.json'
+cache_version = 1
+
 
 
 def main():
-	data_files, annotation_files = get_mitbih_filenames(data_dir)
-	print('Found %d record(s)' % len(data_files))
+	import matplotlib.pyplot as plt
+
+	database = load_database(data_dir)
+	print('Found %d record(s), %d samples' % (len(database.records), database.num_samples))
 
 	record = '116'
-	signals = read_data_file(data_dir, record)
-	annsamp, anntype, chan = read_annotation_file(data_dir, record)
+	signals = database.get_signals(record)
+	annsamp, anntype, chan = database.get_annotations(record)
 
 
 	print(annsamp[0:10])
@@ -55,32 +75,54 @@ def get_mitbih_filenames(dir_path):
 	return (data_files, annotation_files)
 
 
-def read_data_file(file_dir, record_name):
-	""" reads channel 0 data from specified record """
-	cwd = os.getcwd()
-	os.chdir(file_dir)
+def get_record_names(dir_path):
+	"""names of the records in the specified directory (those with a header and data file), sorted"""
+	names = []
+	for file in os.listdir(dir_path):
+		if file.endswith( header_extension ):
+			name = file[0:-len(header_extension)]
+			if os.path.exists(os.path.join(dir_path, name + data_extension)):
+				names += [name]
+	return sorted(names)
+
+
+def read_header(file_dir, record_name):
+	"""sampling frequency, number of samples and channel names of a record, from the first lines of its header file"""
+	with open(os.path.join(file_dir, record_name + header_extension), 'r') as f:
+		lines = [line.split() for line in f if line.strip() and not line.startswith('#')]
+
+	#record line: name, number of signals, sampling frequency, number of samples per signal
+	num_channels = int(lines[0][1])
+	fs = float(lines[0][2].split('/')[0])
+	num_samples = int(lines[0][3])
+
+	#signal lines: file, format, gain, resolution, zero, initial value, checksum, block size, description
+	channels = [' '.join(line[8:]) for line in lines[1:num_channels+1]]
+	return {'fs': fs, 'length': num_samples, 'channels': channels}
+
 
-	#function rdsamp function documentation in wfdb python github repository
-	signals, fields = wfdb.rdsamp(record_name, physical=1)
+def read_record(file_dir, record_name):
+	""" reads all channels of specified record, as a (samples x channels) array """
+	#function rdsamp function documentation in wfdb python github repository. it takes a path to the record, so
+	#this doesn't need to change the working directory (which is shared by every thread)
+	signals, fields = wfdb.rdsamp(os.path.join(file_dir, record_name), physical=1)
+	return signals
 
-	os.chdir(cwd)
 
+def read_data_file(file_dir, record_name):
+	""" reads channel 0 data from specified record """
 	#NOTE: most annotation seem to correspond to channel 0. let's work with this one channel for now
+	signals = read_record(file_dir, record_name)
 	signals = signals.T[0]
 	return signals
 
 
 def read_annotation_file(file_dir, record_name):
 	""" reads annotations of specified record """
-	cwd = os.getcwd()
-	os.chdir(file_dir)
-
 	#function rdann function documentation in wfdb python github repository
 	ext = annotation_extension[1:]	#without the '.'
 	anndisp = 0			#return annotated events as integers
-	annsamp, anntype, subtype, chan, num, aux, annfs = wfdb.rdann(record_name, ext, anndisp=anndisp)
-
-	os.chdir(cwd)
+	annsamp, anntype, subtype, chan, num, aux, annfs = wfdb.rdann(os.path.join(file_dir, record_name), ext, anndisp=anndisp)
 
 	#annsamp: annotation location in samples relative to beginning of record
 	#anntype: integer corresponding to an event (see wfdb github python repository)
@@ -88,6 +130,249 @@ def read_annotation_file(file_dir, record_name):
 	return (annsamp, anntype, chan)
 
 
+def decode_record(file_dir, record_name):
+	"""signals (samples x channels, in cache_dtype) and annotations of a record. runs in the worker processes"""
+	signals = read_record(file_dir, record_name).astype(cache_dtype)
+	annsamp, anntype, chan = read_annotation_file(file_dir, record_name)
+	return [signals, np.asarray(annsamp, np.int64), np.asarray(anntype, np.int16), np.asarray(chan, np.int16)]
+
+
+
+################################
+######## DATABASE CACHE ########
+################################
+
+def get_source_stamps(dir_path, record_name):
+	"""size and modification time of each file of a record, to tell whether a cache is out of date"""
+	stamps = {}
+	for extension in [header_extension, data_extension, annotation_extension]:
+		file_path = os.path.join(dir_path, record_name + extension)
+		if os.path.exists(file_path):
+			stat = os.stat(file_path)
+			stamps[extension] = [stat.st_size, int(stat.st_mtime)]
+	return stamps
+
+
+def build_cache(dir_path, cache_path, num_workers=None):
+	"""Decodes every record in dir_path, num_workers at a time in separate processes (all CPUs by default), into
+	   a cache in cache_path (see load_database). Each channel is written to its file as its records come in, so
+	   the whole database is never in memory at once"""
+	record_names = get_record_names(dir_path)
+	if len(record_names) == 0:
+		print('No records found in %s' % dir_path)
+		sys.exit()
+	if wfdb is None:
+		print('Decoding the records needs wfdb (pip install wfdb)')
+		sys.exit()
+	os.makedirs(cache_path, exist_ok=True)
+
+	#the headers say how long everything will be
+	records = []
+	start = 0
+	for name in record_names:
+		record = read_header(dir_path, name)
+		record['name'] = name
+		record['start'] = start
+		record['stamps'] = get_source_stamps(dir_path, name)
+		records += [record]
+		start += record['length']
+	num_samples = start
+	num_channels = max([len(record['channels']) for record in records])
+
+	#channels a record doesn't have are NaN
+	channel_files = []
+	for channel in range(0, num_channels):
+		channel_file = np.lib.format.open_memmap(os.path.join(cache_path, 'channel_%d.npy' % channel), mode='w+', dtype=cache_dtype, shape=(num_samples,))
+		channel_file[:] = np.nan
+		channel_files += [channel_file]
+
+	annotations = []
+	ann_start = 0
+	with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+		decoded = executor.map(decode_record, [dir_path] * len(records), record_names)
+		for (record, [signals, annsamp, anntype, chan]) in zip(records, decoded):
+			assert(signals.shape[0] == record['length'])
+			for channel in range(0, signals.shape[1]):
+				channel_files[channel][record['start']:record['start']+record['length']] = signals[:, channel]
+			record['ann_start'] = ann_start
+			record['ann_end'] = ann_start + len(annsamp)
+			ann_start = record['ann_end']
+			annotations += [[annsamp, anntype, chan]]
+
+	for channel_file in channel_files:
+		channel_file.flush()
+	del channel_files
+
+	for (i, name) in enumerate(['ann_sample', 'ann_type', 'ann_chan']):
+		np.save(os.path.join(cache_path, name + '.npy'), np.concatenate([annotation[i] for annotation in annotations]))
+
+	#the index goes last: a cache without one is incomplete
+	index = {'version': cache_version, 'dtype': np.dtype(cache_dtype).str, 'num_samples': num_samples,
+	         'num_channels': num_channels, 'records': records}
+	temp_path = os.path.join(cache_path, cache_index_file + '.tmp')
+	with open(temp_path, 'w') as f:
+		json.dump(index, f, indent=1)
+	os.replace(temp_path, os.path.join(cache_path, cache_index_file))
+	return index
+
+
+def read_cache_index(dir_path, cache_path):
+	"""the index of the cache in cache_path, or None if there is none or it doesn't match the records in dir_path"""
+	index_path = os.path.join(cache_path, cache_index_file)
+	if not os.path.exists(index_path):
+		return None
+	with open(index_path, 'r') as f:
+		index = json.load(f)
+	if index.get('version') != cache_version:
+		return None
+
+	record_names = get_record_names(dir_path)
+	if record_names != [record['name'] for record in index['records']]:
+		return None
+	for record in index['records']:
+		if get_source_stamps(dir_path, record['name']) != record['stamps']:
+			return None
+	return index
+
+
+class Database:
+	"""The MIT-BIH records of a cache, memory-mapped: nothing is read from disk until it's used.
+	   channels[c] holds channel c of every record one after the other, and ann_sample/ann_type/ann_chan the
+	   annotations of every record (ann_sample relative to the start of its record). records lists, in order,
+	   each record's name, fs, length, channel names, where it starts in the channels (start) and where its
+	   annotations are (ann_start to ann_end)"""
+
+	def __init__(self, cache_path, index):
+		self.records = index['records']
+		self.record_index = dict([(record['name'], i) for (i, record) in enumerate(self.records)])
+		self.num_samples = index['num_samples']
+		self.channels = [np.load(os.path.join(cache_path, 'channel_%d.npy' % channel), mmap_mode='r') for channel in range(0, index['num_channels'])]
+		self.ann_sample = np.load(os.path.join(cache_path, 'ann_sample.npy'), mmap_mode='r')
+		self.ann_type = np.load(os.path.join(cache_path, 'ann_type.npy'), mmap_mode='r')
+		self.ann_chan = np.load(os.path.join(cache_path, 'ann_chan.npy'), mmap_mode='r')
+
+	def get_record(self, record_name):
+		return self.records[self.record_index[record_name]]
+
+	def get_signals(self, record_name, channel=0):
+		"""the samples of one channel of a record (a view of the cache, like read_data_file returns)"""
+		record = self.get_record(record_name)
+		return self.channels[channel][record['start']:record['start']+record['length']]
+
+	def get_annotations(self, record_name):
+		"""(annsamp, anntype, chan) of a record, like read_annotation_file returns"""
+		record = self.get_record(record_name)
+		annotations = slice(record['ann_start'], record['ann_end'])
+		return (self.ann_sample[annotations], self.ann_type[annotations], self.ann_chan[annotations])
+
+
+def load_database(dir_path=data_dir, cache_path=None, num_workers=None, rebuild=False):
+	"""Every record in dir_path, as a Database. The first time (or when the records change, or with rebuild), they
+	   are decoded in parallel into a cache (by default in a cache directory in dir_path); after that, loading only
+	   memory-maps the cache"""
+	if cache_path is None:
+		cache_path = os.path.join(dir_path, 'cache')
+
+	index = None
+	if not rebuild:
+		index = read_cache_index(dir_path, cache_path)
+	if index is None:
+		index = build_cache(dir_path, cache_path, num_workers)
+	return Database(cache_path, index)
+
+
+
+###################################
+######## BEAT SEGMENTATION ########
+###################################
+
+def get_windows(signal, centers, window_size, offset=None, normalize=False, dtype=None):
+	"""(beats x window_size) array of the windows of signal (1D, e.g. a memory-mapped channel) that start offset
+	   samples before each of centers (by default, centered on them). Gathered in one go from a strided view of
+	   signal, so only the pages the windows are on are read. With normalize, each window is shifted and scaled to
+	   zero mean and unit variance"""
+	if offset is None:
+		offset = window_size // 2
+	starts = np.asarray(centers) - offset
+	assert(len(starts) == 0 or (np.min(starts) >= 0 and np.max(starts) + window_size <= len(signal)))
+
+	#row i of the view is signal[i:i+window_size], without copying anything
+	windows = np.lib.stride_tricks.sliding_window_view(signal, window_size)
+	result = windows[starts]
+	if dtype is not None:
+		result = result.astype(dtype, copy=False)
+
+	if normalize:
+		normalize_windows(result)
+	return result
+
+
+def normalize_windows(windows):
+	"""shifts and scales each row of windows (in place) to zero mean and unit variance"""
+	windows -= np.mean(windows, axis=1, keepdims=True)
+	std = np.std(windows, axis=1, keepdims=True)
+	np.maximum(std, 1e-6, out=std)		#flat windows stay flat
+	windows /= std
+
+
+def get_balanced_indices(labels, balance, random):
+	"""indices into labels with the same number of each class: that of the rarest class with 'undersample', that of
+	   the most common one (some drawn more than once) with 'oversample'. sorted, so that windows are read in order"""
+	classes, counts = np.unique(labels, return_counts=True)
+	if balance == 'undersample':
+		count = np.min(counts)
+	elif balance == 'oversample':
+		count = np.max(counts)
+	else:
+		print('Unknown class balancing %s' % balance)
+		sys.exit()
+
+	order = np.argsort(labels, kind='stable')
+	class_starts = np.concatenate([[0], np.cumsum(counts)[0:-1]])
+	#count draws from each class's run of order
+	draws = [random.choice(class_count, count, replace=(balance == 'oversample')) for class_count in counts]
+	indices = order[np.concatenate([class_start + draw for (class_start, draw) in zip(class_starts, draws)])]
+	return np.sort(indices)
+
+
+def get_beats(database, window_size, channel=0, record_names=None, offset=None, normalize=False, balance=None, seed=None, dtype=None):
+	"""Training samples from the annotated beats of a Database: [windows, labels], a (beats x window_size) array of
+	   the signal of channel around each beat (see get_windows) and the anntype of each beat. Annotations that aren't
+	   beats (non_key_annotations) and beats too close to the ends of their record are left out. record_names
+	   restricts it to some of the records (e.g. a train/test split by record). balance can be 'undersample' or
+	   'oversample' (see get_balanced_indices), drawing with seed. Windows are rows, like DataLoader samples (a
+	   Network takes their transpose).
+	   Everything is done on whole arrays: the only loops are over records and classes"""
+	if offset is None:
+		offset = window_size // 2
+	if record_names is None:
+		records = database.records
+	else:
+		records = [database.get_record(name) for name in record_names]
+
+	#every annotation of the records, with the start and length of its record
+	ann_counts = np.array([record['ann_end'] - record['ann_start'] for record in records], np.int64)
+	annotations = np.concatenate([np.arange(record['ann_start'], record['ann_end']) for record in records] + [np.zeros(0, np.int64)])
+	record_starts = np.repeat([record['start'] for record in records], ann_counts)
+	record_lengths = np.repeat([record['length'] for record in records], ann_counts)
+
+	samples = np.asarray(database.ann_sample[annotations])
+	labels = np.asarray(database.ann_type[annotations])
+	keep = ~np.isin(labels, non_key_annotations)
+	keep &= samples - offset >= 0
+	keep &= samples - offset + window_size <= record_lengths
+	centers = (record_starts + samples)[keep]
+	labels = labels[keep]
+
+	if balance is not None:
+		selected = get_balanced_indices(labels, balance, np.random.RandomState(seed))
+		centers = centers[selected]
+		labels = labels[selected]
+
+	windows = get_windows(database.channels[channel], centers, window_size, offset, normalize, dtype)
+	return [windows, labels]
+
+
 
 
 #def read_all_mitbih_records(dir_path):
@@ -125,6 +410,350 @@ def read_annotation_file(file_dir, record_name):
 
 
 
+###########################
+######## STREAMING ########
+###########################
+
+#[sos, delay] of the Pan-Tompkins bandpass filter for each sampling frequency (designing it takes longer than
+#filtering a few seconds of signal)
+bandpasses = {}
+
+def get_bandpass(fs):
+	"""[second-order sections, delay in samples at its center frequency] of a 5-15 Hz Butterworth bandpass"""
+	if fs not in bandpasses:
+		sos = scipy.signal.butter(2, [5.0, 15.0], btype='bandpass', fs=fs, output='sos')
+		[b, a] = scipy.signal.sos2tf(sos)
+		delay = int(round(scipy.signal.group_delay((b, a), w=[10.0], fs=fs)[1][0]))
+		bandpasses[fs] = [sos, delay]
+	return bandpasses[fs]
+
+
+class PanTompkins:
+	"""Pan-Tompkins R-peak detection (Pan & Tompkins, 1985), chunk by chunk: 5-15 Hz bandpass, derivative,
+	   squaring and a 150 ms moving-window integration, all as scipy.signal filters that carry their state from one
+	   chunk to the next. Candidate peaks are the local maxima of the integrated signal, in order: one within the
+	   200 ms refractory period of the candidate before it replaces that one if it is higher, and is dropped
+	   otherwise. Each is then compared with an adaptive threshold between running estimates of the signal and noise
+	   peak levels. If no beat turns up within 166% of the average RR interval, the largest candidate since the
+	   last beat above half the threshold is taken (search back). The R peak of a beat is the largest bandpassed
+	   sample in the integration window before its integrated peak, less the bandpass delay.
+
+	   process(chunk) returns the sample indices (from the start of the stream) of the R peaks it can settle: a
+	   peak comes out once the refractory period after it has come in. Nothing depends on what is still to come, so
+	   the R peaks are the same however the stream is chunked. flush() returns the rest at the end of the stream.
+	   The first learning seconds set the initial thresholds"""
+
+	def __init__(self, fs=360, learning=2.0):
+		self.fs = fs
+		[self.sos, self.bandpass_delay] = get_bandpass(fs)
+		self.derivative = np.array([1.0, 2.0, 0.0, -2.0, -1.0]) * (fs / 8.0)
+		self.derivative_delay = 2
+		self.window = int(0.15 * fs)
+		self.refractory = int(0.2 * fs)
+		self.num_learning = int(learning * fs)
+		self.max_search_back = int(3.0 * fs)
+		self.window_weights = np.ones(self.window) / self.window
+
+		#filter state: the bandpass', and the last inputs of the derivative and of the integration
+		self.sos_state = None
+		self.derivative_state = np.zeros(len(self.derivative) - 1)
+		self.window_state = np.zeros(self.window - 1)
+
+		#bandpassed and integrated signal from sample tail_start on: what hasn't been settled, and the R peak search window before it
+		self.tail_start = 0
+		self.bandpassed = np.zeros(0)
+		self.integrated = np.zeros(0)
+		self.scanned = 0		#local maxima before this sample have been dealt with
+		self.pending = None		#[sample, value] of the last local maximum, until the refractory period after it is in
+
+		self.signal_level = None
+		self.noise_level = None
+		self.last_beat = None
+		self.rr_intervals = collections.deque(maxlen=8)
+		self.skipped = []		#[sample, value] of the candidates rejected since the last beat, for search back
+
+	def filter(self, chunk):
+		"""bandpassed and integrated chunk, continuing from the previous ones"""
+		chunk = np.asarray(chunk, np.float64)
+		if self.sos_state is None:
+			#start as if the signal had always been at its first value
+			self.sos_state = scipy.signal.sosfilt_zi(self.sos) * chunk[0]
+		[bandpassed, self.sos_state] = scipy.signal.sosfilt(self.sos, chunk, zi=self.sos_state)
+		#the derivative and the integration are FIR filters: a convolution over the chunk and the inputs before it
+		#does them (lfilter takes several times longer on chunks this short)
+		inputs = np.concatenate([self.derivative_state, bandpassed])
+		self.derivative_state = inputs[len(inputs)-len(self.derivative)+1:]
+		derivative = np.convolve(inputs, self.derivative, 'valid')
+		np.square(derivative, out=derivative)
+		inputs = np.concatenate([self.window_state, derivative])
+		self.window_state = inputs[len(inputs)-self.window+1:]
+		integrated = np.convolve(inputs, self.window_weights, 'valid')
+		return [bandpassed, integrated]
+
+	def process(self, chunk, final=False):
+		"""adds chunk to the stream. returns the R peaks settled so far"""
+		if len(chunk) > 0:
+			[bandpassed, integrated] = self.filter(chunk)
+			self.bandpassed = np.concatenate([self.bandpassed, bandpassed])
+			self.integrated = np.concatenate([self.integrated, integrated])
+		if self.signal_level is None:
+			if len(self.integrated) < self.num_learning and not final:
+				return np.zeros(0, np.int64)
+			learning = self.integrated[0:self.num_learning]
+			self.signal_level = 0.25 * np.max(learning)
+			self.noise_level = 0.5 * np.mean(learning)
+
+		#a local maximum is known once a different sample follows it (a flat top could go on in the next chunk)
+		end = self.tail_start + len(self.integrated)
+		known = end
+		if not final:
+			changes = np.flatnonzero(self.integrated[1:] != self.integrated[:-1])
+			known = self.tail_start + (changes[-1] + 1 if len(changes) > 0 else 0)
+		peaks = scipy.signal.find_peaks(self.integrated)[0] + self.tail_start
+		peaks = peaks[(peaks >= self.scanned) & (peaks < known)]
+
+		#the refractory period over the local maxima in stream order, rather than find_peaks' distance, which goes
+		#by height over the whole array: its choices near the end of one chunk could change with the next
+		beats = []
+		for peak in peaks:
+			value = self.integrated[peak - self.tail_start]
+			if self.pending is not None and peak - self.pending[0] < self.refractory:
+				if value > self.pending[1]:
+					self.pending = [peak, value]
+				continue
+			if self.pending is not None:
+				beats += self.check_candidate(self.pending[0])
+			self.pending = [peak, value]
+		self.scanned = max(self.scanned, known)
+		if self.pending is not None and (final or self.pending[0] + self.refractory <= self.scanned):
+			beats += self.check_candidate(self.pending[0])
+			self.pending = None
+		r_peaks = self.get_r_peaks(np.array(beats, np.int64))
+
+		#keep what is needed to find the R peaks of the candidates still to come, and of those search back may take
+		keep_from = self.scanned
+		if self.pending is not None:
+			keep_from = min(keep_from, self.pending[0])
+		if len(self.skipped) > 0:
+			keep_from = min(keep_from, self.skipped[0][0])
+		keep_from = max(min(keep_from, end) - self.window - self.derivative_delay - 1, self.tail_start)
+		self.bandpassed = self.bandpassed[keep_from-self.tail_start:]
+		self.integrated = self.integrated[keep_from-self.tail_start:]
+		self.tail_start = keep_from
+		return r_peaks
+
+	def flush(self):
+		"""the R peaks still unsettled at the end of the stream"""
+		return self.process(np.zeros(0), final=True)
+
+	def check_candidate(self, candidate):
+		"""beats (integrated peaks) found at candidate: none, it, and/or one found by search back before it"""
+		beats = []
+		value = self.integrated[candidate - self.tail_start]
+		threshold = self.noise_level + 0.25 * (self.signal_level - self.noise_level)
+
+		#no beat for too long: take the best of the candidates skipped since the last one, if it's high enough
+		if self.last_beat is not None and len(self.skipped) > 0 and len(self.rr_intervals) > 0:
+			if candidate - self.last_beat > 1.66 * np.mean(self.rr_intervals):
+				[sample, skipped_value] = max(self.skipped, key=lambda skipped: skipped[1])
+				if skipped_value > 0.5 * threshold:
+					self.signal_level = 0.25 * skipped_value + 0.75 * self.signal_level
+					beats += [self.add_beat(sample)]
+					threshold = self.noise_level + 0.25 * (self.signal_level - self.noise_level)
+
+		if self.last_beat is not None and candidate - self.last_beat < self.refractory:
+			return beats
+		if value > threshold:
+			self.signal_level = 0.125 * value + 0.875 * self.signal_level
+			beats += [self.add_beat(candidate)]
+		else:
+			self.noise_level = 0.125 * value + 0.875 * self.noise_level
+			#search back only looks a few seconds back (so a flat signal doesn't pile up candidates)
+			self.skipped = [skipped for skipped in self.skipped if skipped[0] > candidate - self.max_search_back] + [[candidate, value]]
+		return beats
+
+	def add_beat(self, sample):
+		if self.last_beat is not None:
+			self.rr_intervals.append(sample - self.last_beat)
+		self.last_beat = sample
+		self.skipped = []
+		return sample
+
+	def get_r_peaks(self, beats):
+		"""the R peak of each integrated peak: the largest bandpassed sample (either sign) in the integration window
+		   before it, shifted back by the bandpass delay"""
+		if len(beats) == 0:
+			return beats
+		ends = beats - self.derivative_delay - self.tail_start + 1
+		starts = np.maximum(ends - self.window, 0)
+		offsets = np.arange(-self.window, 0)
+		#windows shorter than the integration window (at the very start) are padded with their first sample
+		indices = np.maximum(ends[:,np.newaxis] + offsets, starts[:,np.newaxis])
+		peaks = self.tail_start + indices[np.arange(len(beats)), np.argmax(np.abs(self.bandpassed[indices]), axis=1)]
+		return np.maximum(peaks - self.bandpass_delay, 0)
+
+
+def pan_tompkins(signal, fs):
+	"""sample indices of the R peaks in signal (e.g. channel 0 from read_data_file), with PanTompkins"""
+	detector = PanTompkins(fs)
+	return np.concatenate([detector.process(signal), detector.flush()])
+
+
+def get_detection_accuracy(detected, reference, tolerance):
+	"""[true positives, false positives, false negatives] of detected R peaks against reference beats (both sorted
+	   sample indices): a reference beat is found if a detection is within tolerance samples of it"""
+	if len(detected) == 0 or len(reference) == 0:
+		return [0, len(detected), len(reference)]
+	#the reference beat nearest to each detection
+	after = np.clip(np.searchsorted(reference, detected), 1, len(reference) - 1)
+	nearest = np.where(detected - reference[after-1] <= reference[after] - detected, after - 1, after)
+	hits = np.abs(reference[nearest] - detected) <= tolerance
+	true_positives = len(np.unique(nearest[hits]))
+	return [true_positives, len(detected) - true_positives, len(reference) - true_positives]
+
+
+def get_record_chunks(database, record_name, chunk_size, channel=0):
+	"""yields the samples of a record chunk_size at a time, as if it came in live"""
+	signal = database.get_signals(record_name, channel)
+	for start in range(0, len(signal), chunk_size):
+		yield signal[start:start+chunk_size]
+
+
+class BeatStream:
+	"""Classifies the beats of a signal that comes in chunk by chunk (a long record, or a live one), in constant
+	   memory. Every chunk goes through one beat detector that keeps its state from chunk to chunk, and into a ring
+	   buffer that holds the last few seconds. Once the detector has settled a beat and its window is all in, the
+	   window is copied out, and windows go through net batch_size at a time (larger batches are faster, smaller
+	   ones give annotations sooner).
+
+	   net takes windows of window_size samples, starting offset samples before the beat (centered by default), as
+	   trained on get_beats(..., normalize=normalize). detector has process(chunk) and flush() like PanTompkins
+	   (a PanTompkins(fs) by default), returning the beats it settled as sample indices from the start of the
+	   stream, in order. It may settle a beat up to lookback seconds after it (PanTompkins' search back looks 3 s
+	   back). classes maps the net's outputs to labels (e.g. anntypes); by default the labels are the output indices.
+
+	   process(chunk) returns the annotations it completed, as (samples, labels, probabilities): samples from
+	   the beginning of the stream, and the probability of each label. flush() classifies the beats still waiting,
+	   at the end of the stream."""
+
+	def __init__(self, net, window_size, fs=360, detector=None, offset=None, normalize=True, classes=None,
+	             batch_size=64, max_chunk_size=None, lookback=4.0):
+		if offset is None:
+			offset = window_size // 2
+		if max_chunk_size is None:
+			max_chunk_size = int(fs)
+		if detector is None:
+			detector = PanTompkins(fs)
+		self.net = net
+		self.window_size = window_size
+		self.fs = fs
+		self.detector = detector
+		self.offset = offset
+		self.normalize = normalize
+		self.classes = classes
+		self.batch_size = batch_size
+		self.max_chunk_size = max_chunk_size
+
+		#the ring buffer: sample i of the stream is at ring[i % capacity], for the last capacity samples. it holds
+		#the window of a beat settled lookback seconds late, after the largest chunk
+		self.capacity = int(lookback * fs) + max_chunk_size + window_size
+		self.ring = np.zeros(self.capacity, np.float64)
+		self.window_offsets = np.arange(window_size) - offset
+
+		#beats settled by the detector whose window isn't all in yet
+		self.pending = np.zeros(0, np.int64)
+
+		#beats waiting for a full batch, and their windows
+		self.beats = np.zeros(batch_size, np.int64)
+		self.windows = np.zeros((batch_size, window_size), np.float64)
+		self.num_waiting = 0
+
+		self.num_samples = 0		#samples in so far
+
+	def process(self, chunk):
+		"""adds chunk to the stream. returns (samples, labels, probabilities) of the beats classified on the way"""
+		results = []
+		for start in range(0, len(chunk), self.max_chunk_size):
+			piece = chunk[start:start+self.max_chunk_size]
+			self.add_samples(piece)
+			results += self.add_beats(self.detector.process(piece))
+		return self.concatenate(results)
+
+	def flush(self):
+		"""classifies the beats still waiting, at the end of the stream (those whose window can't be all in are left out)"""
+		results = self.add_beats(self.detector.flush())
+		if self.num_waiting > 0:
+			results += [self.classify()]
+		return self.concatenate(results)
+
+	def add_samples(self, samples):
+		"""copies samples (at most max_chunk_size) into the ring buffer, in at most two slices"""
+		position = self.num_samples % self.capacity
+		first = min(len(samples), self.capacity - position)
+		self.ring[position:position+first] = samples[0:first]
+		self.ring[0:len(samples)-first] = samples[first:]
+		self.num_samples += len(samples)
+
+	def add_beats(self, beats):
+		"""queues beats settled by the detector, and copies out the windows of the queued beats that are all in.
+		   returns the results of the batches that filled up"""
+		if len(beats) > 0:
+			self.pending = np.concatenate([self.pending, np.asarray(beats, np.int64)])
+		#a beat too early in the stream for its window is left out, and so is one settled too late for the ring
+		#buffer to still hold its window
+		in_ring = self.pending - self.offset >= max(self.num_samples - self.capacity, 0)
+		self.pending = self.pending[in_ring]
+		num_ready = np.searchsorted(self.pending, self.num_samples - (self.window_size - self.offset), side='right')
+		beats = self.pending[0:num_ready]
+		self.pending = self.pending[num_ready:]
+
+		results = []
+		while len(beats) > 0:
+			count = min(len(beats), self.batch_size - self.num_waiting)
+			waiting = slice(self.num_waiting, self.num_waiting + count)
+			self.beats[waiting] = beats[0:count]
+			np.take(self.ring, (beats[0:count,np.newaxis] + self.window_offsets) % self.capacity, out=self.windows[waiting])
+			self.num_waiting += count
+			beats = beats[count:]
+			if self.num_waiting == self.batch_size:
+				results += [self.classify()]
+		return results
+
+	def classify(self):
+		"""runs the waiting beats through the net"""
+		count = self.num_waiting
+		windows = self.windows[0:count]
+		if self.normalize:
+			normalize_windows(windows)
+		probabilities = self.net.predict_proba(windows.T, chunk_size=self.batch_size)
+		outputs = np.argmax(probabilities, axis=0)
+		labels = outputs
+		if self.classes is not None:
+			labels = np.asarray(self.classes)[outputs]
+		self.num_waiting = 0
+		return (self.beats[0:count].copy(), labels, probabilities[outputs, np.arange(count)])
+
+	def concatenate(self, results):
+		if len(results) == 0:
+			return (np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0))
+		return tuple([np.concatenate(parts) for parts in zip(*results)])
+
+
+def classify_stream(net, chunks, window_size, **kwargs):
+	"""yields (samples, labels, probabilities) of the beats in chunks (an iterable of signal chunks, e.g.
+	   get_record_chunks) as they are classified. kwargs go to BeatStream"""
+	stream = BeatStream(net, window_size, **kwargs)
+	for chunk in chunks:
+		annotations = stream.process(chunk)
+		if len(annotations[0]) > 0:
+			yield annotations
+	annotations = stream.flush()
+	if len(annotations[0]) > 0:
+		yield annotations
+
+
+
+
 if __name__=='__main__':
 	main()
 
@@ -1,32 +1,336 @@
-import urllib
+import os
+import sys
+import time
+import shutil
+import hashlib
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+import concurrent.futures
 
-#ONLY WORKS WITH python2 ...
+#Downloads the MITBIH arrhythmia records (.dat, .atr and .hea files) next to this script, num_workers at a time.
+#Files that are already here with the right checksum are skipped (with the right size, if the source has no
+#checksums), and partial downloads (.part files) are resumed with range requests. The source can also be a mirror:
+#a file:// URL or a local directory laid out the same way.
+#
+#usage: python download_data.py [--source=URL or directory] [--dest=directory] [--workers=N]
 
-#all records are within this range. not every integer in the range corresponds to a record, but we'll deal
+source_url = 'https://physionet.org/files/mitdb/1.0.0/'
+checksum_file = 'SHA256SUMS.txt'	#sha256 and name of every file of the database
+records_file = 'RECORDS'		#the record names, one per line
+
+extensions = ['.dat', '.atr', '.hea']
+
+#if the source lists neither checksums nor records: all records are within this range. not every integer in the
+#range corresponds to a record, but we'll deal
 record_start = 100
 record_end = 234
 
+num_retries = 4
+block_size = 1 << 16
 
-def main():
-	for i in range(record_start, record_end+1):
-		url = 'http://www.physionet.org/physiobank/database/mitdb/'
 
-		ind = str(i)	
+class HttpSource:
+	"""files under an http(s) URL. Each thread keeps one connection open and reuses it for all of its requests.
+	   close() closes them all, once the threads are done"""
+
+	def __init__(self, url):
+		self.url = url
+		self.connections = threading.local()
+		#every connection opened, whichever thread it belongs to, for close()
+		self.all_connections = []
+		self.lock = threading.Lock()
+
+	def get_connection(self, parts):
+		key = (parts.scheme, parts.netloc)
+		connection = getattr(self.connections, 'connection', None)
+		if connection is None or self.connections.key != key:
+			if connection is not None:
+				connection.close()
+			if parts.scheme == 'https':
+				connection = http.client.HTTPSConnection(parts.netloc, timeout=60)
+			else:
+				connection = http.client.HTTPConnection(parts.netloc, timeout=60)
+			with self.lock:
+				self.all_connections.append(connection)
+			self.connections.connection = connection
+			self.connections.key = key
+		return connection
+
+	def close_connection(self):
+		"""closes the connection of the calling thread"""
+		connection = getattr(self.connections, 'connection', None)
+		if connection is not None:
+			connection.close()
+			self.connections.connection = None
+			with self.lock:
+				self.all_connections.remove(connection)
+
+	def close(self):
+		"""closes the connections of all threads"""
+		with self.lock:
+			for connection in self.all_connections:
+				connection.close()
+			self.all_connections = []
+
+	def send(self, method, name, headers):
+		"""[URL, response] of method name, after redirects. None if there is no such file"""
+		url = urllib.parse.urljoin(self.url, name)
+		for redirect in range(0, 5):
+			parts = urllib.parse.urlsplit(url)
+			path = parts.path + ('?' + parts.query if parts.query else '')
+			connection = self.get_connection(parts)
+			try:
+				connection.request(method, path, headers=headers)
+				response = connection.getresponse()
+			except (http.client.HTTPException, OSError):
+				#e.g. the server closed a connection that was kept open: the retry gets a new one
+				self.close_connection()
+				raise
+
+			if response.status in [301, 302, 303, 307, 308]:
+				response.read()
+				url = urllib.parse.urljoin(url, response.getheader('Location'))
+				continue
+			if response.status == 404:
+				response.read()
+				return None
+			return [url, response]
+		raise IOError('%s: too many redirects' % url)
+
+	def request(self, name, offset=0):
+		"""[response, whether it starts at offset, its length (None if unknown)] for GET name, from offset on if the
+		   server can do that. None if there is no such file. The response must be read to the end before the next
+		   request"""
+		headers = {}
+		if offset > 0:
+			headers['Range'] = 'bytes=%d-' % offset
+		result = self.send('GET', name, headers)
+		if result is None:
+			return None
+		[url, response] = result
+		if response.status == 416:
+			#nothing after offset: the partial file is (at least) complete
+			response.read()
+			return [EmptyResponse(), True, 0]
+		if response.status not in [200, 206]:
+			response.read()
+			raise IOError('%s: HTTP %d %s' % (url, response.status, response.reason))
+		length = response.getheader('Content-Length')
+		return [response, response.status == 206, int(length) if length is not None else None]
+
+	def get_size(self, name):
+		"""size of name from a HEAD request, or None if the server doesn't say (or has no such file)"""
+		result = self.send('HEAD', name, {})
+		if result is None:
+			return None
+		[url, response] = result
+		response.read()
+		length = response.getheader('Content-Length')
+		if response.status != 200 or length is None:
+			return None
+		return int(length)
+
+
+class EmptyResponse:
+	def read(self, size=-1):
+		return b''
+
+
+class LocalSource:
+	"""files in a local directory (or under a file:// URL), e.g. a mirror of the database"""
+
+	def __init__(self, path):
+		self.path = path
+
+	def request(self, name, offset=0):
+		"""like HttpSource.request"""
+		file_path = os.path.join(self.path, name)
+		if not os.path.isfile(file_path):
+			return None
+		f = open(file_path, 'rb')
+		f.seek(offset)
+		return [f, True, max(os.path.getsize(file_path) - offset, 0)]
+
+	def get_size(self, name):
+		"""like HttpSource.get_size"""
+		file_path = os.path.join(self.path, name)
+		if not os.path.isfile(file_path):
+			return None
+		return os.path.getsize(file_path)
+
+	def close(self):
+		pass
+
 
-		data = ind + '.dat'
-		annotation = ind + '.atr'
-		header = ind + '.hea'
+def get_source(url):
+	"""HttpSource or LocalSource for url (an http(s) or file:// URL, or a directory)"""
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme in ['http', 'https']:
+		if not url.endswith('/'):
+			url += '/'
+		return HttpSource(url)
+	if parts.scheme == 'file':
+		return LocalSource(urllib.request.url2pathname(parts.path))
+	return LocalSource(url)
 
-		data_url = url + ind + '.dat'
-		annotation_url = url + ind + '.atr'
-		header_url = url + ind + '.hea'
 
-		ret = urllib.urlopen(header_url)
-		if ret.code == 200:
-			#file exists
-			urllib.urlretrieve( data_url, data )
-			urllib.urlretrieve( annotation_url, annotation )
-			urllib.urlretrieve( header_url, header )
+def read_text(source, name):
+	"""contents of a small text file of source, or None if it has none"""
+	result = source.request(name)
+	if result is None:
+		return None
+	[response, partial, length] = result
+	try:
+		return response.read().decode('utf-8')
+	finally:
+		if hasattr(response, 'close'):
+			response.close()
+
+
+def get_file_list(source):
+	"""{name: sha256 (None if unknown)} of the files to download"""
+	checksums = read_text(source, checksum_file)
+	if checksums is not None:
+		files = {}
+		for line in checksums.splitlines():
+			fields = line.split()
+			if len(fields) == 2 and os.path.splitext(fields[1])[1] in extensions and '/' not in fields[1]:
+				files[fields[1]] = fields[0].lower()
+		return files
+
+	print('%s has no %s: files will not be verified' % (source_name(source), checksum_file))
+	records = read_text(source, records_file)
+	if records is not None:
+		names = [line.strip() for line in records.splitlines() if line.strip()]
+	else:
+		names = [str(i) for i in range(record_start, record_end+1)]
+	return dict([(name + extension, None) for name in names for extension in extensions])
+
+
+def source_name(source):
+	if isinstance(source, HttpSource):
+		return source.url
+	return source.path
+
+
+def get_sha256(file_path):
+	sha256 = hashlib.sha256()
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			sha256.update(block)
+	return sha256.hexdigest()
+
+
+def is_complete(source, name, checksum, file_path):
+	"""whether file_path holds all of name: the right checksum or, without one, the size the source gives"""
+	if checksum is not None:
+		return get_sha256(file_path) == checksum
+	#e.g. a file cut short by a download that didn't go through a .part file
+	try:
+		size = source.get_size(name)
+	except (http.client.HTTPException, OSError):
+		if isinstance(source, HttpSource):
+			source.close_connection()
+		return False
+	return size is None or os.path.getsize(file_path) == size
+
+
+def download_file(source, name, checksum, dest_dir):
+	"""Downloads name into dest_dir unless it is there already (with the right checksum, or the right size if there
+	   is none). Returns what happened: 'present', 'downloaded', 'resumed' or 'missing' (the source has no such file)"""
+	file_path = os.path.join(dest_dir, name)
+	part_path = file_path + '.part'
+	if os.path.exists(file_path) and is_complete(source, name, checksum, file_path):
+		if os.path.exists(part_path):
+			os.remove(part_path)
+		return 'present'
+
+	#the file goes to a .part file first, so an interrupted download is never taken for a complete one
+	resumed = False
+	for attempt in range(0, num_retries + 1):
+		offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+		try:
+			result = source.request(name, offset)
+			if result is None:
+				return 'missing'
+			[response, partial, length] = result
+			try:
+				#a server that ignores the range sends the whole file again
+				mode = 'ab' if partial else 'wb'
+				resumed = resumed or (partial and offset > 0)
+				with open(part_path, mode) as f:
+					start = f.tell()
+					shutil.copyfileobj(response, f, block_size)
+					received = f.tell() - start
+			finally:
+				if hasattr(response, 'close'):
+					response.close()
+			if length is not None and received < length:
+				#the connection dropped: what did arrive stays in the .part file, for the retry to resume from
+				raise IOError('got %d of %d bytes' % (received, length))
+		except (http.client.HTTPException, OSError) as error:
+			if isinstance(source, HttpSource):
+				source.close_connection()
+			if attempt == num_retries:
+				raise
+			print('%s: %s, retrying' % (name, error))
+			time.sleep(2 ** attempt)
+			continue
+
+		if checksum is not None and get_sha256(part_path) != checksum:
+			#corrupt (or resumed from a different version of the file): start over
+			print('%s: checksum mismatch, downloading again' % name)
+			os.remove(part_path)
+			resumed = False
+			continue
+		os.replace(part_path, file_path)
+		return 'resumed' if resumed else 'downloaded'
+
+	raise IOError('%s: checksum still wrong after %d attempts' % (name, num_retries + 1))
+
+
+def download(url=source_url, dest_dir=None, num_workers=8):
+	"""downloads every file of the database at url into dest_dir (the directory of this script by default).
+	   returns {name: what happened} (see download_file)"""
+	if dest_dir is None:
+		dest_dir = os.path.dirname(os.path.abspath(__file__))
+	os.makedirs(dest_dir, exist_ok=True)
+	source = get_source(url)
+	results = {}
+	try:
+		files = get_file_list(source)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+			futures = dict([(executor.submit(download_file, source, name, checksum, dest_dir), name) for (name, checksum) in sorted(files.items())])
+			for future in concurrent.futures.as_completed(futures):
+				results[futures[future]] = future.result()
+	finally:
+		#the worker threads are done: close the connections they kept open
+		source.close()
+
+	counts = {}
+	for outcome in results.values():
+		counts[outcome] = counts.get(outcome, 0) + 1
+	print('%d files: %s' % (len(results), ', '.join(['%d %s' % (count, outcome) for (outcome, count) in sorted(counts.items())])))
+	return results
+
+
+def main():
+	url = source_url
+	dest_dir = None
+	num_workers = 8
+	for arg in sys.argv[1:]:
+		if arg.startswith('--source='):
+			url = arg[len('--source='):]
+		elif arg.startswith('--dest='):
+			dest_dir = arg[len('--dest='):]
+		elif arg.startswith('--workers='):
+			num_workers = int(arg[len('--workers='):])
+		else:
+			print('Unknown argument %s. usage: python download_data.py [--source=URL or directory] [--dest=directory] [--workers=N]' % arg)
+			sys.exit()
+	download(url, dest_dir, num_workers)
 
 
 
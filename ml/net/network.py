@@ -0,0 +1,260 @@
+from base import *
+from profiler import get_forward_flops, get_output_Dez_flops, get_gradient_flops, get_backward_flops, get_update_flops
+from profiler import get_activation_flops, get_loss_flops, get_derivative_flops
+
+
+class Network:
+	"""A stack of connected layers (bottom to top), run through a plan compiled once instead of recursing through
+	   layer_above/layer_below on every batch. Indexing and iteration give the layers, like the plain lists used before."""
+
+	def __init__(self, layers):
+		assert(len(layers) >= 2)
+		for (layer, layer_above) in zip(layers[0:-1], layers[1:]):
+			assert(layer.layer_above is layer_above)
+		assert(layers[0].layer_below is None)
+		assert(layers[-1].layer_above is None)
+
+		self.layers = list(layers)
+		self.profiler = None
+		self.num_accumulated = 0		#samples whose gradients are in the accumulators, waiting for apply_gradients
+		self.compile()
+
+	def __len__(self):
+		return len(self.layers)
+
+	def __getitem__(self, index):
+		return self.layers[index]
+
+	def __iter__(self):
+		return iter(self.layers)
+
+
+	def compile(self):
+		"""Builds the execution plan: the kernel each layer runs on the forward pass, on the backward pass (top to
+		   bottom), and for the weight update. Call again if layers are reconnected."""
+		for layer in self.layers:
+			layer.compile()
+
+		input_layer = self.layers[0]
+		output_layer = self.layers[-1]
+		assert(input_layer.layer_type in ['input', 'embedding'])
+		assert(output_layer.neuron_type == 'softmax')
+
+		#each step is [kernel, layer, phase, flop estimate] (the rest is for the profiler)
+		if output_layer.loss is None:
+			#forward: each kernel takes what the one below returned
+			forward = [[input_layer.forward_input, input_layer, 'forward', get_forward_flops]]
+			forward += [[layer.forward_hidden, layer, 'forward', get_forward_flops] for layer in self.layers[1:-1]]
+			forward += [[output_layer.forward_output, output_layer, 'forward', get_forward_flops]]
+
+			#backward: dE/dz of the output layer comes from the targets, then each kernel takes the dE/dz of the layer above
+			backward = [[output_layer.get_output_Dez, output_layer, 'backward', get_output_Dez_flops]]
+			backward += [[layer.backward_hidden, layer, 'backward', get_backward_flops] for layer in reversed(self.layers[1:-1])]
+			backward += [[input_layer.get_gradients, input_layer, 'backward', get_gradient_flops]]
+		else:
+			#the output layer's loss only computes the outputs it needs, from the targets: the forward pass stops at
+			#the y of the layer below, and the loss gives that layer's dE/dy (and the gradients of its weights)
+			top_layer = self.layers[-2]
+			forward = []
+			backward = [[output_layer.get_loss_Dey, output_layer, 'backward', get_loss_flops]]
+			if len(self.layers) > 2:
+				forward += [[input_layer.forward_input, input_layer, 'forward', get_forward_flops]]
+				forward += [[layer.forward_hidden, layer, 'forward', get_forward_flops] for layer in self.layers[1:-2]]
+				backward += [[top_layer.backward_from_loss, top_layer, 'backward', get_derivative_flops]]
+				backward += [[layer.backward_hidden, layer, 'backward', get_backward_flops] for layer in reversed(self.layers[1:-2])]
+				backward += [[input_layer.get_gradients, input_layer, 'backward', get_gradient_flops]]
+			forward += [[top_layer.forward_to_loss, top_layer, 'forward', get_activation_flops]]
+
+		#update: only layers with outgoing weights that can change
+		update = [[layer.update_weights, layer, 'update', get_update_flops] for layer in self.layers if len(layer.params) > 0]
+
+		self.forward_plan = self.get_plan(forward, True)
+		self.backward_plan = self.get_plan(backward)
+		self.update_plan = self.get_plan(update)
+		self.params = [param for layer in self.layers for param in layer.params]
+
+		#inference: forward steps up to the net input of the output layer, without training bookkeeping
+		self.inference_plan = [layer.infer for layer in self.layers[0:-1]]
+
+
+	def get_plan(self, steps, begins_batch=False):
+		"""the kernels of steps, wrapped by the profiler if there is one"""
+		if self.profiler is None:
+			return [kernel for [kernel, layer, phase, get_flops] in steps]
+		return [self.profiler.wrap(kernel, layer, phase, get_flops, begins_batch and istep == 0) for (istep, [kernel, layer, phase, get_flops]) in enumerate(steps)]
+
+	def set_profiler(self, profiler):
+		"""records every step of forward/backward/update with profiler (see profiler.Profiler). None turns it off"""
+		if self.profiler is not None:
+			self.profiler.disable()
+		self.profiler = profiler
+		if profiler is not None:
+			profiler.enable()
+		self.compile()
+
+
+	def set_buffer_reuse(self, reuse=True):
+		for layer in self.layers:
+			layer.set_buffer_reuse(reuse)
+
+
+	def forward(self, inputs):
+		"""forward pass; returns the output layer's y"""
+		result = inputs
+		for step in self.forward_plan:
+			result = step(result)
+		return result
+
+	def backward(self, targets):
+		"""gradients of all weights, computed before any of them change"""
+		Dez = targets
+		for step in self.backward_plan:
+			Dez = step(Dez)
+
+	def update(self):
+		for step in self.update_plan:
+			step()
+
+	def train_batch(self, inputs, targets, micro_batch_size=None):
+		"""One gradient step on a batch (samples in columns). With a micro_batch_size, the batch goes through the
+		   net that many samples at a time and their gradients are accumulated, so activations only ever take up
+		   micro_batch_size columns. The step is the same as for the whole batch at once, up to rounding."""
+		if micro_batch_size is None or micro_batch_size >= inputs.shape[1]:
+			self.forward(inputs)
+			self.backward(targets)
+			self.update()
+			return
+
+		for start in range(0, inputs.shape[1], micro_batch_size):
+			self.accumulate_gradients(inputs[:, start:start+micro_batch_size], targets[..., start:start+micro_batch_size])
+		self.apply_gradients()
+
+	def accumulate_gradients(self, inputs, targets):
+		"""forward and backward pass on a micro-batch, adding its gradients to those accumulated so far (in arrays
+		   allocated once per parameter) instead of updating the weights"""
+		self.forward(inputs)
+		self.backward(targets)
+		num_samples = inputs.shape[1]
+		for param in self.params:
+			#Dew is the average over the micro-batch: weigh it by its number of samples
+			param.add_Dew_to(param.get_accumulator(), num_samples)
+		self.num_accumulated += num_samples
+
+	def apply_gradients(self):
+		"""one update with the average gradient over all samples accumulated since the last one"""
+		assert(self.num_accumulated > 0)
+		for param in self.params:
+			param.accumulator /= float(self.num_accumulated)
+			param.set_Dew(param.accumulator)
+		self.update()
+
+		for param in self.params:
+			param.accumulator[...] = 0.0
+			param.set_Dew(None)
+		self.num_accumulated = 0
+
+
+	def fit(self, get_batches, num_epochs=1, callback=None, accumulate=1):
+		"""Trains for num_epochs. get_batches() is called once per epoch and returns an iterable of (inputs, targets).
+		   callback(iepoch, ibatch, inputs, targets), if given, is called after every batch; training stops early
+		   if it returns True.
+
+		   With accumulate > 1, the batches are micro-batches: their gradients are accumulated and applied once
+		   every `accumulate` batches (and at the end of an epoch), for an effective batch size that many times
+		   larger without the memory that would take."""
+		assert(accumulate >= 1)
+		for iepoch in range(0, num_epochs):
+			for (ibatch, (inputs, targets)) in enumerate(get_batches()):
+				if accumulate == 1:
+					self.train_batch(inputs, targets)
+				else:
+					self.accumulate_gradients(inputs, targets)
+					if (ibatch + 1) % accumulate == 0:
+						self.apply_gradients()
+
+				if callback is not None and callback(iepoch, ibatch, inputs, targets):
+					if self.num_accumulated > 0:
+						self.apply_gradients()
+					return
+
+			if self.num_accumulated > 0:
+				self.apply_gradients()
+
+	def get_output_z(self, inputs, chunk_size):
+		"""yields [start, end, z]: the net input to the output layer for samples [start, end) of inputs (samples in
+		   columns), chunk_size samples at a time. z is overwritten by the next chunk"""
+		num_samples = inputs.shape[1]
+		for start in range(0, num_samples, chunk_size):
+			end = min(start + chunk_size, num_samples)
+			result = inputs[:, start:end]
+			for step in self.inference_plan:
+				result = step(result)
+			yield [start, end, result]
+
+	def predict_proba(self, inputs, chunk_size=1024):
+		"""output probabilities (classes x samples), computed chunk_size samples at a time"""
+		output_layer = self.layers[-1]
+		result = np.empty((output_layer.num_neurons, inputs.shape[1]), output_layer.dtype)
+		column = output_layer.inference_buffers.get('column', (1, chunk_size))
+		spread = output_layer.inference_buffers.get('spread', (output_layer.num_neurons, chunk_size))
+		for [start, end, z] in self.get_output_z(inputs, chunk_size):
+			get_softmax(z, out=result[:, start:end], column=column[:, 0:end-start], spread=spread[:, 0:end-start])
+		return result
+
+	def predict(self, inputs, chunk_size=1024):
+		"""index of the most probable class of each sample (softmax is monotonic, so this is the argmax of z)"""
+		result = np.empty(inputs.shape[1], np.int64)
+		for [start, end, z] in self.get_output_z(inputs, chunk_size):
+			np.argmax(z, axis=0, out=result[start:end])
+		return result
+
+	def top_k(self, inputs, k, chunk_size=1024, return_proba=False):
+		"""(k x samples) indices of the k most probable classes of each sample, most probable first. With return_proba,
+		   returns [indices, probabilities]. Only the top k of each sample are sorted (argpartition does the rest)"""
+		output_layer = self.layers[-1]
+		num_classes = output_layer.num_neurons
+		assert(1 <= k <= num_classes)
+
+		num_samples = inputs.shape[1]
+		indices = np.empty((k, num_samples), np.int64)
+		probabilities = None
+		if return_proba:
+			probabilities = np.empty((k, num_samples), output_layer.dtype)
+
+		for [start, end, z] in self.get_output_z(inputs, chunk_size):
+			samples = np.arange(end - start)
+			if k < num_classes:
+				top = np.argpartition(z, num_classes - k, axis=0)[num_classes-k:]
+			else:
+				top = np.broadcast_to(np.arange(num_classes)[:,np.newaxis], z.shape)
+			top_z = z[top, samples]
+
+			#most probable first
+			order = np.argsort(-top_z, axis=0)
+			indices[:, start:end] = top[order, samples]
+			if return_proba:
+				#log of the softmax normalizer of each column, from all of z
+				shift = np.max(z, axis=0)
+				log_sum = shift + np.log(np.sum(np.exp(z - shift), axis=0))
+				probabilities[:, start:end] = np.exp(top_z[order, samples] - log_sum)
+
+		if return_proba:
+			return [indices, probabilities]
+		return indices
+
+	def evaluate(self, inputs, targets, chunk_size=1024):
+		"""Average cross-entropy of the net on inputs (samples in columns), computed chunk_size samples at a time on
+		   the inference path. The training state of the layers (y, z_below...) is left alone. targets are one-hot
+		   (classes x samples) or class indices. With a sampled/hierarchical loss this is still the exact cost"""
+		total = 0.0
+		for [start, end, z] in self.get_output_z(inputs, chunk_size):
+			if targets.ndim == 1:
+				#class indices
+				total -= np.sum(get_log_softmax(z)[targets[start:end], np.arange(end - start)])
+			else:
+				total -= np.sum(targets[:, start:end] * get_log_softmax(z))
+		return total / float(inputs.shape[1])
+
+	def get_cost(self, targets):
+		"""cross-entropy of the last forward pass (with a sampled/hierarchical loss: the training cost of the last batch)"""
+		return self.layers[-1].get_cost(targets)
@@ -0,0 +1,283 @@
+import numpy as np
+import math
+import sys
+
+
+#########################################
+######## LEARNING RATE SCHEDULES ########
+#########################################
+
+#A schedule gives the factor the base learning rate is multiplied by at a given step (1 for the first update)
+
+class ConstantSchedule:
+	def __call__(self, step):
+		return 1.0
+
+	def get_config(self):
+		return {'type': 'ConstantSchedule'}
+
+
+class StepDecay:
+	"""multiplies the learning rate by gamma every step_size steps"""
+	def __init__(self, step_size, gamma=0.1):
+		self.step_size = step_size
+		self.gamma = gamma
+
+	def __call__(self, step):
+		return self.gamma ** ((step - 1) // self.step_size)
+
+	def get_config(self):
+		return {'type': 'StepDecay', 'step_size': self.step_size, 'gamma': self.gamma}
+
+
+class ExponentialDecay:
+	"""multiplies the learning rate by gamma every step"""
+	def __init__(self, gamma):
+		self.gamma = gamma
+
+	def __call__(self, step):
+		return self.gamma ** (step - 1)
+
+	def get_config(self):
+		return {'type': 'ExponentialDecay', 'gamma': self.gamma}
+
+
+class CosineDecay:
+	"""half a cosine from 1 down to min_factor over num_steps, then min_factor"""
+	def __init__(self, num_steps, min_factor=0.0):
+		self.num_steps = num_steps
+		self.min_factor = min_factor
+
+	def __call__(self, step):
+		progress = min(float(step - 1) / float(self.num_steps), 1.0)
+		return self.min_factor + (1.0 - self.min_factor) * 0.5 * (1.0 + math.cos(math.pi * progress))
+
+	def get_config(self):
+		return {'type': 'CosineDecay', 'num_steps': self.num_steps, 'min_factor': self.min_factor}
+
+
+class LinearWarmup:
+	"""ramps the learning rate up linearly over num_steps, then follows schedule (constant if None)"""
+	def __init__(self, num_steps, schedule=None):
+		self.num_steps = num_steps
+		self.schedule = schedule
+
+	def __call__(self, step):
+		factor = min(float(step) / float(self.num_steps), 1.0)
+		if self.schedule is not None:
+			factor *= self.schedule(step)
+		return factor
+
+	def get_config(self):
+		schedule = None
+		if self.schedule is not None:
+			schedule = self.schedule.get_config()
+		return {'type': 'LinearWarmup', 'num_steps': self.num_steps, 'schedule': schedule}
+
+
+############################
+######## OPTIMIZERS ########
+############################
+
+class ColumnSlice:
+	"""the columns of a parameter that its gradient holds (param.Dew_columns), with copies of their optimizer state,
+	   for get_step to work on like on a whole parameter"""
+	def __init__(self, param, state_names):
+		self.Dew = param.Dew
+		self.state = dict([(name, param.state[name][:, param.Dew_columns]) for name in state_names])
+
+
+class Optimizer:
+	"""Turns the gradients in param.Dew into weight updates. The per-weight state (momentum, squared gradient
+	   averages...) lives in param.state, is allocated once (in the precision of the master weights) and updated in
+	   place. param.state['num_updates'] counts the updates applied so far.
+
+	   Subclasses list their state arrays in state_names and implement get_step(param, learning_rate, step_count, step),
+	   which writes the amount to subtract from the weights into step (step_count is 1 for the first update).
+	   flops_per_weight is roughly what an update costs per weight, for profiling.
+
+	   A gradient that only holds some columns (param.Dew_columns) updates those columns and their state only ('lazy'
+	   momentum/Adam: a column's state only moves on the batches that use it), so the update of a sampled or
+	   hierarchical output layer costs what the batch uses, not the vocabulary size."""
+	state_names = []
+	flops_per_weight = 2
+
+	def __init__(self, schedule=None):
+		self.schedule = schedule
+
+	def init_state(self, param):
+		"""allocates the state of param, if it isn't there yet"""
+		master = param.get_master()
+		if 'num_updates' not in param.state:
+			param.state['num_updates'] = np.zeros(1, np.int64)
+		for name in self.state_names:
+			if name not in param.state:
+				param.state[name] = np.zeros(master.shape, master.dtype)
+
+	def update(self, params, learning_rate):
+		"""applies one update to each parameter, with base learning rate learning_rate"""
+		for param in params:
+			self.init_state(param)
+			param.state['num_updates'] += 1
+			step_count = int(param.state['num_updates'][0])
+			if self.schedule is not None:
+				rate = learning_rate * self.schedule(step_count)
+			else:
+				rate = learning_rate
+
+			master = param.get_master()
+			if param.Dew_columns is None:
+				step = param.get_work_array()
+				self.get_step(param, rate, step_count, step)
+				master -= step
+				param.sync()
+				continue
+
+			columns = param.Dew_columns
+			part = ColumnSlice(param, self.state_names)
+			step = np.empty(param.Dew.shape, master.dtype)
+			self.get_step(part, rate, step_count, step)
+			for name in self.state_names:
+				param.state[name][:, columns] = part.state[name]
+			master[:, columns] -= step
+			param.sync(columns)
+
+	def get_config(self):
+		"""constructor arguments (JSON-friendly), with the class name under 'type'"""
+		config = self.get_hyperparameters()
+		config['type'] = type(self).__name__
+		config['schedule'] = None
+		if self.schedule is not None:
+			config['schedule'] = self.schedule.get_config()
+		return config
+
+
+class SGD(Optimizer):
+	"""gradient descent with (heavy ball) momentum: velocity = momentum*velocity + Dew, W -= learning_rate*velocity.
+	   With nesterov, the step looks ahead along the velocity: W -= learning_rate*(Dew + momentum*velocity)"""
+	state_names = ['velocity']
+	flops_per_weight = 4
+
+	def __init__(self, momentum=0.9, nesterov=False, schedule=None):
+		Optimizer.__init__(self, schedule)
+		self.momentum = momentum
+		self.nesterov = nesterov
+		if momentum == 0:
+			self.state_names = []
+			self.flops_per_weight = 2
+		elif nesterov:
+			self.flops_per_weight = 6
+
+	def get_step(self, param, learning_rate, step_count, step):
+		if self.momentum == 0:
+			np.multiply(param.Dew, learning_rate, out=step)
+			return
+
+		velocity = param.state['velocity']
+		velocity *= self.momentum
+		velocity += param.Dew
+		if self.nesterov:
+			np.multiply(velocity, self.momentum, out=step)
+			step += param.Dew
+			step *= learning_rate
+		else:
+			np.multiply(velocity, learning_rate, out=step)
+
+	def get_hyperparameters(self):
+		return {'momentum': self.momentum, 'nesterov': self.nesterov}
+
+
+def Nesterov(momentum=0.9, schedule=None):
+	return SGD(momentum, nesterov=True, schedule=schedule)
+
+
+class RMSProp(Optimizer):
+	"""divides each gradient by a running average of its magnitude: W -= learning_rate * Dew / (sqrt(mean Dew^2) + epsilon)"""
+	state_names = ['mean_square']
+	flops_per_weight = 9
+
+	def __init__(self, rho=0.9, epsilon=1e-8, schedule=None):
+		Optimizer.__init__(self, schedule)
+		self.rho = rho
+		self.epsilon = epsilon
+
+	def get_step(self, param, learning_rate, step_count, step):
+		mean_square = param.state['mean_square']
+		np.multiply(param.Dew, param.Dew, out=step)
+		step *= 1.0 - self.rho
+		mean_square *= self.rho
+		mean_square += step
+
+		np.sqrt(mean_square, out=step)
+		step += self.epsilon
+		np.divide(param.Dew, step, out=step)
+		step *= learning_rate
+
+	def get_hyperparameters(self):
+		return {'rho': self.rho, 'epsilon': self.epsilon}
+
+
+class Adam(Optimizer):
+	"""Adam (Kingma & Ba): running averages of the gradient and its square, with their bias from starting at zero
+	   corrected for"""
+	state_names = ['mean', 'mean_square']
+	flops_per_weight = 12
+
+	def __init__(self, beta1=0.9, beta2=0.999, epsilon=1e-8, schedule=None):
+		Optimizer.__init__(self, schedule)
+		self.beta1 = beta1
+		self.beta2 = beta2
+		self.epsilon = epsilon
+
+	def get_step(self, param, learning_rate, step_count, step):
+		mean = param.state['mean']
+		mean_square = param.state['mean_square']
+
+		mean *= self.beta1
+		np.multiply(param.Dew, 1.0 - self.beta1, out=step)
+		mean += step
+
+		mean_square *= self.beta2
+		np.multiply(param.Dew, param.Dew, out=step)
+		step *= 1.0 - self.beta2
+		mean_square += step
+
+		#step = learning_rate/(1-beta1^t) * mean / (sqrt(mean_square/(1-beta2^t)) + epsilon)
+		np.sqrt(mean_square, out=step)
+		step *= 1.0 / math.sqrt(1.0 - self.beta2 ** step_count)
+		step += self.epsilon
+		np.divide(mean, step, out=step)
+		step *= learning_rate / (1.0 - self.beta1 ** step_count)
+
+	def get_hyperparameters(self):
+		return {'beta1': self.beta1, 'beta2': self.beta2, 'epsilon': self.epsilon}
+
+
+schedules = {'ConstantSchedule': ConstantSchedule, 'StepDecay': StepDecay, 'ExponentialDecay': ExponentialDecay,
+             'CosineDecay': CosineDecay, 'LinearWarmup': LinearWarmup}
+optimizers = {'SGD': SGD, 'RMSProp': RMSProp, 'Adam': Adam}
+
+
+def get_schedule(config):
+	"""schedule from what get_config() returned"""
+	if config is None:
+		return None
+	config = dict(config)
+	name = config.pop('type')
+	if name not in schedules:
+		print('Unknown learning rate schedule %s' % name)
+		sys.exit()
+	if name == 'LinearWarmup':
+		config['schedule'] = get_schedule(config['schedule'])
+	return schedules[name](**config)
+
+
+def get_optimizer(config):
+	"""optimizer from what get_config() returned"""
+	config = dict(config)
+	name = config.pop('type')
+	if name not in optimizers:
+		print('Unknown optimizer %s' % name)
+		sys.exit()
+	config['schedule'] = get_schedule(config['schedule'])
+	return optimizers[name](**config)
@@ -0,0 +1,226 @@
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+from base import *
+
+
+class SharedArrays:
+	"""numpy arrays carved out of a single block of shared memory. Forked processes see the same memory, so writes
+	   from any process are visible to all of them"""
+	def __init__(self, specs):		#list of (shape, dtype)
+		offsets = []
+		size = 0
+		for (shape, dtype) in specs:
+			size = (size + 63) // 64 * 64		#keep every array cache-line aligned
+			offsets += [size]
+			size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+		self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+		self.arrays = [np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offset) for ((shape, dtype), offset) in zip(specs, offsets)]
+
+	def close(self):
+		#views have to go before the memory can be released
+		self.arrays = []
+		self.memory.close()
+		self.memory.unlink()
+
+
+class ParallelTrainer:
+	"""Data-parallel training of a Network on num_workers forked processes. The weights (W, master weights, and
+	   optimizer state) of every trainable block are moved into shared memory, so all processes work on the same arrays.
+
+	   mode='sync': every batch is split into one shard per worker. Workers write their (shard-weighted) gradients
+	   into per-worker slots in shared memory, the slots are summed in place, and this process applies one update.
+	   Gives the same result as single-process training, up to rounding.
+
+	   mode='hogwild': workers train on whole batches of their own and update the shared weights without locking.
+	   Updates can overlap, which is the point: no process ever waits on another.
+
+	   Needs the 'fork' start method (workers inherit the net). Call close() when done; the weights are then copied
+	   back into ordinary memory, so the net keeps working."""
+
+	def __init__(self, net, num_workers, mode='sync'):
+		assert(num_workers >= 1)
+		assert(mode in ['sync', 'hogwild'])
+		self.net = net
+		self.num_workers = num_workers
+		self.mode = mode
+		self.params = [param for layer in net for param in layer.params]
+
+		self.share_parameters()
+
+		#one gradient slot per worker and parameter (sync mode only)
+		self.gradients = None
+		self.gradient_slots = []
+		if mode == 'sync':
+			specs = [(param.W.shape, param.W.dtype) for param in self.params] * num_workers
+			self.gradients = SharedArrays(specs)
+			num_params = len(self.params)
+			self.gradient_slots = [self.gradients.arrays[i*num_params : (i+1)*num_params] for i in range(0, num_workers)]
+
+		context = multiprocessing.get_context('fork')
+		self.pipes = []
+		self.workers = []
+		for iworker in range(0, num_workers):
+			(pipe, worker_pipe) = context.Pipe()
+			worker = context.Process(target=self.run_worker, args=(iworker, worker_pipe), daemon=True)
+			worker.start()
+			worker_pipe.close()
+			self.pipes += [pipe]
+			self.workers += [worker]
+
+
+	def get_parameter_arrays(self, param):
+		"""[owner, attribute/key] of each array of param that lives in shared memory"""
+		arrays = [[param, 'W']]
+		if param.master is not None:
+			arrays += [[param, 'master']]
+		arrays += [[param.state, name] for name in sorted(param.state.keys())]
+		return arrays
+
+	def share_parameters(self):
+		"""moves W, the master weights and the optimizer state of every parameter into shared memory"""
+		#the optimizer state has to exist before the workers are forked
+		for layer in self.net:
+			layer.init_optimizer_state()
+
+		arrays = []
+		for param in self.params:
+			arrays += self.get_parameter_arrays(param)
+		values = [self.get_array(owner, key) for [owner, key] in arrays]
+		self.weights = SharedArrays([(value.shape, value.dtype) for value in values])
+
+		for ([owner, key], value, shared) in zip(arrays, values, self.weights.arrays):
+			shared[...] = value
+			self.set_array(owner, key, shared)
+
+	def unshare_parameters(self):
+		"""copies the parameters back into ordinary memory, and releases the shared memory"""
+		for param in self.params:
+			for [owner, key] in self.get_parameter_arrays(param):
+				self.set_array(owner, key, self.get_array(owner, key).copy())
+			param.set_Dew(None)
+		self.weights.close()
+
+	def get_array(self, owner, key):
+		if isinstance(owner, dict):
+			return owner[key]
+		return getattr(owner, key)
+
+	def set_array(self, owner, key, value):
+		if isinstance(owner, dict):
+			owner[key] = value
+		else:
+			setattr(owner, key, value)
+
+
+	def run_worker(self, iworker, pipe):
+		"""worker loop: runs whatever this process is sent until it gets None"""
+		while True:
+			message = pipe.recv()
+			if message is None:
+				break
+			try:
+				[inputs, targets, weight] = message
+				if self.mode == 'sync':
+					self.net.forward(inputs)
+					self.net.backward(targets)
+					for (param, slot) in zip(self.params, self.gradient_slots[iworker]):
+						if param.Dew_columns is None:
+							np.multiply(param.Dew, weight, out=slot)
+						else:
+							slot[...] = 0.0
+							param.add_Dew_to(slot, weight)
+				else:
+					self.net.train_batch(inputs, targets)
+				pipe.send(None)
+			except Exception:
+				pipe.send(traceback.format_exc())
+		pipe.close()
+
+	def wait(self, iworker):
+		"""waits until worker iworker has finished what it was sent"""
+		error = self.pipes[iworker].recv()
+		if error is not None:
+			print('Worker %d failed:\n%s' % (iworker, error))
+			self.close()
+			sys.exit()
+
+
+	def train_batch(self, inputs, targets):
+		"""one batch (samples in columns), split across the workers. In sync mode this is one gradient step"""
+		num_samples = inputs.shape[1]
+		bounds = np.linspace(0, num_samples, self.num_workers+1).astype(int)
+		num_shards = 0
+		for iworker in range(0, self.num_workers):
+			[start, end] = bounds[iworker:iworker+2]
+			if end > start:
+				weight = float(end - start) / float(num_samples)
+				self.pipes[iworker].send([inputs[:, start:end], targets[..., start:end], weight])
+				num_shards += 1
+		for iworker in range(0, num_shards):
+			self.wait(iworker)
+
+		if self.mode == 'sync':
+			self.reduce_gradients(num_shards)
+			self.net.update()
+
+	def reduce_gradients(self, num_shards):
+		"""sums the gradient slots of the workers into the first one, and points each param.Dew at it"""
+		for (iparam, param) in enumerate(self.params):
+			total = self.gradient_slots[0][iparam]
+			for iworker in range(1, num_shards):
+				total += self.gradient_slots[iworker][iparam]
+			param.set_Dew(total)
+
+
+	def fit(self, get_batches, num_epochs=1, callback=None):
+		"""Network.fit on the workers. In hogwild mode whole batches go to the workers in turn, with up to two
+		   outstanding per worker. callback(iepoch, ibatch, inputs, targets) runs in this process, which hasn't
+		   run the batch itself (use net.evaluate to get a cost); training stops early if it returns True"""
+		for iepoch in range(0, num_epochs):
+			if self.mode == 'sync':
+				for (ibatch, (inputs, targets)) in enumerate(get_batches()):
+					self.train_batch(inputs, targets)
+					if callback is not None and callback(iepoch, ibatch, inputs, targets):
+						return
+				continue
+
+			outstanding = [0] * self.num_workers
+			stop = False
+			for (ibatch, (inputs, targets)) in enumerate(get_batches()):
+				iworker = ibatch % self.num_workers
+				if outstanding[iworker] == 2:
+					self.wait(iworker)
+					outstanding[iworker] -= 1
+				self.pipes[iworker].send([inputs, targets, 1.0])
+				outstanding[iworker] += 1
+				if callback is not None and callback(iepoch, ibatch, inputs, targets):
+					stop = True
+					break
+
+			#finish the epoch before the next one starts (or the caller looks at the weights)
+			for iworker in range(0, self.num_workers):
+				for i in range(0, outstanding[iworker]):
+					self.wait(iworker)
+			if stop:
+				return
+
+
+	def close(self):
+		"""stops the workers and moves the weights back into ordinary memory"""
+		for (pipe, worker) in zip(self.pipes, self.workers):
+			try:
+				pipe.send(None)
+			except (BrokenPipeError, OSError):
+				pass
+			worker.join()
+			pipe.close()
+		self.pipes = []
+		self.workers = []
+
+		self.unshare_parameters()
+		if self.gradients is not None:
+			self.gradient_slots = []
+			self.gradients.close()
+			self.gradients = None
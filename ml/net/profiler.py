@@ -0,0 +1,159 @@
+import json
+import time
+import tracemalloc
+from base import *
+
+
+def get_forward_flops(layer, num_samples):
+	"""y = f(z) of layer (unless it takes its input from data), and the net input to the layer above"""
+	flops = 0
+	if layer.layer_type not in ['input', 'embedding']:
+		flops += layer.activation.flops * layer.num_neurons * num_samples
+	for block in layer.blocks:
+		flops += block.get_flops(num_samples)[0]
+	return flops
+
+def get_output_Dez_flops(layer, num_samples):
+	return layer.num_neurons * num_samples
+
+def get_gradient_flops(layer, num_samples):
+	return sum([block.get_flops(num_samples)[2] for block in layer.trainable_blocks])
+
+def get_backward_flops(layer, num_samples):
+	"""gradients of the outgoing weights, and dE/dz of layer through its outgoing connections"""
+	flops = get_gradient_flops(layer, num_samples)
+	flops += sum([block.get_flops(num_samples)[1] for block in layer.connections])
+	flops += layer.activation.derivative_flops * layer.num_neurons * num_samples
+	return flops
+
+def get_activation_flops(layer, num_samples):
+	"""y = f(z) only (the layer below an output layer with a loss)"""
+	if layer.layer_type in ['input', 'embedding']:
+		return 0
+	return layer.activation.flops * layer.num_neurons * num_samples
+
+def get_derivative_flops(layer, num_samples):
+	return layer.activation.derivative_flops * layer.num_neurons * num_samples
+
+def get_loss_flops(layer, num_samples):
+	"""the loss of an output layer, which picks the outputs (and gradients) it needs"""
+	return layer.layer_below.connections[0].get_loss_flops(num_samples)
+
+def get_update_flops(layer, num_samples):
+	#a gradient of some columns (see Parameter.Dew_columns) only updates those
+	sizes = [param.W.size if param.Dew_columns is None else param.Dew.size for param in layer.params]
+	return layer.optimizer.flops_per_weight * sum(sizes)
+
+
+def get_shape(value):
+	if isinstance(value, np.ndarray):
+		return list(value.shape)
+	return None
+
+
+class Profiler:
+	"""Records wall time, FLOPs (estimated from the layer sizes), array shapes and, with track_memory, bytes
+	   allocated (via tracemalloc, which slows things down) for every step of a Network's plan: one event per layer
+	   and phase (forward, backward, update) and batch. Attach with Network.set_profiler; without a profiler the
+	   plan runs the layer kernels directly, so there is no overhead at all"""
+
+	def __init__(self, track_memory=False):
+		self.track_memory = track_memory
+		self.started_tracing = False
+		self.clear()
+
+	def clear(self):
+		self.events = []
+		self.num_batches = 0
+		self.batch_size = 0
+		self.start_time = time.perf_counter()
+
+	def enable(self):
+		if self.track_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.started_tracing = True
+
+	def disable(self):
+		if self.started_tracing:
+			tracemalloc.stop()
+			self.started_tracing = False
+
+
+	def wrap(self, step, layer, phase, get_flops, begins_batch=False):
+		"""step, recording an event each time it runs. begins_batch marks the first step of a training batch"""
+		def profiled(*args):
+			if begins_batch:
+				self.num_batches += 1
+				self.batch_size = args[0].shape[-1]
+			num_samples = self.batch_size
+			if len(args) > 0 and isinstance(args[0], np.ndarray):
+				num_samples = args[0].shape[-1]
+
+			if self.track_memory:
+				tracemalloc.reset_peak()
+				before = tracemalloc.get_traced_memory()[0]
+			start = time.perf_counter()
+			result = step(*args)
+			end = time.perf_counter()
+
+			allocated = None
+			if self.track_memory:
+				allocated = tracemalloc.get_traced_memory()[1] - before
+
+			self.events += [{'batch': self.num_batches, 'layer': layer.name, 'phase': phase,
+			                 'start': start - self.start_time, 'duration': end - start,
+			                 'flops': get_flops(layer, num_samples), 'bytes': allocated,
+			                 'input_shape': get_shape(args[0]) if len(args) > 0 else None, 'output_shape': get_shape(result)}]
+			return result
+		return profiled
+
+
+	def get_summary(self):
+		"""[layer, phase, calls, seconds, flops, bytes, output shape] per layer and phase, in the order they first ran"""
+		rows = {}
+		order = []
+		for event in self.events:
+			key = (event['layer'], event['phase'])
+			if key not in rows:
+				rows[key] = [event['layer'], event['phase'], 0, 0.0, 0, 0, None]
+				order += [key]
+			row = rows[key]
+			row[2] += 1
+			row[3] += event['duration']
+			row[4] += event['flops']
+			row[5] += event['bytes'] or 0
+			row[6] = event['output_shape']
+		return [rows[key] for key in order]
+
+	def get_table(self):
+		"""summary as a text table"""
+		summary = self.get_summary()
+		total = sum([row[3] for row in summary])
+		lines = ['%-14s %-9s %7s %11s %11s %7s %10s %12s  %s' % ('layer', 'phase', 'calls', 'total ms', 'mean ms', '%', 'GFLOP/s', 'KB/call', 'output shape')]
+		for [layer, phase, calls, seconds, flops, allocated, shape] in summary:
+			gflops = flops / seconds / 1e9 if seconds > 0 else 0.0
+			kb = '-'
+			if self.track_memory:
+				kb = '%.1f' % (allocated / 1e3 / calls)
+			lines += ['%-14s %-9s %7d %11.3f %11.4f %7.1f %10.2f %12s  %s' % (layer, phase, calls, seconds * 1e3, seconds * 1e3 / calls,
+			                                                                100.0 * seconds / total if total > 0 else 0.0, gflops, kb, shape)]
+		lines += ['%d batches, %.3f ms per batch' % (self.num_batches, total * 1e3 / max(self.num_batches, 1))]
+		return '\n'.join(lines)
+
+	def print_table(self):
+		print(self.get_table())
+
+	def get_chrome_trace(self):
+		"""the events in Chrome's trace event format (load in chrome://tracing or Perfetto)"""
+		trace_events = []
+		for event in self.events:
+			args = {'batch': event['batch'], 'flops': event['flops'], 'input_shape': event['input_shape'], 'output_shape': event['output_shape']}
+			if event['bytes'] is not None:
+				args['bytes'] = event['bytes']
+			trace_events += [{'name': '%s %s' % (event['layer'], event['phase']), 'cat': event['phase'], 'ph': 'X',
+			                  'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6, 'pid': 0, 'tid': 0, 'args': args}]
+		return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+	def save_chrome_trace(self, file_path):
+		with open(file_path, 'w') as f:
+			json.dump(self.get_chrome_trace(), f)
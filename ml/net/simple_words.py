@@ -1,20 +1,15 @@
 import time
 import sys
 from base import *
+from network import Network
+from parallel import ParallelTrainer
+from loader import DataLoader
+from checkpoint import save_network, AsyncCheckpointer
+from validation import Validator
 
 
 def main():
-	#get matlab data
-	data = sio.loadmat('data.mat')
-	_vocab = data['data'][0,0]['vocab']
-	vocab = []
-	for i in range(_vocab.shape[1]):
-		vocab += [ _vocab[0,i][0] ]
-
-	#samples are in rows
-	train_data = data['data'][0,0]['trainData'].T
-	validate_data = data['data'][0,0]['validData'].T
-	test_data = data['data'][0,0]['testData'].T
+	[vocab, train_data, validate_data, test_data] = load_data('data.mat')
 
 	num_words = len(vocab)
 	net = make_layers(num_words)
@@ -29,56 +24,106 @@ def main():
 	#back_to_test = get_word_indices_from_one_hot(one_hot, 10)
 	#print(back_to_test)
 
-	train(net, train_data, validate_data, test_data, batch_size=100, num_words=num_words, num_epochs=10)
-	np.savetxt("hidden.csv", net[2].W, delimiter='\t')
-	np.savetxt("hidden_y.csv", net[2].y, delimiter='\t')
-	np.savetxt("embed.csv", net[1].W, delimiter='\t')
-	np.savetxt("embed_y.csv", net[1].y, delimiter='\t')
-	np.savetxt("out_y.csv", net[3].y, delimiter='\t')
+	train(net, train_data, validate_data, test_data, batch_size=100, num_words=num_words, num_epochs=10, checkpoint_path='simple_words.ckpt',
+	      patience=5, best_path='simple_words_best.ckpt')
+
+	#weights, optimizer state and layer configuration. load back with checkpoint.load_network
+	save_network(net, 'simple_words.net')
 
 	#print(net[0].W)
 	#print(net[1].W)
 	#print(net[2].W)
 
 
-def train(net, train_data, validate_data, test_data, batch_size, num_words, num_epochs=1):
-
-	train_size = train_data.shape[0]
-	num_batches = float(train_size) / float(batch_size)
-	num_batches = math.floor(num_batches)
+def load_data(file_path):
+	"""returns [vocab, train_data, validate_data, test_data] from the matlab data file. samples are in rows"""
+	#get matlab data
+	data = sio.loadmat(file_path)
+	_vocab = data['data'][0,0]['vocab']
+	vocab = []
+	for i in range(_vocab.shape[1]):
+		vocab += [ _vocab[0,i][0] ]
 
-	[valid_inputs, valid_targets] = get_one_hot_data(validate_data[0:10000,:].T, num_words)	#TODO
+	#samples are in rows
+	train_data = data['data'][0,0]['trainData'].T
+	validate_data = data['data'][0,0]['validData'].T
+	test_data = data['data'][0,0]['testData'].T
 
-	for iepoch in range(0, num_epochs):
-		for ibatch in range(0, num_batches):
-			batch_train_data = np.array
-			if ibatch != num_batches-1:
-				batch_train_data = train_data[ibatch*batch_size : (ibatch+1)*batch_size, :]
+	return [vocab, train_data, validate_data, test_data]
+
+
+def train(net, train_data, validate_data, test_data, batch_size, num_words, num_epochs=1, reuse_buffers=True,
+          num_workers=1, parallel_mode='sync', shuffle=True, checkpoint_path=None, checkpoint_every=1000,
+          validate_every=1000, patience=None, best_path=None, accumulate=1, num_validate=10000):
+	"""Trains net on batches of train_data, shuffled every epoch unless shuffle is False. With num_workers > 1,
+	   batches are trained on that many processes (see ParallelTrainer for parallel_mode). With a checkpoint_path,
+	   the net is saved there every checkpoint_every batches (in the background) and at the end of every epoch.
+
+	   The validation cost is computed every validate_every batches, on the first num_validate samples of
+	   validate_data (all of them if num_validate is None). Training stops once it hasn't improved for
+	   `patience` validations in a row (if patience isn't None). With a best_path, the net with the best validation
+	   cost so far is kept there. With accumulate > 1, the weights are updated once every `accumulate` batches, with
+	   the gradient of all of them (single process only). Returns the Validator, which holds the validation costs"""
+	assert(accumulate == 1 or num_workers == 1)
+
+	#keep activation/gradient arrays between batches instead of allocating new ones every batch
+	net.set_buffer_reuse(reuse_buffers)
+
+	dtype = net[-1].dtype
+	#a sampled/hierarchical output layer only needs the index of each target word
+	target_indices = net[-1].loss is not None
+	def encode(samples, out):
+		return get_index_data(samples, num_words, dtype, out, target_indices)
+
+	#batches are encoded on a background thread while the net trains
+	train_loader = DataLoader(train_data, batch_size, encode, shuffle=shuffle)
+	if num_validate is not None:
+		validate_data = validate_data[0:num_validate,:]
+	valid_loader = DataLoader(validate_data, batch_size, encode, shuffle=False)
+	[valid_inputs, valid_targets] = valid_loader.get_all()
+	validator = Validator(valid_inputs, valid_targets, validate_every, patience, best_path=best_path)
+
+	checkpointer = None
+	if checkpoint_path is not None:
+		checkpointer = AsyncCheckpointer(checkpoint_path)
+
+	trainer = None
+	if num_workers > 1:
+		trainer = ParallelTrainer(net, num_workers, parallel_mode)
+
+	#print stuff
+	def report(iepoch, ibatch, train_inputs, train_targets):
+		if ibatch % 100 == 0:
+			if trainer is None:
+				cost = net.get_cost(train_targets)
 			else:
-				#last batch... may have incomplete batch
-				batch_train_data = train_data[ibatch*batch_size :, :]
-
-			#split train data into input and targets
-			[train_inputs, train_targets] = get_one_hot_data(batch_train_data.T, num_words)
-
-			#do forward propagation
-			net[0].forwardprop_update(input_data = train_inputs)
-
-			#do back propagation
-			net[-1].backprop_update(targets = train_targets)
-
-			#print stuff
-			if ibatch % 100 == 0:
-				cost = net[-1].get_cost(train_targets)
-				if cost is not None:
-					print('epoch %d   batch %d  cost %f' % (iepoch, ibatch, cost))
-			if (ibatch - 1) % 1000 == 0 and ibatch > 0:
-				net[0].forwardprop_update(input_data = valid_inputs)
-				cost = net[-1].get_cost(valid_targets)
-				if cost is not None:
-					print('epoch %d   batch %d  validate cost %f' % (iepoch, ibatch, cost))
-
-			#return
+				#the batch ran on the workers
+				cost = net.evaluate(train_inputs, train_targets)
+			if cost is not None:
+				print('epoch %d   batch %d  cost %f' % (iepoch, ibatch, cost))
+		if checkpointer is not None and (ibatch + 1 == len(train_loader) or (ibatch + 1) % checkpoint_every == 0):
+			checkpointer.save(net, {'epoch': iepoch, 'batch': ibatch})
+
+		stop = validator.after_batch(net, {'epoch': iepoch, 'batch': ibatch})
+		if validator.is_due():
+			print('epoch %d   batch %d  validate cost %f' % (iepoch, ibatch, validator.get_last_cost()))
+		if stop:
+			print('stopping early: best validate cost %f, %d batches in' % (validator.best_cost, validator.best_batch))
+		return stop
+
+	try:
+		if trainer is None:
+			net.fit(lambda: iter(train_loader), num_epochs, callback=report, accumulate=accumulate)
+		else:
+			trainer.fit(lambda: iter(train_loader), num_epochs, callback=report)
+	finally:
+		if trainer is not None:
+			trainer.close()
+		if checkpointer is not None:
+			checkpointer.wait()
+		validator.close()
+
+	return validator
 
 
 		
@@ -94,7 +139,44 @@ def get_one_hot_data(samples, vocab_size):
 	return [one_hot_inputs, one_hot_targets]
 
 
-def get_one_hot(word_matrix, vocab_size):
+def get_index_data(samples, vocab_size, dtype=np.float64, out=None, target_indices=False):
+	"""inputs for an embedding input layer (indices of the active one-hot neurons), and one-hot targets (or, with
+	   target_indices, the 0-based index of each target word). out is an earlier [inputs, targets] to refill, if it
+	   has the right shapes"""
+	inputs = samples[0:-1,:]
+	targets = samples[-1,:]
+
+	if target_indices:
+		if out is None or out[0].shape != inputs.shape or out[1].shape != targets.shape:
+			return [get_one_hot_indices(inputs, vocab_size), targets - 1]
+		get_one_hot_indices(inputs, vocab_size, out=out[0])
+		np.subtract(targets, 1, out=out[1])
+		return out
+
+	if out is None or out[0].shape != inputs.shape or out[1].shape != (vocab_size, samples.shape[1]) or out[1].dtype != dtype:
+		return [get_one_hot_indices(inputs, vocab_size), get_one_hot(targets, vocab_size, dtype)]
+
+	get_one_hot_indices(inputs, vocab_size, out=out[0])
+	out[1].fill(0.0)
+	out[1][targets - 1, np.arange(samples.shape[1])] = 1.0
+	return out
+
+
+def get_word_counts(data, vocab_size):
+	"""how often each word is the target (last column) in data (samples in rows, 1-based words)"""
+	return np.bincount(data[:,-1] - 1, minlength=vocab_size)
+
+
+def get_one_hot_indices(word_matrix, vocab_size, out=None):
+	"""returns the index of the 'hot' neuron for each word, i.e. the row that would hold its 1.0 in get_one_hot"""
+	numi = word_matrix.shape[0]
+	offsets = vocab_size * np.arange(numi)[:,np.newaxis]
+	result = np.add(offsets, word_matrix, out=out)
+	result -= 1
+	return result
+
+
+def get_one_hot(word_matrix, vocab_size, dtype=np.float64):
 	shape = word_matrix.shape
 	if len(shape) > 1:
 		numi, numj = shape
@@ -102,13 +184,8 @@ def get_one_hot(word_matrix, vocab_size):
 		word_matrix = word_matrix[np.newaxis]	#need to convert array into a matrix
 		numi, numj = word_matrix.shape
 	
-	result = np.zeros( (numi*vocab_size, numj) )
-
-	for j in range(0,numj):
-		new_col = np.array
-		for i in range(0,numi):
-			word = word_matrix[i,j]
-			result[i*vocab_size + word-1, j] = 1.0
+	result = np.zeros( (numi*vocab_size, numj), dtype )
+	result[get_one_hot_indices(word_matrix, vocab_size), np.arange(numj)] = 1.0
 	return result
 
 
@@ -125,26 +202,36 @@ def get_word_indices_from_one_hot(one_hot_matrix, vocab_size):
 
 
 def get_output_words(output_layer):
-	output = output_layer.y
-	num_samples = output.shape[1]
-	word_inds = []
-	for isamp in range(0,num_samples):
-		word_inds += [np.argmax( output[:,isamp] ) + 1]
-	return word_inds
+	return list(np.argmax(output_layer.y, axis=0) + 1)
+
 
+def predict_words(net, contexts, num_words, k=1, chunk_size=1024):
+	"""the k most likely next words (k x samples, most likely first, 1-based) after each context.
+	   contexts holds one 3-word context per column"""
+	inputs = get_one_hot_indices(contexts, num_words)
+	if k == 1:
+		return net.predict(inputs, chunk_size)[np.newaxis,:] + 1
+	return net.top_k(inputs, k, chunk_size) + 1
 
-def make_layers(num_words):
+
+def make_layers(num_words, tie_embeddings=False, dtype=np.float64, master_dtype=None, optimizer=None, learning_rate=0.09, loss=None):
+	"""optimizer (e.g. optimizers.Adam(), with a learning_rate around 0.001) applies to every layer. default: SGD with momentum.
+	   loss (e.g. losses.SampledSoftmax(64, get_word_counts(train_data, num_words))) trains the output layer on part
+	   of the vocabulary per batch. default: the full softmax"""
 	input_size = num_words
 	embedding_size = 50
 	hidden_size = 200
 	output_size = num_words
-	learning_rate = 0.09
+
+	#dtype/master_dtype apply to the whole net (e.g. float32 compute with float64 master weights).
+	#optimizers keep their state with the weights, so one can be shared by all layers
+	precision = {'dtype': dtype, 'master_dtype': master_dtype, 'optimizer': optimizer}
 
 	#create layers
-	input_layer = Layer(name='input', num_columns = input_size*3, layer_type = 'input', learning_rate=learning_rate, neuron_type='linear')
-	embedding_layer = Layer(name='embedding', num_columns = embedding_size*3, learning_rate=learning_rate, neuron_type='linear')
-	hidden_layer = Layer(name='hidden', num_columns = hidden_size, learning_rate=learning_rate, bias=1.0, neuron_type='logistic')
-	output_layer = Layer(name='output', num_columns = output_size, neuron_type = 'softmax', learning_rate=learning_rate, bias=1.0)
+	input_layer = Layer(name='input', num_columns = input_size*3, layer_type = 'embedding', learning_rate=learning_rate, neuron_type='linear', **precision)
+	embedding_layer = Layer(name='embedding', num_columns = embedding_size*3, learning_rate=learning_rate, neuron_type='linear', **precision)
+	hidden_layer = Layer(name='hidden', num_columns = hidden_size, learning_rate=learning_rate, bias=1.0, neuron_type='logistic', **precision)
+	output_layer = Layer(name='output', num_columns = output_size, neuron_type = 'softmax', learning_rate=learning_rate, bias=1.0, loss=loss, **precision)
 
 	#connect inputs
 	#input_layer.connect_to_layer(embedding_layer)
@@ -152,12 +239,13 @@ def make_layers(num_words):
 	input_layer.connect_to_layer(embedding_layer, from_subset=[input_size, 2*input_size], to_subset=[embedding_size, 2*embedding_size])
 	input_layer.connect_to_layer(embedding_layer, from_subset=[2*input_size, 3*input_size], to_subset=[2*embedding_size, 3*embedding_size])
 
-	#tie together weights on the input layer
-	#input_layer.tie_weights_in_range([
-	#                                 [[0,input_size], [0,embedding_size]],
-	#                                 [[input_size, 2*input_size], [embedding_size, 2*embedding_size]],
-	#                                 [[2*input_size, 3*input_size], [2*embedding_size, 3*embedding_size]]
-	#				 ])
+	#tie together weights on the input layer (same embedding for a word in every context position)
+	if tie_embeddings:
+		input_layer.tie_weights_in_range([
+		                                 [[0,input_size], [0,embedding_size]],
+		                                 [[input_size, 2*input_size], [embedding_size, 2*embedding_size]],
+		                                 [[2*input_size, 3*input_size], [2*embedding_size, 3*embedding_size]]
+						 ])
 
 
 	#connect embedding layer
@@ -168,7 +256,7 @@ def make_layers(num_words):
 	
 	print("Finished connecting layers")
 
-	net = [input_layer, embedding_layer, hidden_layer, output_layer]
+	net = Network([input_layer, embedding_layer, hidden_layer, output_layer])
 	return net
 
 
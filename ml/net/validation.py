@@ -0,0 +1,70 @@
+from base import *
+from checkpoint import AsyncCheckpointer
+
+
+class Validator:
+	"""Keeps track of the validation cost of a net during training. The validation set is encoded once (inputs and
+	   targets, samples in columns) and evaluated in chunks on the inference path, so the training state of the
+	   layers is left alone.
+
+	   Call after_batch() after every training batch: every `every` batches it evaluates the net, and it returns
+	   True when training should stop, i.e. when the cost hasn't improved by more than min_delta for `patience`
+	   evaluations in a row (never, if patience is None). With a best_path, the net is saved there (in the
+	   background) every time the cost improves."""
+
+	def __init__(self, inputs, targets, every=1000, patience=None, min_delta=0.0, best_path=None, chunk_size=1024):
+		assert(every >= 1)
+		self.inputs = inputs
+		self.targets = targets
+		self.every = every
+		self.patience = patience
+		self.min_delta = min_delta
+		self.chunk_size = chunk_size
+
+		self.checkpointer = None
+		if best_path is not None:
+			self.checkpointer = AsyncCheckpointer(best_path)
+
+		self.num_batches = 0
+		self.best_cost = None
+		self.best_batch = None
+		self.num_worse = 0
+		self.costs = []		#[batch, cost] of every evaluation
+
+	def evaluate(self, net):
+		return net.evaluate(self.inputs, self.targets, self.chunk_size)
+
+	def after_batch(self, net, extra=None):
+		"""counts a training batch; evaluates the net if it is time to. extra goes with the best checkpoint"""
+		self.num_batches += 1
+		if self.num_batches % self.every != 0:
+			return False
+
+		cost = self.evaluate(net)
+		self.costs += [[self.num_batches, cost]]
+
+		if self.best_cost is None or cost < self.best_cost - self.min_delta:
+			self.best_cost = cost
+			self.best_batch = self.num_batches
+			self.num_worse = 0
+			if self.checkpointer is not None:
+				self.checkpointer.save(net, {'batch': self.num_batches, 'cost': cost, 'extra': extra})
+		else:
+			self.num_worse += 1
+
+		return self.patience is not None and self.num_worse >= self.patience
+
+	def get_last_cost(self):
+		"""cost of the latest evaluation (None if there hasn't been one)"""
+		if len(self.costs) == 0:
+			return None
+		return self.costs[-1][1]
+
+	def is_due(self):
+		"""whether the last batch counted was evaluated"""
+		return self.num_batches > 0 and self.num_batches % self.every == 0
+
+	def close(self):
+		"""waits for the best checkpoint (if any) to be written"""
+		if self.checkpointer is not None:
+			self.checkpointer.wait()